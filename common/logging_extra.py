@@ -7,9 +7,12 @@ import time
 import uuid
 import socket
 import logging
+import functools
+import threading
 import traceback
 from threading import local
 from collections import OrderedDict
+from collections.abc import Mapping
 from contextlib import contextmanager
 
 LOG_TIMESTAMPS = "LOG_TIMESTAMPS" in os.environ
@@ -19,13 +22,46 @@ def json_handler(obj):
   #   return obj.isoformat()
   return repr(obj)
 
-def json_robust_dumps(obj):
-  return json.dumps(obj, default=json_handler)
+_json_encoder = json.JSONEncoder(default=json_handler)
+if json.encoder.c_make_encoder is not None:
+  # the C encoder without JSONEncoder.encode's overhead, with its own markers dict per call
+  # since a shared one breaks across threads and after a repr() raises
+  _c_encoder_args = (json_handler, json.encoder.encode_basestring_ascii, None, ': ', ', ', False, False, True)
+  def json_robust_dumps(obj):
+    if isinstance(obj, str):
+      return json.encoder.encode_basestring_ascii(obj)
+    return ''.join(json.encoder.c_make_encoder({}, *_c_encoder_args)(obj, 0))
+else:
+  def json_robust_dumps(obj):
+    return _json_encoder.encode(obj)
+
+# records are encoded with msg as the last key, split right before its value, so
+# logmessaged can publish them and the file writer can tag msg without decoding the rest
+MSG_KEY = '"msg": '
 
 class NiceOrderedDict(OrderedDict):
   def __str__(self):
     return json_robust_dumps(self)
 
+@functools.lru_cache(maxsize=4096)
+def _site_fragment(levelname, levelno, name, filename, lineno, pathname, module, funcName, host, process):
+  site = NiceOrderedDict()
+  site['level'] = levelname
+  site['levelnum'] = levelno
+  site['name'] = name
+  site['filename'] = filename
+  site['lineno'] = lineno
+  site['pathname'] = pathname
+  site['module'] = module
+  site['funcName'] = funcName
+  site['host'] = host
+  site['process'] = process
+  return ', ' + json_robust_dumps(site)[1:-1]
+
+@functools.lru_cache(maxsize=256)
+def _thread_fragment(thread, thread_name):
+  return f', "thread": {thread}, "threadName": {json_robust_dumps(thread_name)}'
+
 class SwagFormatter(logging.Formatter):
   def __init__(self, swaglogger):
     logging.Formatter.__init__(self, None, '%a %b %d %H:%M:%S %Z %Y')
@@ -33,42 +69,37 @@ class SwagFormatter(logging.Formatter):
     self.swaglogger = swaglogger
     self.host = socket.gethostname()
 
-  def format_dict(self, record):
-    record_dict = NiceOrderedDict()
-
+  def get_msg(self, record):
     if isinstance(record.msg, dict):
-      record_dict['msg'] = record.msg
-    else:
-      try:
-        record_dict['msg'] = record.getMessage()
-      except (ValueError, TypeError):
-        record_dict['msg'] = [record.msg]+record.args
-
-    record_dict['ctx'] = self.swaglogger.get_ctx()
+      return record.msg
+    try:
+      return record.getMessage()
+    except (ValueError, TypeError):
+      return [record.msg, *record.args]
 
+  def format_prefix(self, record):
+    """
+    The record as JSON up to and including MSG_KEY.
+    Everything fixed for a call site is only encoded once.
+    """
+    ctx = self.swaglogger.get_ctx()
+    prefix = '{"ctx": ' + (json_robust_dumps(ctx) if ctx else '{}')
     if record.exc_info:
-      record_dict['exc_info'] = self.formatException(record.exc_info)
-
-    record_dict['level'] = record.levelname
-    record_dict['levelnum'] = record.levelno
-    record_dict['name'] = record.name
-    record_dict['filename'] = record.filename
-    record_dict['lineno'] = record.lineno
-    record_dict['pathname'] = record.pathname
-    record_dict['module'] = record.module
-    record_dict['funcName'] = record.funcName
-    record_dict['host'] = self.host
-    record_dict['process'] = record.process
-    record_dict['thread'] = record.thread
-    record_dict['threadName'] = record.threadName
-    record_dict['created'] = record.created
-
-    return record_dict
+      prefix += ', "exc_info": ' + json_robust_dumps(self.formatException(record.exc_info))
+    prefix += _site_fragment(record.levelname, record.levelno, record.name, record.filename, record.lineno, record.pathname,
+                             record.module, record.funcName, self.host, record.process)
+    prefix += _thread_fragment(record.thread, record.threadName) + f', "created": {record.created!r}, ' + MSG_KEY
+    return prefix
+
+  def format_parts(self, record):
+    # the record as JSON, split before the msg value: prefix + msg + '}'
+    return self.format_prefix(record), json_robust_dumps(self.get_msg(record))
 
   def format(self, record):
     if self.swaglogger is None:
       raise Exception("must set swaglogger before calling format()")
-    return json_robust_dumps(self.format_dict(record))
+    prefix, msg = self.format_parts(record)
+    return prefix + msg + '}'
 
 class SwagLogFileFormatter(SwagFormatter):
   def fix_kv(self, k, v):
@@ -95,18 +126,32 @@ class SwagLogFileFormatter(SwagFormatter):
       k += "$a"
     return k, v
 
+  def format_msg(self, msg):
+    mk, mv = self.fix_kv('msg', msg)
+    return json_robust_dumps(mk) + ': ' + json_robust_dumps(mv)
+
+  def format_encoded_msg(self, msg):
+    # strings, the common case, are tagged without decoding
+    if msg.startswith('"'):
+      return '"msg$s": ' + msg
+    return self.format_msg(json.loads(msg))
+
   def format(self, record):
     if isinstance(record, str):
+      # complete JSON record, e.g. from the C++ logger
       v = json.loads(record)
+      mk, mv = self.fix_kv('msg', v['msg'])
+      del v['msg']
+      v[mk] = mv
+      v['id'] = uuid.uuid4().hex
+      return json_robust_dumps(v)
+
+    if isinstance(record, logging.LogRecord):
+      # tagged from the original objects, like before the records were split
+      prefix, msg = self.format_prefix(record), self.format_msg(self.get_msg(record))
     else:
-      v = self.format_dict(record)
-
-    mk, mv = self.fix_kv('msg', v['msg'])
-    del v['msg']
-    v[mk] = mv
-    v['id'] = uuid.uuid4().hex
-
-    return json_robust_dumps(v)
+      prefix, msg = record[0], self.format_encoded_msg(record[1])
+    return prefix[:-len(MSG_KEY)] + msg + f', "id": "{uuid.uuid4().hex}"}}'
 
 class SwagErrorFilter(logging.Filter):
   def filter(self, record):
@@ -118,6 +163,37 @@ def _tmpfunc():
 def _srcfile():
   return os.path.normcase(_tmpfunc.__code__.co_filename)
 
+@functools.lru_cache(maxsize=4096)
+def _site_attrs(name, level, pathname, lineno, func, process):
+  try:
+    filename = os.path.basename(pathname)
+    module = os.path.splitext(filename)[0]
+  except (TypeError, ValueError, AttributeError):
+    filename = pathname
+    module = "Unknown module"
+
+  process_name = 'MainProcess'
+  mp = sys.modules.get('multiprocessing')
+  if mp is not None:
+    try:
+      process_name = mp.current_process().name
+    except Exception:
+      pass
+
+  return {
+    'name': name,
+    'levelname': logging.getLevelName(level),
+    'levelno': level,
+    'pathname': pathname,
+    'filename': filename,
+    'module': module,
+    'lineno': lineno,
+    'funcName': func,
+    'process': process,
+    'processName': process_name,
+    'taskName': None,
+  }
+
 class SwagLogger(logging.Logger):
   def __init__(self):
     logging.Logger.__init__(self, "swaglog")
@@ -153,15 +229,51 @@ class SwagLogger(logging.Logger):
   def bind_global(self, **kwargs):
     self.global_ctx.update(kwargs)
 
+  def makeRecord(self, name, level, fn, lno, msg, args, exc_info, func=None, extra=None, sinfo=None):
+    # same record as logging.LogRecord, with the call site attributes computed once per call site
+    rv = logging.LogRecord.__new__(logging.LogRecord)
+    rv.__dict__.update(_site_attrs(name, level, fn, lno, func, os.getpid()))
+
+    if args and len(args) == 1 and isinstance(args[0], Mapping) and args[0]:
+      args = args[0]
+    rv.msg = msg
+    rv.args = args
+    rv.exc_info = exc_info
+    rv.exc_text = None
+    rv.stack_info = sinfo
+
+    ct = time.time()
+    rv.created = ct
+    rv.msecs = int((ct - int(ct)) * 1000) + 0.0
+    rv.relativeCreated = (ct - logging._startTime) * 1000
+    rv.thread = threading.get_ident()
+    rv.threadName = threading.current_thread().name
+
+    if extra is not None:
+      for key in extra:
+        if (key in ["message", "asctime"]) or (key in rv.__dict__):
+          raise KeyError(f"Attempt to overwrite {key!r} in LogRecord")
+        rv.__dict__[key] = extra[key]
+    return rv
+
   def event(self, event, *args, **kwargs):
+    if 'error' in kwargs:
+      level = logging.ERROR
+    elif 'debug' in kwargs:
+      level = logging.DEBUG
+    else:
+      level = logging.INFO
+    if not self.isEnabledFor(level):
+      return
+
     evt = NiceOrderedDict()
     evt['event'] = event
     if args:
       evt['args'] = args
     evt.update(kwargs)
-    if 'error' in kwargs:
+    if level == logging.ERROR:
       self.error(evt)
-    elif 'debug' in kwargs:
+    elif level == logging.DEBUG:
       self.debug(evt)
     else:
       self.info(evt)
@@ -94,11 +94,10 @@ class UnixDomainSocketHandler(logging.Handler):
       warnings.filterwarnings("ignore", category=ResourceWarning, message="unclosed.*<zmq.*>")
       self.connect()
 
-    msg = self.format(record).rstrip('\n')
-    # print("SEND".format(repr(msg)))
+    # sent as level, prefix and msg frames, see SwagFormatter.format_parts
+    prefix, msg = self.formatter.format_parts(record)
     try:
-      s = chr(record.levelno)+msg
-      self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
+      self.sock.send_multipart([bytes((record.levelno,)), prefix.encode('utf8'), msg.encode('utf8')], zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
@@ -0,0 +1,66 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from openpilot.common.logging_extra import SwagLogFileFormatter, SwagLogger, json_robust_dumps
+
+
+class SlowRepr:
+  def __repr__(self):
+    time.sleep(0.001)
+    return "slow"
+
+
+class BadRepr:
+  def __init__(self):
+    self.fail = True
+
+  def __repr__(self):
+    if self.fail:
+      raise RuntimeError
+    return "bad"
+
+
+class TestJsonRobustDumps:
+  def test_threads(self):
+    obj = {"a": [SlowRepr(), {"b": SlowRepr()}]}
+    with ThreadPoolExecutor(4) as pool:
+      out = list(pool.map(lambda _: json_robust_dumps(obj), range(200)))
+    assert out == ['{"a": ["slow", {"b": "slow"}]}'] * 200
+
+  def test_after_exception(self):
+    obj = BadRepr()
+    for _ in range(2):
+      try:
+        json_robust_dumps([obj])
+      except RuntimeError:
+        pass
+    obj.fail = False
+    assert json_robust_dumps([obj]) == '["bad"]'
+
+  def test_circular(self):
+    obj = []
+    obj.append(obj)
+    try:
+      json_robust_dumps(obj)
+      raise AssertionError
+    except ValueError:
+      pass
+
+
+class TestSwagLogFileFormatter:
+  def test_record_types(self):
+    log = SwagLogger()
+    formatter = SwagLogFileFormatter(log)
+
+    def fmt(msg, *args):
+      record = log.makeRecord("swaglog", logging.INFO, __file__, 1, msg, args, None)
+      return json.loads(formatter.format(record))
+
+    assert fmt("abc %d", 1)["msg$s"] == "abc 1"
+    # tagged from the original objects, not from their JSON
+    assert fmt({"event": "e", "a": 1, "b": [1], "c": (1, 2), "d": threading.Lock})["msg"] == {
+      "event$s": "e", "a$i": 1, "b$a": [1], "c": [1, 2], "d": repr(threading.Lock),
+    }
@@ -141,14 +141,11 @@ class LateralMpc:
     self.x_sol = np.zeros((N+1, X_DIM))
     self.u_sol = np.zeros((N, 1))
     self.yref = np.zeros((N+1, COST_DIM))
-    for i in range(N):
-      self.solver.cost_set(i, "yref", self.yref[i])
-    self.solver.cost_set(N, "yref", self.yref[N][:COST_E_DIM])
+    self.solver.set_all("yref", self.yref)
 
     # Somehow needed for stable init
-    for i in range(N+1):
-      self.solver.set(i, 'x', np.zeros(X_DIM))
-      self.solver.set(i, 'p', np.zeros(P_DIM))
+    self.solver.set_all('x', np.zeros((N+1, X_DIM)))
+    self.solver.set_all('p', np.zeros((N+1, P_DIM)))
     self.solver.constraints_set(0, "lbx", x0)
     self.solver.constraints_set(0, "ubx", x0)
     self.solver.solve()
@@ -176,20 +173,16 @@ class LateralMpc:
     # rotation_radius = p_cp[1]
     self.yref[:,1] = heading_pts * (v_ego + SPEED_OFFSET)
     self.yref[:,2] = yaw_rate_pts * (v_ego + SPEED_OFFSET)
-    for i in range(N):
-      self.solver.cost_set(i, "yref", self.yref[i])
-      self.solver.set(i, "p", p_cp[i])
-    self.solver.set(N, "p", p_cp[N])
-    self.solver.cost_set(N, "yref", self.yref[N][:COST_E_DIM])
+    # the terminal stage only uses the first COST_E_DIM values of its yref row
+    self.solver.set_all("yref", self.yref)
+    self.solver.set_all("p", p_cp)
 
     t = time.monotonic()
     self.solution_status = self.solver.solve()
     self.solve_time = time.monotonic() - t
 
-    for i in range(N+1):
-      self.x_sol[i] = self.solver.get(i, 'x')
-    for i in range(N):
-      self.u_sol[i] = self.solver.get(i, 'u')
+    self.solver.get_all('x', self.x_sol)
+    self.solver.get_all('u', self.u_sol)
     self.cost = self.solver.get_cost()
 
 
@@ -237,14 +237,11 @@ class LongitudinalMpc:
     self.prev_a = np.array(self.a_solution)
     self.j_solution = np.zeros(N)
     self.yref = np.zeros((N+1, COST_DIM))
-    for i in range(N):
-      self.solver.cost_set(i, "yref", self.yref[i])
-    self.solver.cost_set(N, "yref", self.yref[N][:COST_E_DIM])
+    self.solver.set_all("yref", self.yref)
     self.x_sol = np.zeros((N+1, X_DIM))
     self.u_sol = np.zeros((N,1))
     self.params = np.zeros((N+1, PARAM_DIM))
-    for i in range(N+1):
-      self.solver.set(i, 'x', np.zeros(X_DIM))
+    self.solver.set_all('x', np.zeros((N+1, X_DIM)))
     self.last_cloudlog_t = 0
     self.status = False
     self.crash_cnt = 0.0
@@ -292,8 +289,7 @@ class LongitudinalMpc:
     self.x0[1] = v
     self.x0[2] = a
     if abs(v_prev - v) > 2.:  # probably only helps if v < v_prev
-      for i in range(N+1):
-        self.solver.set(i, 'x', self.x0)
+      self.solver.set_all('x', np.tile(self.x0, (N+1, 1)))
 
   @staticmethod
   def extrapolate_lead(x_lead, v_lead, a_lead, a_lead_tau):
@@ -390,9 +386,8 @@ class LongitudinalMpc:
     self.yref[:,2] = v
     self.yref[:,3] = a
     self.yref[:,5] = j
-    for i in range(N):
-      self.solver.set(i, "yref", self.yref[i])
-    self.solver.set(N, "yref", self.yref[N][:COST_E_DIM])
+    # the terminal stage only uses the first COST_E_DIM values of its yref row
+    self.solver.set_all("yref", self.yref)
 
     self.params[:,2] = np.min(x_obstacles, axis=1)
     self.params[:,3] = np.copy(self.prev_a)
@@ -417,8 +412,7 @@ class LongitudinalMpc:
   def run(self):
     # t0 = time.monotonic()
     # reset = 0
-    for i in range(N+1):
-      self.solver.set(i, 'p', self.params[i])
+    self.solver.set_all('p', self.params)
     self.solver.constraints_set(0, "lbx", self.x0)
     self.solver.constraints_set(0, "ubx", self.x0)
 
@@ -435,10 +429,8 @@ class LongitudinalMpc:
     # print(f"long_mpc residuals: {res[0]:.2e}, {res[1]:.2e}, {res[2]:.2e}, {res[3]:.2e}")
     # self.solver.print_statistics()
 
-    for i in range(N+1):
-      self.x_sol[i] = self.solver.get(i, 'x')
-    for i in range(N):
-      self.u_sol[i] = self.solver.get(i, 'u')
+    self.solver.get_all('x', self.x_sol)
+    self.solver.get_all('u', self.u_sol)
 
     self.v_solution = self.x_sol[:,1]
     self.a_solution = self.x_sol[:,2]
@@ -0,0 +1,125 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import NamedTuple
+
+from cereal import log
+from opendbc.car.interfaces import ACCEL_MIN, ACCEL_MAX
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import LongitudinalMpc, N, X_DIM, U_DIM, SOURCES
+
+LEAD_DIM = 4  # dRel, vLead, aLeadK, aLeadTau
+
+
+class Lead(NamedTuple):
+  status: bool
+  dRel: float
+  vLead: float
+  aLeadK: float
+  aLeadTau: float
+  modelProb: float = 1.0
+
+
+class RadarState(NamedTuple):
+  leadOne: Lead
+  leadTwo: Lead
+
+
+class BatchSolution(NamedTuple):
+  x_sol: np.ndarray  # (B, N+1, X_DIM)
+  u_sol: np.ndarray  # (B, N, U_DIM)
+  solution_status: np.ndarray  # (B,) status of the last solve
+  solve_time: np.ndarray  # (B,) acados time summed over all iterations
+  source: np.ndarray  # (B,) index into SOURCES
+
+
+def _broadcast_leads(leads, n):
+  if leads is None:
+    return np.full((n, LEAD_DIM), np.nan)
+  return np.broadcast_to(np.asarray(leads, dtype=np.float64), (n, LEAD_DIM))
+
+
+def _lead(row):
+  # rows with a nan dRel have no lead, process_lead fakes one
+  return Lead(not np.isnan(row[0]), *row)
+
+
+class _BatchMpc(LongitudinalMpc):
+  # run() resets the solver after a failed solve, which also clears solution_status, keep it here
+  def reset(self):
+    self.failed_status = getattr(self, 'solution_status', 0)
+    super().reset()
+
+
+def _solve_chunk(x0, v_cruise, lead_one, lead_two, personality, accel_limits, n_iter):
+  mpc = _BatchMpc()
+  n = len(x0)
+  x_sol = np.zeros((n, N+1, X_DIM))
+  u_sol = np.zeros((n, N, U_DIM))
+  solution_status = np.zeros(n, dtype=np.int32)
+  solve_time = np.zeros(n)
+  source = np.zeros(n, dtype=np.int32)
+
+  # model trajectories, unused in acc mode
+  x, v, a, j = (np.zeros(N+1) for _ in range(4))
+  for i in range(n):
+    mpc.reset()
+    mpc.failed_status = 0
+    mpc.set_weights(personality=int(personality[i]))
+    mpc.x0[:] = x0[i]
+    mpc.solver.set_all('x', np.tile(mpc.x0, (N+1, 1)))
+    mpc.set_accel_limits(*accel_limits[i])
+
+    radarstate = RadarState(_lead(lead_one[i]), _lead(lead_two[i]))
+    mpc.update(radarstate, v_cruise[i], x, v, a, j, personality=int(personality[i]))
+    solve_time[i] = mpc.solve_time
+    # SQP_RTI does one iteration per solve, keep iterating on the same parameters
+    for _ in range(n_iter - 1):
+      if mpc.failed_status != 0:
+        break
+      mpc.run()
+      solve_time[i] += mpc.solve_time
+
+    solution_status[i] = mpc.failed_status
+    if mpc.failed_status == 0:
+      x_sol[i] = mpc.x_sol
+      u_sol[i] = mpc.u_sol
+    source[i] = SOURCES.index(mpc.source)
+  return x_sol, u_sol, solution_status, solve_time, source
+
+
+def solve_batch(x0, v_cruise, lead_one=None, lead_two=None, personality=log.LongitudinalPersonality.standard,
+                accel_limits=(ACCEL_MIN, ACCEL_MAX), n_iter=10, workers=None, processes=False):
+  """
+  Solves the acc mode LongitudinalMpc for B independent scenarios, each from a reset solver.
+
+  x0: (B, X_DIM) initial ego state, v_cruise: (B,)
+  lead_one, lead_two: (B, 4) of dRel, vLead, aLeadK, aLeadTau, extrapolated like radarState leads.
+                      None or a nan dRel means no lead.
+  personality: (B,), accel_limits: (B, 2) of min and max accel, scalars are broadcast
+
+  Each worker owns one solver and solves a contiguous chunk of the batch. The GIL is released
+  during the solve, so threads scale; processes also avoid the python overhead around it.
+  Scenarios that fail to solve have a non zero solution_status and zeroed solutions.
+  """
+  x0 = np.atleast_2d(np.asarray(x0, dtype=np.float64))
+  n = len(x0)
+  v_cruise = np.broadcast_to(np.asarray(v_cruise, dtype=np.float64), (n,))
+  lead_one = _broadcast_leads(lead_one, n)
+  lead_two = _broadcast_leads(lead_two, n)
+  personality = np.broadcast_to(np.asarray(personality, dtype=np.int32), (n,))
+  accel_limits = np.broadcast_to(np.asarray(accel_limits, dtype=np.float64), (n, 2))
+
+  workers = max(1, min(workers or os.cpu_count() or 1, n))
+  chunks = [idxs for idxs in np.array_split(np.arange(n), workers) if len(idxs)]
+  args = [(x0[c], v_cruise[c], lead_one[c], lead_two[c], personality[c], accel_limits[c], n_iter) for c in chunks]
+  if len(args) <= 1:
+    results = [_solve_chunk(*a) for a in args]
+  else:
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=len(args)) as executor:
+      results = list(executor.map(_solve_chunk, *zip(*args, strict=True)))
+
+  if not results:
+    return BatchSolution(np.zeros((0, N+1, X_DIM)), np.zeros((0, N, U_DIM)), np.zeros(0, dtype=np.int32),
+                         np.zeros(0), np.zeros(0, dtype=np.int32))
+  return BatchSolution(*(np.concatenate(r) for r in zip(*results, strict=True)))
@@ -3,6 +3,7 @@ import numpy as np
 from openpilot.selfdrive.controls.lib.lateral_mpc_lib.lat_mpc import LateralMpc
 from openpilot.selfdrive.controls.lib.drive_helpers import CAR_ROTATION_RADIUS
 from openpilot.selfdrive.controls.lib.lateral_mpc_lib.lat_mpc import N as LAT_MPC_N
+from openpilot.selfdrive.controls.lib.lateral_mpc_lib.lat_mpc import COST_DIM, COST_E_DIM, X_DIM
 
 
 def run_mpc(lat_mpc=None, v_ref=30., x_init=0., y_init=0., psi_init=0., curvature_init=0.,
@@ -83,3 +84,62 @@ class TestLateralMpc:
     sol = run_mpc(lat_mpc=lat_mpc, poly_shift=-3.0, v_ref=7.0)
     left_psi_deg = np.degrees(sol[:,2])
     np.testing.assert_almost_equal(right_psi_deg, -left_psi_deg, decimal=3)
+
+  def test_bulk_interface(self):
+    # set_all/get_all match per stage set/get
+    rng = np.random.default_rng(0)
+    solver = LateralMpc().solver
+    x, u = rng.normal(size=(LAT_MPC_N + 1, X_DIM)), rng.normal(size=(LAT_MPC_N, 1))
+    solver.set_all('x', x)
+    solver.set_all('u', u)
+    for i in range(LAT_MPC_N + 1):
+      np.testing.assert_array_equal(solver.get(i, 'x'), x[i])
+    for i in range(LAT_MPC_N):
+      np.testing.assert_array_equal(solver.get(i, 'u'), u[i])
+    assert solver.get(LAT_MPC_N, 'u').shape == (0,)
+
+    for i in range(LAT_MPC_N + 1):
+      solver.set(i, 'x', -x[i])
+    for i in range(LAT_MPC_N):
+      solver.set(i, 'u', -u[i])
+    np.testing.assert_array_equal(solver.get_all('x'), -x)
+    out = np.zeros((LAT_MPC_N, 1))
+    assert solver.get_all('u', out) is out
+    np.testing.assert_array_equal(out, -u)
+
+    # shapes set() rejects are rejected too, u has no terminal stage
+    with pytest.raises(Exception, match="no columns"):
+      solver.set_all('x', np.zeros((LAT_MPC_N + 1, 0)))
+    with pytest.raises(Exception, match="mismatching dimension"):
+      solver.set_all('x', np.zeros((LAT_MPC_N + 1, X_DIM + 1)))
+    with pytest.raises(Exception, match="mismatching dimension"):
+      solver.set_all('u', np.zeros((LAT_MPC_N + 1, 1)))
+    with pytest.raises(Exception, match="mismatching dimension"):
+      solver.set_all('yref', np.zeros((LAT_MPC_N + 1, COST_DIM + 1)))
+
+  def test_bulk_yref(self):
+    # the terminal yref row is wider than the terminal cost, only its leading values are used
+    rng = np.random.default_rng(0)
+    yref = rng.normal(size=(LAT_MPC_N + 1, COST_DIM))
+    p = np.column_stack([rng.uniform(5., 30., LAT_MPC_N + 1), CAR_ROTATION_RADIUS * np.ones(LAT_MPC_N + 1)])
+    x0 = np.array([0., 0.5, 0., 0.])
+
+    sols = []
+    for bulk in (True, False):
+      lat_mpc = LateralMpc()
+      lat_mpc.set_weights(1., .1, 0.0, .05, 800)
+      solver = lat_mpc.solver
+      if bulk:
+        solver.set_all('yref', yref)
+        solver.set_all('p', p)
+      else:
+        for i in range(LAT_MPC_N):
+          solver.set(i, 'yref', yref[i])
+        solver.set(LAT_MPC_N, 'yref', yref[LAT_MPC_N, :COST_E_DIM])
+        for i in range(LAT_MPC_N + 1):
+          solver.set(i, 'p', p[i])
+      solver.constraints_set(0, "lbx", x0)
+      solver.constraints_set(0, "ubx", x0)
+      solver.solve()
+      sols.append(np.array([solver.get(i, 'x') for i in range(LAT_MPC_N + 1)]))
+    np.testing.assert_array_equal(sols[0], sols[1])
@@ -0,0 +1,51 @@
+import numpy as np
+
+from cereal import log
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import N, SOURCES
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc_batch import solve_batch
+
+
+class TestLongMpcBatch:
+  def setup_method(self):
+    rng = np.random.default_rng(0)
+    self.n = 16
+    self.x0 = np.column_stack([np.zeros(self.n), rng.uniform(0, 30, self.n), np.zeros(self.n)])
+    self.v_cruise = rng.uniform(10, 35, self.n)
+    self.lead_one = np.column_stack([rng.uniform(5, 100, self.n), rng.uniform(0, 30, self.n),
+                                     np.zeros(self.n), np.full(self.n, 1.5)])
+    # half the scenarios without a lead
+    self.lead_one[::2, 0] = np.nan
+    self.personality = rng.choice([log.LongitudinalPersonality.relaxed,
+                                   log.LongitudinalPersonality.standard,
+                                   log.LongitudinalPersonality.aggressive], self.n)
+
+  def test_shapes(self):
+    sol = solve_batch(self.x0, self.v_cruise, self.lead_one, personality=self.personality, workers=4)
+    assert sol.x_sol.shape == (self.n, N+1, 3)
+    assert sol.u_sol.shape == (self.n, N, 1)
+    assert np.all(sol.solution_status == 0)
+    assert np.all(sol.solve_time > 0)
+    np.testing.assert_allclose(sol.x_sol[:, 0], self.x0)
+    # without a lead only cruise can be the limiting source
+    assert np.all(sol.source[::2] == SOURCES.index('cruise'))
+
+  def test_independent_of_workers(self):
+    single = solve_batch(self.x0, self.v_cruise, self.lead_one, personality=self.personality, workers=1)
+    for kwargs in ({'workers': 3}, {'workers': 4, 'processes': True}):
+      sol = solve_batch(self.x0, self.v_cruise, self.lead_one, personality=self.personality, **kwargs)
+      np.testing.assert_allclose(sol.x_sol, single.x_sol)
+      np.testing.assert_allclose(sol.u_sol, single.u_sol)
+      np.testing.assert_array_equal(sol.source, single.source)
+
+  def test_failed_solve(self):
+    x0 = self.x0.copy()
+    x0[3, 1] = np.nan
+    sol = solve_batch(x0, self.v_cruise, self.lead_one, personality=self.personality, workers=2)
+    assert sol.solution_status[3] != 0
+    assert not np.any(sol.x_sol[3]) and not np.any(sol.u_sol[3])
+    # the other scenarios of the chunk still solve
+    assert np.all(np.delete(sol.solution_status, 3) == 0)
+
+  def test_empty(self):
+    sol = solve_batch(np.zeros((0, 3)), [])
+    assert sol.x_sol.shape == (0, N+1, 3)
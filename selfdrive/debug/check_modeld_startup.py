@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from pathlib import Path
+
+import openpilot.selfdrive.modeld.runners.ort_helpers as ort_helpers
+from openpilot.selfdrive.modeld.runners.ort_helpers import make_onnx_cpu_runner
+
+MODELS_DIR = Path(__file__).parent.parent / 'modeld/models'
+MODELS = ['supercombo.onnx', 'dmonitoring_model.onnx']
+N_RUNS = int(os.getenv("N", "5"))
+
+
+def timed(f):
+  start_t = time.monotonic()
+  f()
+  return time.monotonic() - start_t
+
+
+if __name__ == '__main__':
+  # time to a ready session, as modeld and dmonitoringmodeld do it on PC
+  ort_helpers.ORT_CACHE_DIR = Path(tempfile.mkdtemp())
+  try:
+    for model in MODELS:
+      model_path = MODELS_DIR / model
+      uncached = [timed(lambda: make_onnx_cpu_runner(model_path, use_cache=False)) for _ in range(N_RUNS)]
+      cold = []
+      for _ in range(N_RUNS):
+        shutil.rmtree(ort_helpers.ORT_CACHE_DIR, ignore_errors=True)
+        cold.append(timed(lambda: make_onnx_cpu_runner(model_path)))
+      warm = [timed(lambda: make_onnx_cpu_runner(model_path)) for _ in range(N_RUNS)]
+
+      print(f'{model}:')
+      for name, ts in [('uncached', uncached), ('cold cache', cold), ('warm cache', warm)]:
+        print(f'  {name}: {np.mean(ts):.3f} mean s, {min(ts):.3f} min s')
+  finally:
+    shutil.rmtree(ort_helpers.ORT_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import numpy as np
+import time
+
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import LongitudinalMpc, N, COST_E_DIM
+
+N_RUNS = 10000
+
+
+def per_stage(mpc):
+  for i in range(N):
+    mpc.solver.set(i, "yref", mpc.yref[i])
+  mpc.solver.set(N, "yref", mpc.yref[N][:COST_E_DIM])
+  for i in range(N+1):
+    mpc.solver.set(i, 'p', mpc.params[i])
+  for i in range(N+1):
+    mpc.x_sol[i] = mpc.solver.get(i, 'x')
+  for i in range(N):
+    mpc.u_sol[i] = mpc.solver.get(i, 'u')
+
+
+def bulk(mpc):
+  mpc.solver.set_all("yref", mpc.yref)
+  mpc.solver.set_all('p', mpc.params)
+  mpc.solver.get_all('x', mpc.x_sol)
+  mpc.solver.get_all('u', mpc.u_sol)
+
+
+if __name__ == '__main__':
+  # the python to cython calls done by LongitudinalMpc every cycle, without the solve
+  mpc = LongitudinalMpc()
+  for name, f in [('per stage', per_stage), ('bulk', bulk)]:
+    ets = []
+    for _ in range(N_RUNS):
+      start_t = time.process_time_ns()
+      f(mpc)
+      ets.append((time.process_time_ns() - start_t) * 1e-3)
+    print(f'{name}: {np.mean(ets):.2f} mean us, {np.percentile(ets, 99):.2f} p99 us, {min(ets):.2f} min us per cycle')
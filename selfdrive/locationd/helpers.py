@@ -14,19 +14,64 @@ def rotate_std(rot_matrix, std_in):
 
 
 class NPQueue:
+  """ Fixed size FIFO of rows. Every row is written twice in a buffer of twice maxlen, so the queue is always a contiguous view """
   def __init__(self, maxlen: int, rowsize: int) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((2 * maxlen, rowsize))
+    self.start = 0
+    self.size = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
-
-  def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    return self.size
+
+  @property
+  def arr(self) -> np.ndarray:
+    return self.buf[self.start:self.start + self.size]
+
+  def append(self, pt: list[float]) -> np.ndarray | None:
+    """ Appends pt, returns the row it pushed out when full """
+    dropped = None
+    if self.size < self.maxlen:
+      idx = self.size
+      self.size += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      idx = self.start
+      dropped = self.buf[idx].copy()
+      self.start = (self.start + 1) % self.maxlen
+    self.buf[idx] = pt
+    self.buf[idx + self.maxlen] = pt
+    return dropped
+
+
+class TimeSeries:
+  """ Fixed size history of samples with named fields, indexed by monotonic timestamps """
+  def __init__(self, maxlen: int, fields: list[str]) -> None:
+    self.fields = {field: i + 1 for i, field in enumerate(fields)}
+    self.queue = NPQueue(maxlen=maxlen, rowsize=len(fields) + 1)
+
+  def __len__(self) -> int:
+    return len(self.queue)
+
+  def append(self, t: float, *values: float) -> None:
+    self.queue.append([t, *values])
+
+  @property
+  def t(self) -> np.ndarray:
+    return self.queue.arr[:, 0]
+
+  def get(self, field: str) -> np.ndarray:
+    return self.queue.arr[:, self.fields[field]]
+
+  def interp(self, t: float | np.ndarray, field: str) -> np.ndarray:
+    """ Linear interpolation of field at t, which can be an array of any shape """
+    arr = self.queue.arr
+    return np.interp(t, arr[:, 0], arr[:, self.fields[field]])
+
+  def between(self, t_start: float, t_end: float) -> np.ndarray:
+    """ Rows with t_start <= t < t_end, as a view """
+    arr = self.queue.arr
+    start, end = np.searchsorted(arr[:, 0], [t_start, t_end])
+    return arr[start:end]
 
 
 class PointBuckets:
@@ -35,6 +80,8 @@ class PointBuckets:
     self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize) for bounds in x_bounds}
     self.buckets_min_points = dict(zip(x_bounds, min_points, strict=True))
     self.min_points_total = min_points_total
+    # sum of the outer products of the points in each bucket, i.e. points.T @ points
+    self.grams = {bounds: np.zeros((rowsize, rowsize)) for bounds in x_bounds}
 
   def __len__(self) -> int:
     return sum([len(v) for v in self.buckets.values()])
@@ -50,6 +97,22 @@ class PointBuckets:
   def add_point(self, x: float, y: float) -> None:
     raise NotImplementedError
 
+  def append(self, bounds: tuple[float, float], pt: list[float]) -> None:
+    bucket = self.buckets[bounds]
+    dropped = bucket.append(pt)
+    pt = bucket.buf[bucket.start + bucket.size - 1]
+    if dropped is not None and bucket.start == 0:
+      # recompute once per lap of the buffer, so rounding errors don't accumulate
+      self.grams[bounds] = bucket.arr.T @ bucket.arr
+    elif dropped is None:
+      self.grams[bounds] += pt[:, None] * pt
+    else:
+      self.grams[bounds] += pt[:, None] * pt - dropped[:, None] * dropped
+
+  def get_gram(self) -> np.ndarray:
+    """ points.T @ points over all buckets, without stacking the points """
+    return sum(self.grams.values())
+
   def get_points(self, num_points: int = None) -> Any:
     points = np.vstack([x.arr for x in self.buckets.values()])
     if num_points is None:
@@ -0,0 +1,62 @@
+import numpy as np
+
+from openpilot.selfdrive.locationd.helpers import NPQueue, PointBuckets, TimeSeries
+
+
+class Buckets(PointBuckets):
+  def add_point(self, x, y):
+    for bounds in self.x_bounds:
+      if bounds[0] <= x < bounds[1]:
+        self.append(bounds, [x, 1.0, y])
+        break
+
+
+class TestNPQueue:
+  def test_order(self):
+    q = NPQueue(maxlen=5, rowsize=2)
+    rows = []
+    # several laps of the buffer
+    for i in range(23):
+      dropped = q.append([i, -i])
+      if len(rows) == 5:
+        np.testing.assert_array_equal(dropped, rows.pop(0))
+      else:
+        assert dropped is None
+      rows.append([i, -i])
+      assert len(q) == len(rows)
+      np.testing.assert_array_equal(q.arr, rows)
+      assert q.arr.flags.c_contiguous
+
+
+class TestTimeSeries:
+  def test_queries(self):
+    ts = TimeSeries(maxlen=10, fields=["a", "b"])
+    for i in range(25):
+      ts.append(0.5 * i, i, -i)
+    assert len(ts) == 10
+    np.testing.assert_array_equal(ts.t, 0.5 * np.arange(15, 25))
+    np.testing.assert_array_equal(ts.get("b"), -np.arange(15, 25))
+
+    # any shape, clamped to the ends like np.interp
+    t = np.array([[7.75, 10.], [0., 20.]])
+    np.testing.assert_allclose(ts.interp(t, "a"), [[15.5, 20.], [15., 24.]])
+    assert ts.interp(10.25, "b") == -20.5
+
+    # t_end is exclusive
+    rows = ts.between(8.5, 10.)
+    np.testing.assert_array_equal(rows[:, 1], [17, 18, 19])
+    assert rows.base is not None
+    assert len(ts.between(13., 14.)) == 0
+
+
+class TestPointBuckets:
+  def test_gram(self):
+    rng = np.random.default_rng(0)
+    buckets = Buckets(x_bounds=[(-1., 0.), (0., 1.)], min_points=[0, 0], min_points_total=0, points_per_bucket=50, rowsize=3)
+    # enough points for each bucket to wrap several times
+    for _ in range(17):
+      for x, y in rng.uniform(-1, 1, size=(23, 2)):
+        buckets.add_point(x, y)
+      points = buckets.get_points()
+      np.testing.assert_allclose(buckets.get_gram(), points.T @ points, rtol=1e-9, atol=1e-9)
+    assert all(len(b) == 50 for b in buckets.buckets.values())
@@ -95,7 +95,7 @@ class TestLocationdScenarios:
 
   @classmethod
   def setup_class(cls):
-    cls.logs = migrate_all(LogReader(TEST_ROUTE))
+    cls.logs = migrate_all(LogReader(TEST_ROUTE), cache_key=TEST_ROUTE)
 
   def test_base(self):
     """
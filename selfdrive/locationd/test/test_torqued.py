@@ -0,0 +1,99 @@
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+
+from cereal import car
+from openpilot.common.realtime import DT_MDL
+from openpilot.selfdrive.controls.lib.vehicle_model import ACCELERATION_DUE_TO_GRAVITY
+from openpilot.selfdrive.locationd.torqued import MIN_VEL, STEER_MIN_THRESHOLD, TorqueEstimator
+
+
+class DequeHistory:
+  """ torqued's history before TimeSeries: a deque per field """
+  def __init__(self, est):
+    self.est = est
+    self.raw = {k: deque(maxlen=est.hist_len) for k in ("cc_t", "lat_active", "co_t", "steer", "cs_t", "vego", "override")}
+
+  def append(self, which, t, *values):
+    t += self.est.lag
+    if which == "carControl":
+      keys = ("cc_t", "lat_active")
+    elif which == "carOutput":
+      keys = ("co_t", "steer")
+    else:
+      keys = ("cs_t", "vego", "override")
+    for k, v in zip(keys, (t, *values), strict=True):
+      self.raw[k].append(v)
+
+  def get_torque_points(self, t, yaw_rate, roll):
+    window = t + self.est.engage_window
+    lat_active = np.interp(window, self.raw["cc_t"], self.raw["lat_active"]).astype(bool)
+    steer_override = np.interp(window, self.raw["cs_t"], self.raw["override"]).astype(bool)
+    vego = np.interp(t, self.raw["cs_t"], self.raw["vego"])
+    steer = np.interp(t, self.raw["co_t"], self.raw["steer"])
+    lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY)
+    valid = all(lat_active) and not any(steer_override) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD)
+    return steer, lateral_acc, valid
+
+
+class TestTorqued:
+  def test_engage_window(self):
+    for delay in (0., 0.12, 0.3):
+      CP = car.CarParams.new_message(steerActuatorDelay=delay)
+      est = TorqueEstimator(CP)
+      # up to and including now, whatever the rounding of the lag
+      assert np.isclose(est.engage_window[-1], np.floor((est.lag + 1e-6) / DT_MDL) * DT_MDL)
+      assert np.allclose(np.diff(est.engage_window), DT_MDL)
+
+  def test_matches_deque_history(self):
+    rng = np.random.default_rng(0)
+    est = TorqueEstimator(car.CarParams.new_message())
+    ref = DequeHistory(est)
+
+    lat_active = steer_override = False
+    checked = valid_points = 0
+    # 20k frames, inputs every frame with some jitter, a livePose on every other frame
+    for i in range(20000):
+      t = i * DT_MDL + rng.uniform(0, 0.002)
+      if rng.random() < 0.01:
+        lat_active = not lat_active
+      steer_override = rng.random() < 0.002
+      vego = 20. + 10. * np.sin(i / 500.)
+
+      for which, values in (("carControl", (lat_active,)),
+                            ("carOutput", (rng.uniform(-0.5, 0.5),)),
+                            ("carState", (vego, steer_override))):
+        ref.append(which, t, *values)
+        if which == "carControl":
+          msg = SimpleNamespace(latActive=values[0])
+        elif which == "carOutput":
+          msg = SimpleNamespace(actuatorsOutput=SimpleNamespace(steer=-values[0]))
+        else:
+          msg = SimpleNamespace(vEgo=values[0], steeringPressed=values[1])
+        est.handle_log(t, which, msg)
+
+      if i % 2 == 0 and len(est.raw_points["carOutput"]) == est.hist_len:
+        t_pose = t + 0.001
+        yaw_rate, roll = rng.uniform(-0.1, 0.1, size=2)
+        steer, lateral_acc, valid = est.get_torque_points(t_pose, yaw_rate, roll)
+        ref_steer, ref_lateral_acc, ref_valid = ref.get_torque_points(t_pose, yaw_rate, roll)
+        assert valid[0] == ref_valid
+        assert steer[0] == ref_steer
+        assert np.isclose(lateral_acc[0], ref_lateral_acc)
+        checked += 1
+        valid_points += ref_valid
+
+      # a batch over past livePose times matches one call per time
+      if i % 1000 == 999:
+        ts = t - rng.uniform(0, 2, size=50)
+        yaw_rates, rolls = rng.uniform(-0.1, 0.1, size=(2, 50))
+        steer, lateral_acc, valid = est.get_torque_points(ts, yaw_rates, rolls)
+        for j in range(50):
+          ref_steer, ref_lateral_acc, ref_valid = ref.get_torque_points(ts[j], yaw_rates[j], rolls[j])
+          assert valid[j] == ref_valid
+          assert steer[j] == ref_steer
+          assert np.isclose(lateral_acc[j], ref_lateral_acc)
+
+    assert checked > 9000
+    assert 0 < valid_points < checked
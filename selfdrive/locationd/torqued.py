@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import numpy as np
-from collections import deque, defaultdict
 
 import cereal.messaging as messaging
 from cereal import car, log
@@ -9,14 +8,12 @@ from openpilot.common.realtime import config_realtime_process, DT_MDL
 from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.swaglog import cloudlog
 from openpilot.selfdrive.controls.lib.vehicle_model import ACCELERATION_DUE_TO_GRAVITY
-from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator, PoseCalibrator, Pose
+from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator, PoseCalibrator, Pose, TimeSeries
 
 HISTORY = 5  # secs
 POINTS_PER_BUCKET = 1500
 MIN_POINTS_TOTAL = 4000
 MIN_POINTS_TOTAL_QLOG = 600
-FIT_POINTS_TOTAL = 2000
-FIT_POINTS_TOTAL_QLOG = 600
 MIN_VEL = 15  # m/s
 FRICTION_FACTOR = 1.5  # ~85% of data coverage
 FACTOR_SANITY = 0.3
@@ -45,7 +42,7 @@ class TorqueBuckets(PointBuckets):
   def add_point(self, x, y):
     for bound_min, bound_max in self.x_bounds:
       if (x >= bound_min) and (x < bound_max):
-        self.buckets[(bound_min, bound_max)].append([x, 1.0, y])
+        self.append((bound_min, bound_max), [x, 1.0, y])
         break
 
 
@@ -53,18 +50,18 @@ class TorqueEstimator(ParameterEstimator):
   def __init__(self, CP, decimated=False, track_all_points=False):
     self.hist_len = int(HISTORY / DT_MDL)
     self.lag = CP.steerActuatorDelay + .2  # from controlsd
+    # up to and including now, which np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL) only got depending on rounding
+    self.engage_window = -MIN_ENGAGE_BUFFER + np.arange(int((MIN_ENGAGE_BUFFER + self.lag) / DT_MDL + 1e-6) + 1) * DT_MDL
     self.track_all_points = track_all_points  # for offline analysis, without max lateral accel or max steer torque filters
     if decimated:
       self.min_bucket_points = MIN_BUCKET_POINTS / 10
       self.min_points_total = MIN_POINTS_TOTAL_QLOG
-      self.fit_points = FIT_POINTS_TOTAL_QLOG
       self.factor_sanity = FACTOR_SANITY_QLOG
       self.friction_sanity = FRICTION_SANITY_QLOG
 
     else:
       self.min_bucket_points = MIN_BUCKET_POINTS
       self.min_points_total = MIN_POINTS_TOTAL
-      self.fit_points = FIT_POINTS_TOTAL
       self.factor_sanity = FACTOR_SANITY
       self.friction_sanity = FRICTION_SANITY
 
@@ -133,7 +130,11 @@ class TorqueEstimator(ParameterEstimator):
   def reset(self):
     self.resets += 1.0
     self.decay = MIN_FILTER_DECAY
-    self.raw_points = defaultdict(lambda: deque(maxlen=self.hist_len))
+    self.raw_points = {
+      'carControl': TimeSeries(self.hist_len, ['lat_active']),
+      'carOutput': TimeSeries(self.hist_len, ['steer_torque']),
+      'carState': TimeSeries(self.hist_len, ['vego', 'steer_override']),
+    }
     self.filtered_points = TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS,
                                          min_points=self.min_bucket_points,
                                          min_points_total=self.min_points_total,
@@ -142,14 +143,19 @@ class TorqueEstimator(ParameterEstimator):
     self.all_torque_points = []
 
   def estimate_params(self):
-    points = self.filtered_points.get_points(self.fit_points)
     # total least square solution as both x and y are noisy observations
     # this is empirically the slope of the hysteresis parallelogram as opposed to the line through the diagonals
+    # points are [x, 1, y], the fit only needs points.T @ points which the buckets keep up to date
+    gram = self.filtered_points.get_gram()
     try:
-      _, _, v = np.linalg.svd(points, full_matrices=False)
-      slope, offset = -v.T[0:2, 2] / v.T[2, 2]
-      _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
-      friction_coeff = np.std(spread) * FRICTION_FACTOR
+      # the eigenvector of the smallest eigenvalue of points.T @ points is the last right singular vector of points
+      _, v = np.linalg.eigh(gram)
+      slope, offset = -v[0:2, 0] / v[2, 0]
+      n = gram[1, 1]
+      mean = gram[[0, 2], 1] / n
+      cov = gram[np.ix_([0, 2], [0, 2])] / n - np.outer(mean, mean)
+      spread_axis = slope2rot(slope)[:, 1]
+      friction_coeff = np.sqrt(max(spread_axis @ cov @ spread_axis, 0.)) * FRICTION_FACTOR
     except np.linalg.LinAlgError as e:
       cloudlog.exception(f"Error computing live torque params: {e}")
       slope = offset = friction_coeff = np.nan
@@ -161,39 +167,45 @@ class TorqueEstimator(ParameterEstimator):
       self.filtered_params[param].update(value)
       self.filtered_params[param].update_alpha(self.decay)
 
+  def get_torque_points(self, t, yaw_rate, roll):
+    """
+    Steer torque and lateral accel at times t, and whether the points are usable.
+    Vectorized over t, so offline analysis can process whole routes at once.
+    """
+    t = np.atleast_1d(t)
+    # check lat active up to now (without lag compensation)
+    engage_window = t[:, None] + self.engage_window
+    lat_active = self.raw_points['carControl'].interp(engage_window, 'lat_active').astype(bool).all(axis=1)
+    steer_override = self.raw_points['carState'].interp(engage_window, 'steer_override').astype(bool).any(axis=1)
+    vego = self.raw_points['carState'].interp(t, 'vego')
+    steer = self.raw_points['carOutput'].interp(t, 'steer_torque')
+    lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY)
+    valid = lat_active & ~steer_override & (vego > MIN_VEL) & (np.abs(steer) > STEER_MIN_THRESHOLD)
+    return steer, lateral_acc, valid
+
   def handle_log(self, t, which, msg):
     if which == "carControl":
-      self.raw_points["carControl_t"].append(t + self.lag)
-      self.raw_points["lat_active"].append(msg.latActive)
+      self.raw_points["carControl"].append(t + self.lag, msg.latActive)
     elif which == "carOutput":
-      self.raw_points["carOutput_t"].append(t + self.lag)
-      self.raw_points["steer_torque"].append(-msg.actuatorsOutput.steer)
+      self.raw_points["carOutput"].append(t + self.lag, -msg.actuatorsOutput.steer)
     elif which == "carState":
-      self.raw_points["carState_t"].append(t + self.lag)
       # TODO: check if high aEgo affects resulting lateral accel
-      self.raw_points["vego"].append(msg.vEgo)
-      self.raw_points["steer_override"].append(msg.steeringPressed)
+      self.raw_points["carState"].append(t + self.lag, msg.vEgo, msg.steeringPressed)
     elif which == "liveCalibration":
       self.calibrator.feed_live_calib(msg)
 
     # calculate lateral accel from past steering torque
     elif which == "livePose":
-      if len(self.raw_points['steer_torque']) == self.hist_len:
+      if len(self.raw_points['carOutput']) == self.hist_len:
         device_pose = Pose.from_live_pose(msg)
         calibrated_pose = self.calibrator.build_calibrated_pose(device_pose)
         angular_velocity_calibrated = calibrated_pose.angular_velocity
 
         yaw_rate = angular_velocity_calibrated.yaw
         roll = device_pose.orientation.roll
-        # check lat active up to now (without lag compensation)
-        lat_active = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                               self.raw_points['carControl_t'], self.raw_points['lat_active']).astype(bool)
-        steer_override = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                                   self.raw_points['carState_t'], self.raw_points['steer_override']).astype(bool)
-        vego = np.interp(t, self.raw_points['carState_t'], self.raw_points['vego'])
-        steer = np.interp(t, self.raw_points['carOutput_t'], self.raw_points['steer_torque']).item()
-        lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY).item()
-        if all(lat_active) and not any(steer_override) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD):
+        steer, lateral_acc, valid = self.get_torque_points(t, yaw_rate, roll)
+        if valid[0]:
+          steer, lateral_acc = float(steer[0]), float(lateral_acc[0])
           if abs(lateral_acc) <= LAT_ACC_THRESHOLD:
             self.filtered_points.add_point(steer, lateral_acc)
 
@@ -41,6 +41,9 @@ MODEL_PATH = Path(__file__).parent / 'models/supercombo.onnx'
 MODEL_PKL_PATH = Path(__file__).parent / 'models/supercombo_tinygrad.pkl'
 METADATA_PATH = Path(__file__).parent / 'models/supercombo_metadata.pkl'
 
+# the features buffer holds every 4th hidden state, ending 4 frames back
+FEATURE_IDXS = np.arange(-4,-100,-4)[::-1]
+
 class FrameMeta:
   frame_id: int = 0
   timestamp_sof: int = 0
@@ -56,7 +59,7 @@ class ModelState:
   output: np.ndarray
   prev_desire: np.ndarray  # for tracking the rising edge of the pulse
 
-  def __init__(self, context: CLContext):
+  def __init__(self, context: CLContext, intra_op_num_threads: int | None = None):
     self.frames = {'input_imgs': DrivingModelFrame(context), 'big_input_imgs': DrivingModelFrame(context)}
     self.prev_desire = np.zeros(ModelConstants.DESIRE_LEN, dtype=np.float32)
     self.full_features_20Hz = np.zeros((ModelConstants.FULL_HISTORY_BUFFER_LEN, ModelConstants.FEATURE_LEN), dtype=np.float32)
@@ -83,7 +86,7 @@ class ModelState:
       with open(MODEL_PKL_PATH, "rb") as f:
         self.model_run = pickle.load(f)
     else:
-      self.onnx_cpu_runner = make_onnx_cpu_runner(MODEL_PATH)
+      self.onnx_cpu_runner = make_onnx_cpu_runner(MODEL_PATH, intra_op_num_threads=intra_op_num_threads)
 
   def slice_outputs(self, model_outputs: np.ndarray) -> dict[str, np.ndarray]:
     parsed_model_outputs = {k: model_outputs[np.newaxis, v] for k,v in self.output_slices.items()}
@@ -91,18 +94,17 @@ class ModelState:
       parsed_model_outputs['raw_pred'] = model_outputs.copy()
     return parsed_model_outputs
 
-  def run(self, buf: VisionBuf, wbuf: VisionBuf, transform: np.ndarray, transform_wide: np.ndarray,
-                inputs: dict[str, np.ndarray], prepare_only: bool) -> dict[str, np.ndarray] | None:
+  def update_desire(self, desire: np.ndarray) -> np.ndarray:
     # Model decides when action is completed, so desire input is just a pulse triggered on rising edge
-    inputs['desire'][0] = 0
-    new_desire = np.where(inputs['desire'] - self.prev_desire > .99, inputs['desire'], 0)
-    self.prev_desire[:] = inputs['desire']
+    desire[0] = 0
+    new_desire = np.where(desire - self.prev_desire > .99, desire, 0)
+    self.prev_desire[:] = desire
 
     self.desire_20Hz[:-1] = self.desire_20Hz[1:]
     self.desire_20Hz[-1] = new_desire
-    self.numpy_inputs['desire'][:] = self.desire_20Hz.reshape((1,25,4,-1)).max(axis=2)
+    return self.desire_20Hz.reshape((1,25,4,-1)).max(axis=2)
 
-    self.numpy_inputs['traffic_convention'][:] = inputs['traffic_convention']
+  def prepare_imgs(self, buf: VisionBuf, wbuf: VisionBuf, transform: np.ndarray, transform_wide: np.ndarray) -> None:
     imgs_cl = {'input_imgs': self.frames['input_imgs'].prepare(buf, transform.flatten()),
                'big_input_imgs': self.frames['big_input_imgs'].prepare(wbuf, transform_wide.flatten())}
 
@@ -115,6 +117,17 @@ class ModelState:
       for key in imgs_cl:
         self.numpy_inputs[key] = self.frames[key].buffer_from_cl(imgs_cl[key]).reshape(self.input_shapes[key])
 
+  def update_features(self, outputs: dict[str, np.ndarray]) -> None:
+    self.full_features_20Hz[:-1] = self.full_features_20Hz[1:]
+    self.full_features_20Hz[-1] = outputs['hidden_state'][0, :]
+    self.numpy_inputs['features_buffer'][:] = self.full_features_20Hz[FEATURE_IDXS]
+
+  def run(self, buf: VisionBuf, wbuf: VisionBuf, transform: np.ndarray, transform_wide: np.ndarray,
+                inputs: dict[str, np.ndarray], prepare_only: bool) -> dict[str, np.ndarray] | None:
+    self.numpy_inputs['desire'][:] = self.update_desire(inputs['desire'])
+    self.numpy_inputs['traffic_convention'][:] = inputs['traffic_convention']
+    self.prepare_imgs(buf, wbuf, transform, transform_wide)
+
     if prepare_only:
       return None
 
@@ -124,13 +137,32 @@ class ModelState:
       self.output = self.onnx_cpu_runner.run(None, self.numpy_inputs)[0].flatten()
 
     outputs = self.parser.parse_outputs(self.slice_outputs(self.output))
+    self.update_features(outputs)
+    return outputs
 
-    self.full_features_20Hz[:-1] = self.full_features_20Hz[1:]
-    self.full_features_20Hz[-1] = outputs['hidden_state'][0, :]
 
-    idxs = np.arange(-4,-100,-4)[::-1]
-    self.numpy_inputs['features_buffer'][:] = self.full_features_20Hz[idxs]
-    return outputs
+def build_model_msgs(model_output: dict[str, np.ndarray], DH: DesireHelper, car_state, lat_active: bool, v_ego: float, steer_delay: float,
+                     publish_state: PublishState, meta_main: FrameMeta, meta_extra: FrameMeta, frame_id: int, frame_drop_ratio: float,
+                     vipc_dropped_frames: int, model_execution_time: float, live_calib_seen: bool):
+  modelv2_send = messaging.new_message('modelV2')
+  drivingdata_send = messaging.new_message('drivingModelData')
+  posenet_send = messaging.new_message('cameraOdometry')
+  fill_model_msg(drivingdata_send, modelv2_send, model_output, v_ego, steer_delay,
+                 publish_state, meta_main.frame_id, meta_extra.frame_id, frame_id,
+                 frame_drop_ratio, meta_main.timestamp_eof, model_execution_time, live_calib_seen)
+
+  desire_state = modelv2_send.modelV2.meta.desireState
+  l_lane_change_prob = desire_state[log.Desire.laneChangeLeft]
+  r_lane_change_prob = desire_state[log.Desire.laneChangeRight]
+  lane_change_prob = l_lane_change_prob + r_lane_change_prob
+  DH.update(car_state, lat_active, lane_change_prob)
+  modelv2_send.modelV2.meta.laneChangeState = DH.lane_change_state
+  modelv2_send.modelV2.meta.laneChangeDirection = DH.lane_change_direction
+  drivingdata_send.drivingModelData.meta.laneChangeState = DH.lane_change_state
+  drivingdata_send.drivingModelData.meta.laneChangeDirection = DH.lane_change_direction
+
+  fill_pose_msg(posenet_send, model_output, meta_main.frame_id, vipc_dropped_frames, meta_main.timestamp_eof, live_calib_seen)
+  return modelv2_send, drivingdata_send, posenet_send
 
 
 def main(demo=False):
@@ -278,24 +310,10 @@ def main(demo=False):
     model_execution_time = mt2 - mt1
 
     if model_output is not None:
-      modelv2_send = messaging.new_message('modelV2')
-      drivingdata_send = messaging.new_message('drivingModelData')
-      posenet_send = messaging.new_message('cameraOdometry')
-      fill_model_msg(drivingdata_send, modelv2_send, model_output, v_ego, steer_delay,
-                     publish_state, meta_main.frame_id, meta_extra.frame_id, frame_id,
-                     frame_drop_ratio, meta_main.timestamp_eof, model_execution_time, live_calib_seen)
-
-      desire_state = modelv2_send.modelV2.meta.desireState
-      l_lane_change_prob = desire_state[log.Desire.laneChangeLeft]
-      r_lane_change_prob = desire_state[log.Desire.laneChangeRight]
-      lane_change_prob = l_lane_change_prob + r_lane_change_prob
-      DH.update(sm['carState'], sm['carControl'].latActive, lane_change_prob)
-      modelv2_send.modelV2.meta.laneChangeState = DH.lane_change_state
-      modelv2_send.modelV2.meta.laneChangeDirection = DH.lane_change_direction
-      drivingdata_send.drivingModelData.meta.laneChangeState = DH.lane_change_state
-      drivingdata_send.drivingModelData.meta.laneChangeDirection = DH.lane_change_direction
-
-      fill_pose_msg(posenet_send, model_output, meta_main.frame_id, vipc_dropped_frames, meta_main.timestamp_eof, live_calib_seen)
+      modelv2_send, drivingdata_send, posenet_send = build_model_msgs(model_output, DH, sm['carState'], sm['carControl'].latActive, v_ego,
+                                                                      steer_delay, publish_state, meta_main, meta_extra, frame_id,
+                                                                      frame_drop_ratio, vipc_dropped_frames, model_execution_time,
+                                                                      live_calib_seen)
       pm.send('modelV2', modelv2_send)
       pm.send('drivingModelData', drivingdata_send)
       pm.send('cameraOdometry', posenet_send)
@@ -1,10 +1,25 @@
+import os
+import json
+import hashlib
+import platform
+import tempfile
 import onnx
 import onnxruntime as ort
 import numpy as np
 import itertools
+from pathlib import Path
+
+from openpilot.system.hardware.hw import Paths
 
 ORT_TYPES_TO_NP_TYPES = {'tensor(float16)': np.float16, 'tensor(float)': np.float32, 'tensor(uint8)': np.uint8}
 
+# converted and optimized models
+ORT_CACHE_DIR = Path(Paths.model_cache_root())
+ORT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# bump when the conversion or the session options change
+ORT_CACHE_VERSION = 1
+DEFAULT_INTRA_OP_THREADS = 4
+
 def attributeproto_fp16_to_fp32(attr):
   float32_list = np.frombuffer(attr.raw_data, dtype=np.float16)
   attr.data_type = 1
@@ -27,10 +42,97 @@ def convert_fp16_to_fp32(model):
   return model.SerializeToString()
 
 
-def make_onnx_cpu_runner(model_path):
+def make_session_options(intra_op_num_threads=None):
   options = ort.SessionOptions()
-  options.intra_op_num_threads = 4
+  options.intra_op_num_threads = intra_op_num_threads or DEFAULT_INTRA_OP_THREADS
   options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
   options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-  model_data = convert_fp16_to_fp32(onnx.load(model_path))
-  return ort.InferenceSession(model_data,  options, providers=['CPUExecutionProvider'])
+  return options
+
+
+def get_artifact_metadata(model_data):
+  # optimized graphs can use hardware specific kernels and are tied to the ort version
+  return {
+    'source_sha256': hashlib.sha256(model_data).hexdigest(),
+    'onnxruntime': ort.__version__,
+    'machine': platform.machine(),
+    'cache_version': ORT_CACHE_VERSION,
+  }
+
+
+def get_artifact_paths(model_path, metadata):
+  key = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()[:16]
+  artifact = ORT_CACHE_DIR / f"{Path(model_path).stem}_{key}.ort"
+  return artifact, artifact.with_suffix('.json')
+
+
+def load_artifact(artifact, metadata_path, metadata):
+  """ The artifact's contents, if it's complete and has the hash its metadata recorded """
+  try:
+    stored = json.loads(metadata_path.read_text())
+    data = artifact.read_bytes()
+  except (OSError, ValueError):
+    return None
+  if stored != {**metadata, 'artifact_sha256': hashlib.sha256(data).hexdigest()}:
+    return None
+  # mtime is the last use for eviction
+  os.utime(artifact)
+  return data
+
+
+def evict_artifacts(keep):
+  """ Removes the least recently used artifacts past ORT_CACHE_MAX_BYTES """
+  artifacts = []
+  for artifact in ORT_CACHE_DIR.glob('*.ort'):
+    try:
+      st = artifact.stat()
+    except FileNotFoundError:
+      continue
+    artifacts.append((st.st_mtime, st.st_size, artifact))
+
+  total = 0
+  for _, size, artifact in sorted(artifacts, reverse=True):
+    total += size
+    if total > ORT_CACHE_MAX_BYTES and artifact != keep:
+      artifact.with_suffix('.json').unlink(missing_ok=True)
+      artifact.unlink(missing_ok=True)
+
+
+def make_onnx_cpu_runner(model_path, use_cache=True, intra_op_num_threads=None):
+  """
+  The fp16 to fp32 conversion and ort's graph optimizations take seconds, so the optimized model is saved
+  in the ORT format in a per-user cache, keyed on the source model's hash. The metadata file is written last,
+  with the artifact's hash, which is checked before loading. The least recently used artifacts are evicted
+  past ORT_CACHE_MAX_BYTES.
+  """
+  with open(model_path, 'rb') as f:
+    model_data = f.read()
+  metadata = get_artifact_metadata(model_data)
+  artifact, metadata_path = get_artifact_paths(model_path, metadata)
+
+  options = make_session_options(intra_op_num_threads)
+  if use_cache and (artifact_data := load_artifact(artifact, metadata_path, metadata)) is not None:
+    return ort.InferenceSession(artifact_data, options, providers=['CPUExecutionProvider'])
+
+  model_data = convert_fp16_to_fp32(onnx.load_from_string(model_data))
+  if not use_cache:
+    return ort.InferenceSession(model_data, options, providers=['CPUExecutionProvider'])
+
+  ORT_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=ORT_CACHE_DIR, suffix='.ort.tmp')
+  os.close(fd)
+  try:
+    options.optimized_model_filepath = tmp
+    options.add_session_config_entry('session.save_model_format', 'ORT')
+    session = ort.InferenceSession(model_data, options, providers=['CPUExecutionProvider'])
+    with open(tmp, 'rb') as f:
+      artifact_sha256 = hashlib.sha256(f.read()).hexdigest()
+    os.replace(tmp, artifact)
+    with open(tmp, 'w') as f:
+      json.dump({**metadata, 'artifact_sha256': artifact_sha256}, f)
+    os.replace(tmp, metadata_path)
+  finally:
+    if os.path.exists(tmp):
+      os.unlink(tmp)
+  evict_artifacts(keep=artifact)
+  return session
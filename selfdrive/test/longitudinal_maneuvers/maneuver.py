@@ -1,4 +1,8 @@
+import os
+import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
 from openpilot.selfdrive.test.longitudinal_maneuvers.plant import Plant
 
 
@@ -81,3 +85,31 @@ class Maneuver:
 
     print("maneuver end", valid)
     return valid, np.array(logs)
+
+
+def _evaluate(maneuver):
+  try:
+    return maneuver.evaluate()
+  except Exception as e:
+    return e
+
+
+def run_maneuvers(maneuvers, workers=None):
+  """
+  Evaluate maneuvers across at most workers processes, results are in the order of maneuvers.
+  A maneuver that raises gets its exception as result, so it doesn't abort the others.
+  Plants aren't paced, so this reports how many simulated seconds run per wall clock second.
+  """
+  workers = min(workers or os.cpu_count() or 1, len(maneuvers))
+  start = time.monotonic()
+  if workers <= 1:
+    results = [_evaluate(maneuver) for maneuver in maneuvers]
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      results = list(executor.map(_evaluate, maneuvers))
+  wall_time = time.monotonic() - start
+
+  sim_time = sum(maneuver.duration for maneuver in maneuvers)
+  print(f"{len(maneuvers)} maneuvers on {workers} workers, {sim_time:.0f} simulated seconds in {wall_time:.2f}s: " +
+        f"{sim_time / wall_time:.1f} simulated seconds per second")
+  return results
@@ -1,8 +1,9 @@
 import itertools
+import os
 from parameterized import parameterized_class
 
 from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import STOP_DISTANCE
-from openpilot.selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver
+from openpilot.selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver, run_maneuvers
 
 
 # TODO: make new FCW tests
@@ -187,8 +188,13 @@ class TestLongitudinalControl:
   force_decel: bool
 
   def test_maneuver(self, subtests):
-    for maneuver in create_maneuvers({"e2e": self.e2e, "force_decel": self.force_decel}):
+    maneuvers = create_maneuvers({"e2e": self.e2e, "force_decel": self.force_decel})
+    # share the cores with the other xdist workers
+    workers = (os.cpu_count() or 1) // int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", 1))
+    for maneuver, result in zip(maneuvers, run_maneuvers(maneuvers, workers=max(workers, 1)), strict=True):
       with subtests.test(title=maneuver.title, e2e=maneuver.e2e, force_decel=maneuver.force_decel):
         print(maneuver.title, f'in {"e2e" if maneuver.e2e else "acc"} mode')
-        valid, _ = maneuver.evaluate()
+        if isinstance(result, Exception):
+          raise result
+        valid, _ = result
         assert valid
@@ -1,45 +1,177 @@
 #!/usr/bin/env python3
 import sys
-import math
 import capnp
 import numbers
-import dictdiffer
+import itertools
+import numpy as np
 from collections import Counter
+from collections.abc import Iterable
 
 from openpilot.tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
 
+# marks an ignored field in the tree built by _ignore_tree
+IGNORED = object()
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
+# struct schema id -> (non-union field names, has union, is group)
+_struct_fields_cache: dict[int, tuple[tuple[str, ...], bool, bool]] = {}
 
+
+def _ignore_tree(ignore: Iterable[str]) -> dict:
+  # "carState.events.0.name" -> {"carState": {"events": {0: {"name": IGNORED}}}}
+  tree: dict = {}
+  for key in ignore:
+    node = tree
+    keys = [int(k) if k.isdigit() else k for k in key.split(".")]
     for k in keys[:-1]:
-      # indexing into list
-      if k.isdigit():
-        attr = attr[int(k)]
-      else:
-        attr = getattr(attr, k)
-
-    v = getattr(attr, keys[-1])
-    if isinstance(v, bool):
-      val = False
-    elif isinstance(v, numbers.Number):
-      val = 0
-    elif isinstance(v, (list, capnp.lib.capnp._DynamicListBuilder)):
-      val = []
+      node = node.setdefault(k, {})
+      if node is IGNORED:
+        break
     else:
-      raise NotImplementedError(f"Unknown type: {type(v)}")
-    setattr(attr, keys[-1], val)
-  return msg
-
-
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+      node[keys[-1]] = IGNORED
+  return tree
+
+
+def _struct_fields(msg) -> tuple[tuple[str, ...], bool, bool]:
+  schema = msg.schema
+  node_id = schema.node.id
+  if node_id not in _struct_fields_cache:
+    _struct_fields_cache[node_id] = (schema.non_union_fields, len(schema.union_fields) > 0, schema.node.struct.isGroup)
+  return _struct_fields_cache[node_id]
+
+
+def _diff_path(path):
+  # same paths as dictdiffer: dotted string, or a list if there are list indices in it
+  return ".".join(path) if all(isinstance(k, str) for k in path) else list(path)
+
+
+def _to_python(v):
+  if isinstance(v, capnp._DynamicStructReader):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, capnp._DynamicListReader):
+    return [_to_python(x) for x in v]
+  elif isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return v._as_str()
+  return v
+
+
+class LogDiffer:
+  """
+  Compares two messages by walking their capnp schema. Ignored fields are skipped in place, structs without ignored
+  fields are compared by their serialized bytes first, and numeric lists are compared as numpy arrays.
+  Differences are reported in dictdiffer format.
+  """
+  def __init__(self, ignore_fields: Iterable[str], tolerance: float, drift: dict[str, dict[str, float]] | None = None):
+    self.ignore = _ignore_tree(ignore_fields)
+    self.tolerance = tolerance
+    # field -> count, max_abs and max_rel of every numeric change, including the ones within tolerance
+    self.drift = drift
+
+  def diff(self, msg1, msg2) -> list:
+    out: list = []
+    self._diff(msg1, msg2, (), self.ignore, out)
+    return out
+
+  def _record_drift(self, path, abs_diff: float, rel_diff: float, count: int = 1):
+    if self.drift is None:
+      return
+    key = ".".join(k for k in path if isinstance(k, str))
+    d = self.drift.setdefault(key, {"count": 0, "max_abs": 0., "max_rel": 0.})
+    d["count"] += count
+    d["max_abs"] = max(d["max_abs"], abs_diff)
+    d["max_rel"] = max(d["max_rel"], rel_diff)
+
+  def _diff(self, a, b, path, ignore, out):
+    if isinstance(a, capnp._DynamicStructReader):
+      self._diff_struct(a, b, path, ignore, out)
+    elif isinstance(a, capnp._DynamicListReader):
+      self._diff_list(a, b, path, ignore, out)
+    elif isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+      # nan equals nan, like dictdiffer
+      if a != b and not (a != a and b != b):
+        self._diff_numbers(np.array([a]), np.array([b]), path, [path], out)
+    elif isinstance(a, capnp.lib.capnp._DynamicEnum):
+      if a != b:
+        out.append(("change", _diff_path(path), (a._as_str(), b._as_str())))
+    elif a != b:
+      out.append(("change", _diff_path(path), (a, b)))
+
+  def _diff_struct(self, a, b, path, ignore, out):
+    names, has_union, is_group = _struct_fields(a)
+    if not ignore and not is_group and a.as_builder().to_bytes() == b.as_builder().to_bytes():
+      return
+
+    # fields in to_dict order, the union member first
+    which1, which2 = (a.which(), b.which()) if has_union else (None, None)
+    if has_union and which1 == which2:
+      names = (which1, ) + names
+
+    for name in names:
+      sub = ignore.get(name) if ignore else None
+      if sub is not IGNORED:
+        self._diff(getattr(a, name), getattr(b, name), path + (name, ), sub, out)
+
+    if which1 != which2:
+      out.append(("add", _diff_path(path), [(which2, _to_python(getattr(b, which2)))]))
+      out.append(("remove", _diff_path(path), [(which1, _to_python(getattr(a, which1)))]))
+
+  def _diff_list(self, a, b, path, ignore, out):
+    n1, n2 = len(a), len(b)
+    n = min(n1, n2)
+    if n > 0:
+      self._diff_items(a, b, n, path, ignore, out)
+
+    # after the changes, and removed items last index first, like dictdiffer
+    if n2 > n:
+      out.append(("add", _diff_path(path), [(i, _to_python(b[i])) for i in range(n, n2)]))
+    elif n1 > n:
+      out.append(("remove", _diff_path(path), [(i, _to_python(a[i])) for i in reversed(range(n, n1))]))
+
+  def _diff_items(self, a, b, n, path, ignore, out):
+    # the first n items of both lists
+    first = a[0]
+    if ignore or isinstance(first, (capnp._DynamicStructReader, capnp._DynamicListReader)):
+      for i in range(n):
+        sub = ignore.get(i) if ignore else None
+        if sub is not IGNORED:
+          self._diff(a[i], b[i], path + (i, ), sub, out)
+      return
+
+    l1, l2 = list(a)[:n], list(b)[:n]
+    if l1 == l2:
+      return
+    if isinstance(first, numbers.Number):
+      x, y = np.array(l1), np.array(l2)
+      idxs = np.flatnonzero((x != y) & ~(np.isnan(x) & np.isnan(y)))
+      self._diff_numbers(x[idxs], y[idxs], path, [path + (int(i), ) for i in idxs], out)
+    else:
+      for i in range(n):
+        if l1[i] != l2[i]:
+          out.append(("change", _diff_path(path + (i, )), (_to_python(l1[i]), _to_python(l2[i]))))
+
+  def _diff_numbers(self, x: np.ndarray, y: np.ndarray, path, paths: list, out):
+    # only called with values that aren't equal
+    xf, yf = x.astype(np.float64), y.astype(np.float64)
+    with np.errstate(invalid='ignore', over='ignore'):
+      abs_diff = np.abs(xf - yf)
+      scale = np.maximum(np.abs(xf), np.abs(yf))
+      outside = ~(np.isfinite(xf) & np.isfinite(yf) & (abs_diff <= np.maximum(self.tolerance, self.tolerance * scale)))
+      finite = np.isfinite(abs_diff)
+      if finite.any():
+        rel_diff = np.divide(abs_diff[finite], scale[finite], out=np.zeros(int(finite.sum())), where=scale[finite] > 0)
+        self._record_drift(path, float(abs_diff[finite].max()), float(rel_diff.max()), int(finite.sum()))
+
+    for i in np.flatnonzero(outside):
+      out.append(("change", _diff_path(paths[i]), (x[i].item(), y[i].item())))
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, max_diffs=None, drift_store=None):
+  """
+  Compare two logs message by message, both can be any iterable of events (e.g. a LogReader) and are only iterated once.
+  max_diffs stops comparing messages of a service once that many differences were found for it.
+  drift_store is filled with every numeric field that changed, and by how much, including changes within tolerance.
+  """
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -47,48 +179,55 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
   tolerance = EPSILON if tolerance is None else tolerance
 
   log1, log2 = (
-    [m for m in log if m.which() not in ignore_msgs]
+    (m for m in log if m.which() not in ignore_msgs)
     for log in (log1, log2)
   )
 
-  if len(log1) != len(log2):
-    cnt1 = Counter(m.which() for m in log1)
-    cnt2 = Counter(m.which() for m in log2)
-    raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
+  differ = LogDiffer(ignore_fields, tolerance, drift_store)
+  cnt1: Counter = Counter()
+  cnt2: Counter = Counter()
+  service_diffs: Counter = Counter()
+  aligned = True
 
   diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
-      raise Exception("msgs not aligned between logs")
-
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
+  for msg1, msg2 in itertools.zip_longest(log1, log2):
+    if msg1 is not None:
+      cnt1[msg1.which()] += 1
+    if msg2 is not None:
+      cnt2[msg2.which()] += 1
+    if msg1 is None or msg2 is None or not aligned:
+      continue
+
+    which = msg1.which()
+    if which != msg2.which():
+      # keep counting, logs with different lengths are reported first
+      aligned = False
+      continue
+
+    if max_diffs is not None and service_diffs[which] >= max_diffs:
+      continue
+
+    dd = differ.diff(msg1, msg2)
+    if max_diffs is not None:
+      dd = dd[:max_diffs - service_diffs[which]]
+    service_diffs[which] += len(dd)
+    diff.extend(dd)
+
+  len1, len2 = cnt1.total(), cnt2.total()
+  if len1 != len2:
+    raise Exception(f"logs are not same length: {len1} VS {len2}\n\t\t{cnt1}\n\t\t{cnt2}")
+  if not aligned:
+    raise Exception("msgs not aligned between logs")
   return diff
 
 
+def format_drift(drift):
+  lines = []
+  for k, d in sorted(drift.items(), key=lambda kv: kv[1]["max_abs"], reverse=True):
+    lines.append(f"\t{k}: {d['count']} changes, max abs {d['max_abs']:.3g}, max rel {d['max_rel']:.3g}")
+  return "\n".join(lines)
+
+
 def format_process_diff(diff):
   diff_short, diff_long = "", ""
 
@@ -139,12 +278,16 @@ def format_diff(results, log_paths, ref_commit):
 
 
 if __name__ == "__main__":
-  log1 = list(LogReader(sys.argv[1]))
-  log2 = list(LogReader(sys.argv[2]))
+  log1 = LogReader(sys.argv[1])
+  log2 = LogReader(sys.argv[2])
   ignore_fields = sys.argv[3:] or ["logMonoTime"]
-  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields)}}
+  drift: dict[str, dict[str, float]] = {}
+  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields, drift_store=drift)}}
   log_paths = {"segment": {"proc": {"ref": sys.argv[1], "new": sys.argv[2]}}}
   diff_short, diff_long, failed = format_diff(results, log_paths, None)
 
   print(diff_long)
   print(diff_short)
+  if len(drift):
+    print("drifted fields:")
+    print(format_drift(drift))
@@ -0,0 +1,95 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import warnings
+
+import capnp
+from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR, ManagedCache
+from openpilot.tools.lib.filereader import FileReader
+from openpilot.tools.lib.logreader import LogMessage, STREAM_READ_SIZE, decompress_stream
+
+LOG_STORE_DIR = os.path.join(DEFAULT_CACHE_DIR, "process_replay")
+
+
+class LogStore:
+  """
+  Local content-addressed store of decompressed logs, for inputs and reference outputs of process replay.
+  Keys (e.g. segment name, or reference log name which includes the ref commit) point to objects named by
+  the sha256 of their content. Objects are stored uncompressed and read through mmap, so repeat runs
+  neither download nor decompress, and worker processes share the page cache instead of pickled bytes.
+
+  Several keys can share an object, so the cache budget is kept per object. An evicted object leaves its
+  refs dangling, and a lookup through them is a miss that fetches it again.
+  """
+  def __init__(self, root: str = LOG_STORE_DIR):
+    self.root = root
+    self.cache = ManagedCache(root)
+    os.makedirs(os.path.join(root, "refs"), exist_ok=True)
+    os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+
+  def _ref_path(self, key: str) -> str:
+    return os.path.join(self.root, "refs", hashlib.sha256(key.encode()).hexdigest())
+
+  def _object_path(self, digest: str) -> str:
+    return os.path.join(self.root, "objects", digest)
+
+  def lookup(self, key: str) -> str | None:
+    ref_path = self._ref_path(key)
+    try:
+      with open(ref_path) as f:
+        object_path = self._object_path(f.read().strip())
+    except FileNotFoundError:
+      return None
+    return object_path if os.path.exists(object_path) else None
+
+  def get(self, key: str, url: str) -> str:
+    """Path of the decompressed log stored under key, downloading and decompressing url on a miss"""
+    object_path = self.lookup(key)
+    hit = object_path is not None
+    if object_path is None:
+      object_path = self._fetch(key, url)
+
+    size = os.path.getsize(object_path)
+    self.cache.access(object_path, [object_path], size, hits=int(hit), misses=int(not hit), bytes_saved=size if hit else 0)
+    return object_path
+
+  def _fetch(self, key: str, url: str) -> str:
+    h = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, "objects"), prefix=".", delete=False) as tmp:
+      try:
+        with FileReader(url) as f:
+          for chunk in decompress_stream(iter(lambda: f.read(STREAM_READ_SIZE), b"")):
+            h.update(chunk)
+            tmp.write(chunk)
+      except BaseException:
+        os.remove(tmp.name)
+        raise
+
+    # identical content is stored once, whatever the key
+    object_path = self._object_path(h.hexdigest())
+    os.replace(tmp.name, object_path)
+    with atomic_write_in_dir(self._ref_path(key), overwrite=True) as f:
+      f.write(h.hexdigest())
+    return object_path
+
+  def stats(self) -> dict[str, float]:
+    return self.cache.stats()
+
+
+def read_stored_log(path: str) -> list[LogMessage]:
+  """Parse a log from the store without copying it, the events keep the mmap alive"""
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return []
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  ents = []
+  try:
+    for e in capnp_log.Event.read_multiple_bytes(mm):
+      ents.append(e)
+  except capnp.KjException:
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+  return ents
@@ -1,6 +1,9 @@
 from collections import defaultdict
 from collections.abc import Callable
 import functools
+import hashlib
+import heapq
+import os
 import capnp
 
 from cereal import messaging, car, log
@@ -12,13 +15,17 @@ from openpilot.selfdrive.modeld.fill_model_msg import fill_xyz_poly, fill_lane_l
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_encode_index
 from openpilot.selfdrive.controls.lib.longitudinal_planner import get_accel_from_plan
 from openpilot.system.manager.process_config import managed_processes
-from openpilot.tools.lib.logreader import LogIterable
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR, ManagedCache
+from openpilot.tools.lib.logreader import LogIterable, LogReader, save_log
 from panda import Panda
 
 MessageWithIndex = tuple[int, capnp.lib.capnp._DynamicStructReader]
 MigrationOps = tuple[list[tuple[int, capnp.lib.capnp._DynamicStructReader]], list[capnp.lib.capnp._DynamicStructReader], list[int]]
 MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 
+# bump when the output of any migration changes, invalidates cached migrated logs
+MIGRATION_VERSION = 1
+
 
 ## rules for migration functions
 ## 1. must use the decorator @migration(inputs=[...], product="...") and MigrationFunc signature
@@ -26,7 +33,12 @@ MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 ## 3. product is the message type created by the migration function, and the function will be skipped if product type already exists in lr
 ## 4. it must return a list of operations to be applied to the logreader (replace, add, delete)
 ## 5. all migration functions must be independent of each other
-def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False):
+def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False,
+                cache_key: str | None = None):
+  """
+  cache_key identifies the log (e.g. its path or url), when given the migrated log is cached and reused
+  for the same set of migrations and MIGRATION_VERSION. Local files are also keyed on their mtime and size.
+  """
   migrations = [
     migrate_sensorEvents,
     migrate_carParams,
@@ -50,7 +62,31 @@ def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: boo
   if camera_states:
     migrations.append(migrate_cameraStates)
 
-  return migrate(lr, migrations)
+  if cache_key is None:
+    return migrate(lr, migrations)
+
+  path = migrated_log_path(cache_key, migrations)
+  hit = os.path.exists(path)
+  if hit:
+    migrated = list(LogReader(path))
+  else:
+    migrated = migrate(lr, migrations)
+    # write next to the destination and rename, other processes may be reading the same entry
+    tmp_path = f"{path}.{os.getpid()}.tmp.zst"
+    save_log(tmp_path, migrated)
+    os.replace(tmp_path, path)
+  ManagedCache(DEFAULT_CACHE_DIR).access_file(path, hit=hit)
+  return migrated
+
+
+def migrated_log_path(cache_key: str, migration_funcs: list[MigrationFunc], cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+  key = ",".join(sorted(m.__name__ for m in migration_funcs))
+  if os.path.isfile(cache_key):
+    # a local log can be rewritten in place
+    st = os.stat(cache_key)
+    key += f"@{st.st_mtime_ns}:{st.st_size}"
+  key = hashlib.sha256(key.encode()).hexdigest()[:16]
+  return f"{cache_path_for_file_path(cache_key, cache_dir)}.migrated_v{MIGRATION_VERSION}_{key}.zst"
 
 
 def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
@@ -59,28 +95,38 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
   for i, msg in enumerate(lr):
     grouped[msg.which()].append(i)
 
-  replace_ops, add_ops, del_ops = [], [], []
+  # skip migrations whose products already exist, or that have nothing to migrate
+  active = []
   for migration in migration_funcs:
     assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
-    if migration.product in grouped: # skip if product already exists
-      continue
+    if migration.product not in grouped and any(i in grouped for i in migration.inputs):
+      active.append(migration)
 
+  if not len(active):
+    return lr if _is_sorted(lr) else sorted(lr, key=lambda x: x.logMonoTime)
+
+  replace_ops, add_ops, del_ops = {}, [], set()
+  for migration in active:
+    # only the input messages are handed to the migration
     sorted_indices = sorted(ii for i in migration.inputs for ii in grouped[i])
     msg_gen = [(i, lr[i]) for i in sorted_indices]
     r_ops, a_ops, d_ops = migration(msg_gen)
-    replace_ops.extend(r_ops)
+    replace_ops.update(r_ops)
     add_ops.extend(a_ops)
-    del_ops.extend(d_ops)
+    del_ops.update(d_ops)
+
+  if len(replace_ops) or len(del_ops):
+    lr = [replace_ops.get(i, msg) for i, msg in enumerate(lr) if i not in del_ops]
+  add_ops.sort(key=lambda x: x.logMonoTime)
+  # stable, same order as sorting everything: original messages first on equal logMonoTime.
+  # checked after the replacements, they can change logMonoTime
+  if _is_sorted(lr):
+    return list(heapq.merge(lr, add_ops, key=lambda x: x.logMonoTime))
+  return sorted(lr + add_ops, key=lambda x: x.logMonoTime)
 
-  for index, msg in replace_ops:
-    lr[index] = msg
-  for index in sorted(del_ops, reverse=True):
-    del lr[index]
-  for msg in add_ops:
-    lr.append(msg)
-  lr = sorted(lr, key=lambda x: x.logMonoTime)
 
-  return lr
+def _is_sorted(msgs) -> bool:
+  return all(m1.logMonoTime <= m2.logMonoTime for m1, m2 in zip(msgs, msgs[1:], strict=False))
 
 
 def migration(inputs: list[str], product: str|None=None):
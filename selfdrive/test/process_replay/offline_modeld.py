@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+import os
+import copy
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import capnp
+
+import cereal.messaging as messaging
+from msgq.visionipc import VisionIpcServer, VisionIpcClient
+from openpilot.common.filter_simple import FirstOrderFilter
+from openpilot.common.transformations.camera import DEVICE_CAMERAS
+from openpilot.common.transformations.model import get_warp_matrix
+from openpilot.selfdrive.controls.lib.desire_helper import DesireHelper
+from openpilot.selfdrive.modeld.constants import ModelConstants
+from openpilot.selfdrive.modeld.fill_model_msg import PublishState
+from openpilot.selfdrive.modeld.models.commonmodel_pyx import CLContext
+from openpilot.selfdrive.modeld.modeld import FEATURE_IDXS, FrameMeta, ModelState, build_model_msgs
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import ProcessConfig, get_process_config
+from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_camera_state, available_streams
+from openpilot.system.hardware import TICI
+from openpilot.tools.lib.framereader import BaseFrameReader
+from openpilot.tools.lib.logreader import LogIterable, save_log
+
+# the features buffer of a frame starts 4 frames back, so the next 4 frames don't depend on each other's outputs
+MAX_BATCH_SIZE = 4
+VIPC_NAME = "offline_modeld"
+SM_SERVICES = ["deviceState", "carState", "roadCameraState", "liveCalibration", "driverMonitoringState", "carControl"]
+
+
+@dataclass
+class PendingFrame:
+  imgs: dict[str, np.ndarray]
+  traffic_convention: np.ndarray
+  prepare_only: bool
+  meta_main: FrameMeta
+  meta_extra: FrameMeta
+  frame_id: int
+  v_ego: float
+  car_state: capnp._DynamicStructReader
+  lat_active: bool
+  frame_drop_ratio: float
+  vipc_dropped_frames: int
+  live_calib_seen: bool
+  log_mono_time: int
+
+
+class OfflineModeld:
+  """
+  modeld driven from a log and its FrameReaders instead of VisionIPC and a SubMaster.
+
+  Messages are fed in log order, like process_replay feeds the modeld process, and each camera frame is warped
+  as soon as it arrives. Model execution is deferred, so up to MAX_BATCH_SIZE frames run concurrently. Those
+  frames only depend on hidden states from before the batch, so the features buffer history stays exact. Their
+  desire input does depend on the previous output, through DesireHelper. It's assumed not to change within a
+  batch, and frames after a change are run again, so outputs match the streaming path.
+  """
+  def __init__(self, CP: capnp._DynamicStructReader, lr: LogIterable, frs: dict[str, BaseFrameReader], batch_size: int = MAX_BATCH_SIZE,
+               cfg: ProcessConfig | None = None):
+    assert not TICI, "offline modeld runs the onnx model on PC"
+    assert 1 <= batch_size <= MAX_BATCH_SIZE
+
+    self.cfg = copy.deepcopy(cfg or get_process_config("modeld"))
+    streams = [meta for meta in available_streams(lr) if meta.camera_state in self.cfg.vision_pubs]
+    self.cfg.vision_pubs = [meta.camera_state for meta in streams]
+    assert len(self.cfg.vision_pubs) != 0, "log has no road camera states"
+    self.main_camera = "roadCameraState" if "roadCameraState" in self.cfg.vision_pubs else "wideRoadCameraState"
+    self.main_wide_camera = self.main_camera == "wideRoadCameraState"
+    self.frs = frs
+
+    self.cl_context = CLContext()
+    # the frames of a batch run concurrently on one session, so they split the cores instead of each taking modeld's threads
+    self.model = ModelState(self.cl_context, intra_op_num_threads=max(1, (os.cpu_count() or 1) // batch_size))
+    self.batch_size = batch_size
+    self.pool = ThreadPoolExecutor(max_workers=batch_size)
+
+    # the frames go through a visionipc server in this process, so the warp is the same as modeld's
+    self.vipc_server = VisionIpcServer(VIPC_NAME)
+    for meta in streams:
+      self.vipc_server.create_buffers(meta.stream, 2, frs[meta.camera_state].w, frs[meta.camera_state].h)
+    self.vipc_server.start_listener()
+    self.vipc_clients = {}
+    for meta in streams:
+      client = VisionIpcClient(VIPC_NAME, meta.stream, True, self.cl_context)
+      while not client.connect(False):
+        time.sleep(0.01)
+      self.vipc_clients[meta.camera_state] = client
+
+    # modeld state
+    self.steer_delay = CP.steerActuatorDelay + .2
+    self.DH = DesireHelper()
+    self.publish_state = PublishState()
+    self.frame_dropped_filter = FirstOrderFilter(0., 10., 1. / ModelConstants.MODEL_FREQ)
+    self.last_vipc_frame_id = 0
+    self.run_count = 0
+    self.model_transform_main = np.zeros((3, 3), dtype=np.float32)
+    self.model_transform_extra = np.zeros((3, 3), dtype=np.float32)
+    self.live_calib_seen = False
+
+    # SubMaster emulation, only for what process_replay publishes to modeld
+    self.sm = {s: getattr(messaging.new_message(s), s) for s in SM_SERVICES}
+    self.seen: set[str] = set()
+    self.updated: set[str] = set()
+    self.cycle_msgs: list[capnp._DynamicStructReader] = []
+
+    self.pending: deque[PendingFrame] = deque()
+    self.output_msgs: list[capnp._DynamicStructReader] = []
+
+  def _recv_frame(self, camera_state_msg: capnp._DynamicStructReader):
+    camera_state = getattr(camera_state_msg, camera_state_msg.which())
+    img = self.frs[camera_state_msg.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
+    self.vipc_server.send(meta_from_camera_state(camera_state_msg.which()).stream, img.flatten().tobytes(),
+                          camera_state.frameId, camera_state.timestampSof, camera_state.timestampEof)
+    client = self.vipc_clients[camera_state_msg.which()]
+    buf = client.recv()
+    assert buf is not None
+    return buf, FrameMeta(client)
+
+  def feed(self, msg: capnp._DynamicStructReader) -> None:
+    if msg.which() not in self.cfg.pubs:
+      return
+    self.cycle_msgs.append(msg)
+    if self.cfg.should_recv_callback(msg, self.cfg, self.run_count):
+      self._cycle(msg)
+      self.cycle_msgs = []
+    if len(self.pending) >= self.batch_size:
+      self._run_batch()
+
+  def flush(self) -> list[capnp._DynamicStructReader]:
+    while len(self.pending):
+      self._run_batch()
+    return self.output_msgs
+
+  def _cycle(self, trigger_msg: capnp._DynamicStructReader) -> None:
+    # same as one iteration of the modeld main loop, up to running the model
+    buf_main, meta_main = self._recv_frame(next(m for m in reversed(self.cycle_msgs) if m.which() == self.main_camera))
+    if len(self.cfg.vision_pubs) == 2:
+      buf_extra, meta_extra = self._recv_frame(next(m for m in reversed(self.cycle_msgs) if m.which() == "wideRoadCameraState"))
+    else:
+      buf_extra, meta_extra = buf_main, meta_main
+
+    self.updated = set()
+    for m in self.cycle_msgs:
+      if m.which() in self.sm:
+        self.sm[m.which()] = getattr(m, m.which())
+        self.seen.add(m.which())
+        self.updated.add(m.which())
+
+    is_rhd = self.sm["driverMonitoringState"].isRHD
+    if "liveCalibration" in self.updated and "roadCameraState" in self.seen and "deviceState" in self.seen:
+      device_from_calib_euler = np.array(self.sm["liveCalibration"].rpyCalib, dtype=np.float32)
+      dc = DEVICE_CAMERAS[(str(self.sm['deviceState'].deviceType), str(self.sm['roadCameraState'].sensor))]
+      self.model_transform_main = get_warp_matrix(device_from_calib_euler, dc.ecam.intrinsics if self.main_wide_camera else dc.fcam.intrinsics,
+                                                  False).astype(np.float32)
+      self.model_transform_extra = get_warp_matrix(device_from_calib_euler, dc.ecam.intrinsics, True).astype(np.float32)
+      self.live_calib_seen = True
+
+    traffic_convention = np.zeros((1, ModelConstants.TRAFFIC_CONVENTION_LEN), dtype=np.float32)
+    traffic_convention[0, int(is_rhd)] = 1
+
+    vipc_dropped_frames = max(0, meta_main.frame_id - self.last_vipc_frame_id - 1)
+    frames_dropped = self.frame_dropped_filter.update(min(vipc_dropped_frames, 10))
+    if self.run_count < 10:
+      self.frame_dropped_filter.x = 0.
+      frames_dropped = 0.
+    self.run_count += 1
+    self.last_vipc_frame_id = meta_main.frame_id
+
+    # the warped images don't depend on the model outputs, copy them out of the frame buffers
+    self.model.prepare_imgs(buf_main, buf_extra, self.model_transform_main, self.model_transform_extra)
+    imgs = {k: self.model.numpy_inputs[k].copy() for k in ('input_imgs', 'big_input_imgs')}
+
+    self.pending.append(PendingFrame(
+      imgs=imgs, traffic_convention=traffic_convention, prepare_only=vipc_dropped_frames > 0,
+      meta_main=meta_main, meta_extra=meta_extra, frame_id=self.sm["roadCameraState"].frameId,
+      v_ego=max(self.sm["carState"].vEgo, 0.), car_state=self.sm["carState"], lat_active=self.sm["carControl"].latActive,
+      frame_drop_ratio=frames_dropped / (1 + frames_dropped), vipc_dropped_frames=vipc_dropped_frames,
+      live_calib_seen=self.live_calib_seen, log_mono_time=trigger_msg.logMonoTime + int(self.cfg.processing_time * 1e9),
+    ))
+
+  def _desire_vector(self) -> np.ndarray:
+    vec_desire = np.zeros(ModelConstants.DESIRE_LEN, dtype=np.float32)
+    if self.DH.desire >= 0 and self.DH.desire < ModelConstants.DESIRE_LEN:
+      vec_desire[self.DH.desire] = 1
+    return vec_desire
+
+  def _execute(self, inputs: dict[str, np.ndarray]) -> np.ndarray:
+    return self.model.onnx_cpu_runner.run(None, inputs)[0].flatten()
+
+  def _run_batch(self) -> None:
+    # speculate on the desire of the first pending frame for the rest of the batch
+    desire = self.DH.desire
+    desire_20Hz, prev_desire = self.model.desire_20Hz.copy(), self.model.prev_desire.copy()
+    batch = []
+    for frame in self.pending:
+      if len(batch) == self.batch_size:
+        break
+      desire_input = self.model.update_desire(self._desire_vector())
+      if not frame.prepare_only:
+        features = self.model.full_features_20Hz[FEATURE_IDXS + len(batch)][np.newaxis]
+        batch.append({'desire': desire_input, 'traffic_convention': frame.traffic_convention, 'features_buffer': features, **frame.imgs})
+    self.model.desire_20Hz[:], self.model.prev_desire[:] = desire_20Hz, prev_desire
+
+    t = time.perf_counter()
+    outputs = deque(self.pool.map(self._execute, batch))
+    model_execution_time = (time.perf_counter() - t) / max(len(batch), 1)
+
+    while len(self.pending):
+      frame = self.pending[0]
+      if self.DH.desire != desire or (not frame.prepare_only and not len(outputs)):
+        break
+      self.pending.popleft()
+      self.model.update_desire(self._desire_vector())
+      if frame.prepare_only:
+        continue
+
+      model_output = self.model.parser.parse_outputs(self.model.slice_outputs(outputs.popleft()))
+      self.model.update_features(model_output)
+      msgs = build_model_msgs(model_output, self.DH, frame.car_state, frame.lat_active, frame.v_ego, self.steer_delay,
+                              self.publish_state, frame.meta_main, frame.meta_extra, frame.frame_id, frame.frame_drop_ratio,
+                              frame.vipc_dropped_frames, model_execution_time, frame.live_calib_seen)
+      for m in msgs:
+        m.logMonoTime = frame.log_mono_time
+        self.output_msgs.append(m.as_reader())
+
+
+def run_offline_modeld(lr: LogIterable, frs: dict[str, BaseFrameReader], batch_size: int = MAX_BATCH_SIZE,
+                       cfg: ProcessConfig | None = None) -> list[capnp._DynamicStructReader]:
+  """
+  Returns the modelV2, drivingModelData and cameraOdometry messages the modeld process would publish when
+  replayed on lr with cfg, modeld's process config by default, with the logMonoTimes process_replay gives them.
+  """
+  all_msgs = sorted(migrate_all(lr, manager_states=True, camera_states=True), key=lambda m: m.logMonoTime)
+  CP = next(m.carParams for m in all_msgs if m.which() == "carParams")
+
+  modeld = OfflineModeld(CP, all_msgs, frs, batch_size, cfg)
+  for msg in all_msgs:
+    modeld.feed(msg)
+  return modeld.flush()
+
+
+if __name__ == "__main__":
+  from openpilot.selfdrive.test.process_replay.regen import setup_data_readers
+
+  parser = argparse.ArgumentParser(description="Run modeld offline on a segment, in batches")
+  parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE)
+  parser.add_argument("route", type=str, help="The source route")
+  parser.add_argument("seg", type=int, help="Segment in source route")
+  parser.add_argument("out", type=str, help="Output log path")
+  args = parser.parse_args()
+
+  lr, frs = setup_data_readers(args.route, args.seg, use_route_meta=True, needs_driver_cam=False)
+  t = time.monotonic()
+  msgs = run_offline_modeld(lr, frs, args.batch_size)
+  print(f"{sum(m.which() == 'modelV2' for m in msgs)} frames in {time.monotonic() - t:.1f}s")
+  save_log(args.out, msgs)
@@ -3,12 +3,18 @@ import os
 import time
 import copy
 import json
+import gc
 import heapq
+import queue
 import signal
-from collections import Counter, OrderedDict
+import importlib
+import itertools
+import threading
+import concurrent.futures
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
 from typing import Any
-from collections.abc import Callable, Iterable
+from collections.abc import Callable, Iterable, Iterator, Sequence
 from tqdm import tqdm
 import capnp
 from openpilot.system.hardware.hw import Paths
@@ -35,6 +41,8 @@ from openpilot.tools.lib.framereader import BaseFrameReader
 NUMPY_TOLERANCE = 1e-7
 PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
+# pure python daemons that only talk through SubMaster/PubMaster, and can be replayed with InProcessContainer
+IN_PROCESS_PROCS = {"radard", "plannerd", "calibrationd", "dmonitoringd", "paramsd", "torqued"}
 
 class DummySocket:
   def __init__(self):
@@ -152,7 +160,8 @@ class ProcessContainer:
     self.prefix = OpenpilotPrefix(clean_dirs_on_exit=False)
     self.cfg = copy.deepcopy(cfg)
     self.process = copy.deepcopy(managed_processes[cfg.proc_name])
-    self.msg_queue: list[capnp._DynamicStructReader] = []
+    # messages waiting for the next recv cycle, with their serialized form if already known
+    self.msg_queue: list[tuple[capnp._DynamicStructReader, bytes | None]] = []
     self.cnt = 0
     self.pm: messaging.PubMaster | None = None
     self.sockets: list[messaging.SubSocket] | None = None
@@ -160,6 +169,14 @@ class ProcessContainer:
     self.vipc_server: VisionIpcServer | None = None
     self.environ_config: dict[str, Any] | None = None
     self.capture: ProcessOutputCapture | None = None
+    self.msgs_in = 0
+    self.step_time = 0.
+    # time from sending a batch of messages until the process has published its outputs
+    self.step_latencies: list[float] = []
+
+  @property
+  def throughput(self) -> float:
+    return self.msgs_in / self.step_time if self.step_time > 0 else 0.
 
   @property
   def has_empty_queue(self) -> bool:
@@ -268,52 +285,269 @@ class ProcessContainer:
       self.prefix.clean_dirs()
       self._clean_env()
 
-  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None) -> list[capnp._DynamicStructReader]:
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None,
+               dat: bytes | None = None) -> list[capnp._DynamicStructReader]:
+    """
+    Feed one message to the process. Messages are queued until should_recv_callback marks the end of a cycle,
+    then the whole batch is sent with a single recv handshake. dat is the serialized msg, if the caller has it,
+    which lets the same bytes be sent to several processes without re-encoding.
+    """
     assert self.rc and self.pm and self.sockets and self.process.proc
 
+    t = time.monotonic()
+    end_of_cycle = True
+    if self.cfg.should_recv_callback is not None:
+      end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+    self.msg_queue.append((msg, dat))
+    self.msgs_in += 1
+    if not end_of_cycle:
+      self.step_time += time.monotonic() - t
+      return []
+
     output_msgs = []
     with self.prefix, Timeout(self.cfg.timeout, error_msg=f"timed out testing process {repr(self.cfg.proc_name)}"):
-      end_of_cycle = True
-      if self.cfg.should_recv_callback is not None:
-        end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
-
-      self.msg_queue.append(msg)
-      if end_of_cycle:
-        self.rc.wait_for_recv_called()
-
-        # call recv to let sub-sockets reconnect, after we know the process is ready
-        if self.cnt == 0:
-          for s in self.sockets:
-            messaging.recv_one_or_none(s)
-
-        # empty recv on drained pub indicates the end of messages, only do that if there're any
-        trigger_empty_recv = False
-        if self.cfg.main_pub and self.cfg.main_pub_drained:
-          trigger_empty_recv = next((True for m in self.msg_queue if m.which() == self.cfg.main_pub), False)
-
-        for m in self.msg_queue:
-          self.pm.send(m.which(), m.as_builder())
-          # send frames if needed
-          if self.vipc_server is not None and m.which() in self.cfg.vision_pubs:
-            camera_state = getattr(m, m.which())
-            camera_meta = meta_from_camera_state(m.which())
-            assert frs is not None
-            img = frs[m.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
-            self.vipc_server.send(camera_meta.stream, img.flatten().tobytes(),
-                                  camera_state.frameId, camera_state.timestampSof, camera_state.timestampEof)
-        self.msg_queue = []
-
-        self.rc.unlock_sockets()
-        self.rc.wait_for_next_recv(trigger_empty_recv)
-
-        for socket in self.sockets:
-          ms = messaging.drain_sock(socket)
-          for m in ms:
-            m = m.as_builder()
-            m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
-            output_msgs.append(m.as_reader())
-        self.cnt += 1
+      self.rc.wait_for_recv_called()
+
+      # call recv to let sub-sockets reconnect, after we know the process is ready
+      if self.cnt == 0:
+        for s in self.sockets:
+          messaging.recv_one_or_none(s)
+
+      # empty recv on drained pub indicates the end of messages, only do that if there're any
+      trigger_empty_recv = False
+      if self.cfg.main_pub and self.cfg.main_pub_drained:
+        trigger_empty_recv = next((True for m, _ in self.msg_queue if m.which() == self.cfg.main_pub), False)
+
+      step_start = time.monotonic()
+      for m, m_dat in self.msg_queue:
+        self.pm.send(m.which(), m_dat if m_dat is not None else m.as_builder())
+        # send frames if needed
+        if self.vipc_server is not None and m.which() in self.cfg.vision_pubs:
+          camera_state = getattr(m, m.which())
+          camera_meta = meta_from_camera_state(m.which())
+          assert frs is not None
+          img = frs[m.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
+          self.vipc_server.send(camera_meta.stream, img.flatten().tobytes(),
+                                camera_state.frameId, camera_state.timestampSof, camera_state.timestampEof)
+      self.msg_queue = []
+
+      self.rc.unlock_sockets()
+      self.rc.wait_for_next_recv(trigger_empty_recv)
+      self.step_latencies.append(time.monotonic() - step_start)
+
+      for socket in self.sockets:
+        ms = messaging.drain_sock(socket)
+        for m in ms:
+          m = m.as_builder()
+          m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+          output_msgs.append(m.as_reader())
+      self.cnt += 1
     assert self.process.proc.is_alive()
+    self.step_time += time.monotonic() - t
+
+    return output_msgs
+
+  def stats(self) -> dict[str, float]:
+    latencies = sorted(self.step_latencies)
+
+    def percentile(q: float) -> float:
+      return latencies[min(int(q * len(latencies)), len(latencies) - 1)] if len(latencies) else 0.
+
+    return {
+      "msgs": self.msgs_in,
+      "steps": len(latencies),
+      "seconds": self.step_time,
+      "msgs_per_sec": self.throughput,
+      "latency_p50": percentile(0.5),
+      "latency_p99": percentile(0.99),
+      "latency_max": latencies[-1] if len(latencies) else 0.,
+    }
+
+
+class _InProcessReplayDone(Exception):
+  pass
+
+
+class InProcessSubMaster(messaging.SubMaster):
+  """SubMaster without sockets, update() blocks until the replay hands over the next batch of messages"""
+  def __init__(self, container: 'InProcessContainer', services: list[str], poll: str | None = None,
+               ignore_alive: list[str] | None = None, ignore_avg_freq: list[str] | None = None,
+               ignore_valid: list[str] | None = None, addr: str = "127.0.0.1", frequency: float | None = None):
+    self.container = container
+    self.frame = -1
+    self.services = services
+    self.seen = {s: False for s in services}
+    self.updated = {s: False for s in services}
+    self.recv_time = {s: 0. for s in services}
+    self.recv_frame = {s: 0 for s in services}
+    self.alive = {s: False for s in services}
+    self.freq_ok = {s: False for s in services}
+    self.sock = {}
+    self.data = {}
+    self.valid = {}
+    self.logMonoTime = {}
+
+    self.freq_tracker = {}
+    polled_services = set([poll, ] if poll is not None else services)
+    self.non_polled_services = set(services) - polled_services
+
+    self.ignore_average_freq = [] if ignore_avg_freq is None else ignore_avg_freq
+    self.ignore_alive = [] if ignore_alive is None else ignore_alive
+    self.ignore_valid = [] if ignore_valid is None else ignore_valid
+
+    self.simulation = bool(int(os.getenv("SIMULATION", "0")))
+    self.update_freq = frequency or max([SERVICE_LIST[s].frequency for s in polled_services])
+
+    for s in services:
+      try:
+        data = messaging.new_message(s)
+      except capnp.lib.capnp.KjException:
+        data = messaging.new_message(s, 0) # lists
+
+      self.data[s] = getattr(data.as_reader(), s)
+      self.logMonoTime[s] = 0
+      self.valid[s] = False
+      self.freq_tracker[s] = messaging.FrequencyTracker(SERVICE_LIST[s].frequency, self.update_freq, s == poll)
+
+  def update(self, timeout: int = 100) -> None:
+    # the real sockets are conflated, only the latest message of each service is received per update
+    latest = {m.which(): m for m in self.container.next_batch() if m.which() in self.data}
+    self.update_msgs(time.monotonic(), list(latest.values()))
+
+
+class InProcessPubMaster(messaging.PubMaster):
+  """PubMaster that hands sent messages back to the replay instead of publishing them"""
+  def __init__(self, container: 'InProcessContainer', services: list[str]):
+    self.container = container
+    self.sock = {}
+
+  def send(self, s: str, dat: bytes | capnp._DynamicStructBuilder) -> None:
+    self.container.outputs.append(messaging.log_from_bytes(dat).as_builder() if isinstance(dat, bytes) else dat.copy())
+
+  def all_readers_updated(self, s: str) -> bool:
+    return True
+
+
+class InProcessContainer(ProcessContainer):
+  """
+  Runs a python daemon's main() on a thread of the replaying process, with SubMaster and PubMaster swapped for
+  in-process versions fed directly from the log. Messages are batched with the same should_recv_callback
+  as ProcessContainer, and each batch is one sm.update() of the daemon, so outputs match the msgq replay
+  without a fork, sockets or fake events.
+  """
+  def __init__(self, cfg: ProcessConfig):
+    super().__init__(cfg)
+    assert cfg.proc_name in IN_PROCESS_PROCS, f"{cfg.proc_name} can't be replayed in process"
+    self.outputs: list[capnp._DynamicStructBuilder] = []
+    self.thread: threading.Thread | None = None
+    self.batches: queue.Queue[list[capnp._DynamicStructReader] | None] = queue.Queue()
+    # signals from the daemon thread: None when it's waiting for the next batch, otherwise the exception it died with
+    self.ready: queue.Queue[BaseException | None] = queue.Queue()
+
+  def next_batch(self) -> list[capnp._DynamicStructReader]:
+    self.ready.put(None)
+    msgs = self.batches.get()
+    if msgs is None:
+      raise _InProcessReplayDone
+    return msgs
+
+  def _run(self, mod):
+    try:
+      mod.main()
+      self.ready.put(RuntimeError(f"{self.cfg.proc_name} exited"))
+    except _InProcessReplayDone:
+      pass
+    except BaseException as e:
+      self.ready.put(e)
+
+  def _wait_ready(self):
+    try:
+      err = self.ready.get(timeout=self.cfg.timeout)
+    except queue.Empty:
+      raise TimeoutError(f"timed out testing process {repr(self.cfg.proc_name)}") from None
+    if err is not None:
+      raise Exception(f"{self.cfg.proc_name} failed") from err
+
+  def start(
+    self, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, frs: dict[str, BaseFrameReader] | None,
+    fingerprint: str | None, capture_output: bool
+  ):
+    assert not capture_output, "output capture is not supported for in-process replay"
+    with self.prefix:
+      self._setup_env(params_config, environ_config)
+
+      if self.cfg.config_callback is not None:
+        params = Params()
+        self.cfg.config_callback(params, self.cfg, all_msgs)
+
+      if self.cfg.init_callback is not None:
+        self.cfg.init_callback(None, None, all_msgs, fingerprint)
+
+      mod = importlib.import_module(self.process.module)
+      patched = {
+        (messaging, "SubMaster"): lambda *args, **kwargs: InProcessSubMaster(self, *args, **kwargs),
+        (messaging, "PubMaster"): lambda *args, **kwargs: InProcessPubMaster(self, *args, **kwargs),
+      }
+      # realtime priority, core affinity and disabled gc would apply to the whole replaying process
+      for name in ("config_realtime_process", "set_realtime_priority", "set_core_affinity"):
+        if hasattr(mod, name):
+          patched[(mod, name)] = lambda *args, **kwargs: None
+      originals = {k: getattr(*k) for k in patched}
+      gc_enabled = gc.isenabled()
+      try:
+        for (obj, name), v in patched.items():
+          setattr(obj, name, v)
+        self.thread = threading.Thread(target=self._run, args=(mod,), name=self.cfg.proc_name, daemon=True)
+        self.thread.start()
+        # the daemon is set up once it asks for the first batch
+        self._wait_ready()
+      finally:
+        for (obj, name), v in originals.items():
+          setattr(obj, name, v)
+        # some daemons call gc.disable() directly
+        if gc_enabled:
+          gc.enable()
+
+  def stop(self):
+    with self.prefix:
+      if self.thread is not None and self.thread.is_alive():
+        self.batches.put(None)
+        self.thread.join(self.cfg.timeout)
+      self.prefix.clean_dirs()
+      self._clean_env()
+
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None,
+               dat: bytes | None = None) -> list[capnp._DynamicStructReader]:
+    assert self.thread is not None
+
+    t = time.monotonic()
+    end_of_cycle = True
+    if self.cfg.should_recv_callback is not None:
+      end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+    self.msg_queue.append((msg, dat))
+    self.msgs_in += 1
+    if not end_of_cycle:
+      self.step_time += time.monotonic() - t
+      return []
+
+    with self.prefix:
+      step_start = time.monotonic()
+      self.outputs = []
+      self.batches.put([m for m, _ in self.msg_queue])
+      self.msg_queue = []
+      self._wait_ready()
+      self.step_latencies.append(time.monotonic() - step_start)
+
+    output_msgs = []
+    for m in self.outputs:
+      m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+      output_msgs.append(m.as_reader())
+    self.outputs = []
+    self.cnt += 1
+    self.step_time += time.monotonic() - t
 
     return output_msgs
 
@@ -651,8 +885,13 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False,
+  replay_stats_store: dict[str, dict[str, float]] = None, in_process: bool = False
 ) -> list[capnp._DynamicStructReader]:
+  """
+  in_process replays the daemons in IN_PROCESS_PROCS on threads of this process instead of spawning them,
+  other daemons are still started as separate processes.
+  """
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
   else:
@@ -662,7 +901,8 @@ def replay_process(
                          manager_states=True,
                          panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
                          camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress,
+                                      replay_stats_store, in_process)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -678,7 +918,8 @@ def replay_process(
 
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  replay_stats_store: dict[str, dict[str, float]] | None = None, in_process: bool = False
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -702,7 +943,10 @@ def _replay_multi_process(
   try:
     containers = []
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      if in_process and cfg.proc_name in IN_PROCESS_PROCS and captured_output_store is None:
+        container = InProcessContainer(cfg)
+      else:
+        container = ProcessContainer(cfg)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
@@ -710,30 +954,32 @@ def _replay_multi_process(
     all_subs = {sub for container in containers for sub in container.subs}
     lr_pubs = all_pubs - all_subs
     pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
+    # only messages sent over msgq to more than one process are worth serializing up front
+    shared_pubs = {pub for pub, cs in pubs_to_containers.items() if sum(not isinstance(c, InProcessContainer) for c in cs) > 1}
 
-    pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
-    # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
-    internal_pub_queue: list[capnp._DynamicStructReader] = []
-    # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
-    internal_pub_index_heap: list[tuple[int, int]] = []
+    # external queue for messages taken from logs, already in logMonoTime order
+    external_pub_queue: deque[capnp._DynamicStructReader] = deque(msg for msg in all_msgs if msg.which() in lr_pubs)
+    # heap for messages generated by processes, which will be republished: (logMonoTime, sequence number, msg)
+    # the sequence number keeps messages with equal logMonoTime in generation order
+    internal_pub_heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+    internal_seq = itertools.count()
 
     pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
-    while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
-      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
+    while len(external_pub_queue) != 0 or (len(internal_pub_heap) != 0 and not all(c.has_empty_queue for c in containers)):
+      if len(internal_pub_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_heap[0][0]):
+        msg = external_pub_queue.popleft()
         pbar.update(1)
       else:
-        _, index = heapq.heappop(internal_pub_index_heap)
-        msg = internal_pub_queue[index]
+        msg = heapq.heappop(internal_pub_heap)[2]
 
       target_containers = pubs_to_containers[msg.which()]
+      # serialize once, however many processes the message is sent to
+      dat = msg.as_builder().to_bytes() if msg.which() in shared_pubs else None
       for container in target_containers:
-        output_msgs = container.run_step(msg, frs)
+        output_msgs = container.run_step(msg, frs, dat)
         for m in output_msgs:
           if m.which() in all_pubs:
-            internal_pub_queue.append(m)
-            heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
+            heapq.heappush(internal_pub_heap, (m.logMonoTime, next(internal_seq), m))
         log_msgs.extend(output_msgs)
   finally:
     for container in containers:
@@ -742,10 +988,40 @@ def _replay_multi_process(
         assert container.capture is not None
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
+      if replay_stats_store is not None:
+        replay_stats_store[container.cfg.proc_name] = container.stats()
 
   return log_msgs
 
 
+def _run_in_prefix(func: Callable, job: Any) -> Any:
+  # keep the download cache shared, so reference logs are only fetched once across jobs
+  with OpenpilotPrefix(shared_download_cache=True):
+    return func(job)
+
+
+def replay_sharded(func: Callable[[Any], Any], jobs: Sequence[Any], costs: Sequence[float] | None = None,
+                   workers: int | None = None) -> Iterator[Any]:
+  """
+  Run func over independent replay jobs (e.g. (segment, process) pairs) on a pool of worker processes,
+  each job in its own OpenpilotPrefix. Jobs are submitted most expensive first so the long ones don't
+  end up as stragglers, and results are yielded in completion order.
+  """
+  order = list(range(len(jobs)))
+  if costs is not None:
+    assert len(costs) == len(jobs)
+    order.sort(key=lambda i: costs[i], reverse=True)
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(_run_in_prefix, func, jobs[i]) for i in order]
+    try:
+      for fut in concurrent.futures.as_completed(futures):
+        yield fut.result()
+    finally:
+      for fut in futures:
+        fut.cancel()
+
+
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
   params_dict = {
     "OpenpilotEnabledToggle": True,
@@ -11,6 +11,7 @@ from collections.abc import Iterable
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, FAKEDATA, ProcessConfig, replay_process, get_process_config, \
                                                                    check_openpilot_enabled, check_most_messages_valid, get_custom_params_from_lr
 from openpilot.selfdrive.test.process_replay.vision_meta import DRIVER_CAMERA_FRAME_SIZES
+from openpilot.selfdrive.test.process_replay.log_store import LogStore, read_stored_log
 from openpilot.selfdrive.test.update_ci_routes import upload_route
 from openpilot.tools.lib.route import Route
 from openpilot.tools.lib.framereader import FrameReader, BaseFrameReader, FrameType
@@ -41,11 +42,21 @@ class DummyFrameReader(BaseFrameReader):
 
 def regen_segment(
   lr: LogIterable, frs: dict[str, Any] = None,
-  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False
+  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False, offline_modeld: bool = False
 ) -> list[capnp._DynamicStructReader]:
+  """
+  offline_modeld runs modeld in batches on this process ahead of the others, instead of stepping it frame by frame
+  """
   all_msgs = sorted(lr, key=lambda m: m.logMonoTime)
   custom_params = get_custom_params_from_lr(all_msgs)
 
+  if offline_modeld and any(p.proc_name == "modeld" for p in processes):
+    from openpilot.selfdrive.test.process_replay.offline_modeld import run_offline_modeld
+    model_subs = set(get_process_config("modeld").subs)
+    all_msgs = [m for m in all_msgs if m.which() not in model_subs] + run_offline_modeld(all_msgs, frs)
+    all_msgs.sort(key=lambda m: m.logMonoTime)
+    processes = [p for p in processes if p.proc_name != "modeld"]
+
   print("Replayed processes:", [p.proc_name for p in processes])
   print("\n\n", "*"*30, "\n\n", sep="")
 
@@ -57,7 +68,7 @@ def regen_segment(
 def setup_data_readers(
     route: str, sidx: int, use_route_meta: bool,
     needs_driver_cam: bool = True, needs_road_cam: bool = True, dummy_driver_cam: bool = False
-) -> tuple[LogReader, dict[str, Any]]:
+) -> tuple[LogIterable, dict[str, Any]]:
   if use_route_meta:
     r = Route(route)
     lr = LogReader(r.log_paths()[sidx])
@@ -74,7 +85,8 @@ def setup_data_readers(
         assert device_type != "neo", "Driver camera not supported on neo segments. Use dummy dcamera."
         frs['driverCameraState'] = FrameReader(r.dcamera_paths()[sidx])
   else:
-    lr = LogReader(f"{route}/{sidx}/r")
+    log_path = LogReader(f"{route}/{sidx}/r").logreader_identifiers[0]
+    lr = read_stored_log(LogStore().get(f"{route}/{sidx}/r", log_path))
     frs = {}
     if needs_road_cam:
       frs['roadCameraState'] = FrameReader(f"cd:/{route.replace('|', '/')}/{sidx}/fcamera.hevc")
@@ -93,7 +105,8 @@ def setup_data_readers(
 
 def regen_and_save(
   route: str, sidx: int, processes: str | Iterable[str] = "all", outdir: str = FAKEDATA,
-  upload: bool = False, use_route_meta: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False
+  upload: bool = False, use_route_meta: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False,
+  offline_modeld: bool = False
 ) -> str:
   if not isinstance(processes, str) and not hasattr(processes, "__iter__"):
     raise ValueError("whitelist_proc must be a string or iterable")
@@ -114,7 +127,7 @@ def regen_and_save(
                                needs_driver_cam="driverCameraState" in all_vision_pubs,
                                needs_road_cam="roadCameraState" in all_vision_pubs or "wideRoadCameraState" in all_vision_pubs,
                                dummy_driver_cam=dummy_driver_cam)
-  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm, offline_modeld=offline_modeld)
 
   log_dir = os.path.join(outdir, time.strftime("%Y-%m-%d--%H-%M-%S--0", time.gmtime()))
   rel_log_dir = os.path.relpath(log_dir)
@@ -146,6 +159,7 @@ if __name__ == "__main__":
   parser.add_argument("--upload", action="store_true", help="Upload the new segment to the CI bucket")
   parser.add_argument("--outdir", help="log output dir", default=FAKEDATA)
   parser.add_argument("--dummy-dcamera", action='store_true', help="Use dummy blank driver camera")
+  parser.add_argument("--offline-modeld", action='store_true', help="Run modeld offline in batches, instead of through process replay")
   parser.add_argument("--whitelist-procs", type=comma_separated_list, default=all_procs,
                       help="Comma-separated whitelist of processes to regen (e.g. controlsd,radard)")
   parser.add_argument("--blacklist-procs", type=comma_separated_list, default=[],
@@ -156,4 +170,5 @@ if __name__ == "__main__":
 
   blacklist_set = set(args.blacklist_procs)
   processes = [p for p in args.whitelist_procs if p not in blacklist_set]
-  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera)
+  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera,
+                 offline_modeld=args.offline_modeld)
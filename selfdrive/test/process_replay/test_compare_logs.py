@@ -0,0 +1,113 @@
+import math
+import numbers
+import random
+import dictdiffer
+import pytest
+
+from cereal import log
+from openpilot.selfdrive.test.process_replay.compare_logs import EPSILON, compare_logs
+
+NAN = float("nan")
+VALUES = [0., 1., 1.5, 1.515625, NAN, float("inf")]
+
+
+def dictdiffer_compare_logs(log1, log2, ignore_fields, tolerance):
+  # compare_logs before it walked the schema: ignored fields zeroed, then dictdiffer on the dicts
+  diff = []
+  for msg1, msg2 in zip(log1, log2, strict=True):
+    msgs = []
+    for msg in (msg1, msg2):
+      msg = msg.as_builder()
+      for key in ignore_fields:
+        keys = key.split(".")
+        if msg.which() != keys[0] and len(keys) > 1:
+          continue
+        attr = msg
+        for k in keys[:-1]:
+          attr = attr[int(k)] if k.isdigit() else getattr(attr, k)
+        v = getattr(attr, keys[-1])
+        setattr(attr, keys[-1], False if isinstance(v, bool) else (0 if isinstance(v, numbers.Number) else []))
+      msgs.append(msg.as_reader().to_dict(verbose=True))
+
+    def outside_tolerance(d):
+      try:
+        if d[0] == "change":
+          a, b = d[2]
+          if math.isfinite(a) and math.isfinite(b) and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+            return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+      except TypeError:
+        pass
+      return True
+    diff.extend(filter(outside_tolerance, dictdiffer.diff(*msgs, ignore=ignore_fields)))
+  return diff
+
+
+def calibration(rpy, **kwargs):
+  return log.Event.new_message(liveCalibration={"rpyCalib": rpy, **kwargs}).as_reader()
+
+
+def sensor(which, value, timestamp=0):
+  return log.Event.new_message(sensorEvent={which: value, "timestamp": timestamp}).as_reader()
+
+
+class TestCompareLogs:
+  def test_tolerance(self):
+    ref, new = [calibration([0., 1.5])], [calibration([0., 1.515625])]
+    assert compare_logs(ref, new, tolerance=0.02) == []
+    assert compare_logs(ref, new, tolerance=1e-3) == [("change", ["liveCalibration", "rpyCalib", 1], (1.5, 1.515625))]
+    # relative to the larger value, and at least the tolerance itself
+    assert compare_logs([calibration([0.])], [calibration([0.015625])], tolerance=0.02) == []
+
+  def test_ignore(self):
+    ref = [calibration([0., 1.], calPerc=10), sensor("acceleration", {"v": [1., 2.]})]
+    new = [calibration([1., 1.], calPerc=20), sensor("acceleration", {"v": [1., 3.]})]
+    assert len(compare_logs(ref, new)) == 3
+    assert compare_logs(ref, new, ["liveCalibration.rpyCalib", "liveCalibration.calPerc", "sensorEvent.acceleration.v"]) == []
+    assert compare_logs(ref, new, ["liveCalibration.rpyCalib"]) == [("change", "liveCalibration.calPerc", (10, 20)),
+                                                                    ("change", ["sensorEvent", "acceleration", "v", 1], (2., 3.))]
+
+  def test_list_add_remove(self):
+    assert compare_logs([calibration([1., 2.])], [calibration([1., 2., 3.])]) == [("add", "liveCalibration.rpyCalib", [(2, 3.)])]
+    # changes come first, removed items are listed last index first
+    assert compare_logs([calibration([1., 2., 3., 4.])], [calibration([5., 2.])]) == [
+      ("change", ["liveCalibration", "rpyCalib", 0], (1., 5.)),
+      ("remove", "liveCalibration.rpyCalib", [(3, 4.), (2, 3.)]),
+    ]
+
+  def test_union(self):
+    diff = compare_logs([sensor("acceleration", {"v": [1.]}, timestamp=1)], [sensor("gyro", {"v": [1.]}, timestamp=2)])
+    assert diff == [
+      ("change", "sensorEvent.timestamp", (1, 2)),
+      ("add", "sensorEvent", [("gyro", {"v": [1.], "status": 0})]),
+      ("remove", "sensorEvent", [("acceleration", {"v": [1.], "status": 0})]),
+    ]
+
+  def test_nan(self):
+    # nan is equal to nan, in lists and in fields of structs that differ elsewhere
+    assert compare_logs([calibration([NAN, 1.])], [calibration([NAN, 1.])]) == []
+    assert compare_logs([calibration([NAN, 1.])], [calibration([NAN, 2.])]) == [("change", ["liveCalibration", "rpyCalib", 1], (1., 2.))]
+    assert compare_logs([sensor("light", NAN, timestamp=1)], [sensor("light", NAN, timestamp=2)]) == [("change", "sensorEvent.timestamp", (1, 2))]
+
+    diff = compare_logs([calibration([NAN])], [calibration([1.])])
+    assert len(diff) == 1 and math.isnan(diff[0][2][0])
+
+  @pytest.mark.parametrize("tolerance", [EPSILON, 1e-2])
+  def test_matches_dictdiffer(self, tolerance):
+    rng = random.Random(0)
+
+    def random_event():
+      if rng.random() < 0.5:
+        return calibration([rng.choice(VALUES) for _ in range(rng.randint(0, 4))], calPerc=rng.choice([0, 50]),
+                           calStatus=rng.choice(["uncalibrated", "calibrated"]))
+      which = rng.choice(["acceleration", "gyro", "light"])
+      value = rng.choice(VALUES) if which == "light" else {"v": [rng.choice(VALUES) for _ in range(rng.randint(0, 3))]}
+      return sensor(which, value, timestamp=rng.choice([0, 1]))
+
+    ref = [random_event() for _ in range(2000)]
+    new = [m if rng.random() < 0.2 else random_event() for m in ref]
+    # only pairs of the same service are compared
+    ref, new = zip(*[(a, b) for a, b in zip(ref, new, strict=True) if a.which() == b.which()], strict=True)
+
+    for ignore in ([], ["liveCalibration.calPerc", "sensorEvent.timestamp"]):
+      # repr, so nans compare equal
+      assert repr(compare_logs(ref, new, ignore, tolerance=tolerance)) == repr(dictdiffer_compare_logs(ref, new, ignore, tolerance))
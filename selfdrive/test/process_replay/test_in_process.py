@@ -0,0 +1,29 @@
+import copy
+import gc
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_process_diff
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, IN_PROCESS_PROCS, replay_process
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+TEST_SEGMENT = dict(segments)["TOYOTA"]
+
+
+class TestInProcessReplay:
+  @classmethod
+  def setup_class(cls):
+    cls.lr = list(LogReader(get_url(*TEST_SEGMENT.rsplit("--", 1), "rlog.zst")))
+
+  @parameterized.expand(sorted(IN_PROCESS_PROCS))
+  def test_matches_msgq_replay(self, proc_name):
+    cfg = next(c for c in CONFIGS if c.proc_name == proc_name)
+    ref = replay_process(copy.deepcopy(cfg), self.lr, disable_progress=True)
+    new = replay_process(copy.deepcopy(cfg), self.lr, disable_progress=True, in_process=True)
+
+    # daemons that disable gc or raise their priority mustn't do it to the replaying process
+    assert gc.isenabled()
+    assert len(new) == len(ref)
+    diff = compare_logs(ref, new, cfg.ignore, tolerance=cfg.tolerance)
+    assert len(diff) == 0, format_process_diff(diff)[0]
@@ -0,0 +1,39 @@
+import os
+
+from openpilot.selfdrive.test.process_replay.log_store import LogStore
+from openpilot.tools.lib.cache import ManagedCache
+
+
+class TestLogStore:
+  def test_shared_objects(self, tmp_path):
+    root = str(tmp_path / "store")
+    store = LogStore(root)
+    # room for two objects
+    store.cache = ManagedCache(root, max_bytes=250)
+
+    fns = {}
+    for name, dat in [("x1", b"x" * 100), ("x2", b"x" * 100), ("y", b"y" * 100), ("z", b"z" * 100)]:
+      fns[name] = str(tmp_path / name)
+      with open(fns[name], "wb") as f:
+        f.write(dat)
+
+    # keys with the same content share an object, which only counts once
+    x1, x2 = store.get("x1", fns["x1"]), store.get("x2", fns["x2"])
+    assert x1 == x2
+    assert store.get("y", fns["y"]) != x1
+    stats = store.stats()
+    assert stats["entries"] == 2
+    assert stats["size"] == 200
+    assert all(store.lookup(k) is not None for k in ("x1", "x2", "y"))
+
+    # evicting the object misses for every key that points to it
+    z = store.get("z", fns["z"])
+    assert not os.path.exists(x1)
+    assert store.lookup("x1") is None and store.lookup("x2") is None
+    assert store.lookup("y") is not None and store.lookup("z") == z
+
+    assert store.get("x2", fns["x2"]) == x1
+    with open(x1, "rb") as f:
+      assert f.read() == b"x" * 100
+    assert store.lookup("x1") == x1
+    assert store.stats()["misses"] == 5
@@ -0,0 +1,93 @@
+import os
+import time
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.migration import migrate, migrated_log_path, migration
+
+
+def msg(which, t, **kwargs):
+  m = messaging.new_message(which, **kwargs)
+  m.logMonoTime = t
+  return m.as_reader()
+
+
+def names(lr):
+  return [(m.which(), m.logMonoTime) for m in lr]
+
+
+calls: list[str] = []
+
+
+@migration(inputs=["carControl"], product="carOutput")
+def add_carOutput(msgs):
+  calls.append("add_carOutput")
+  return [], [msg("carOutput", m.logMonoTime) for _, m in msgs], []
+
+
+@migration(inputs=["liveTracksDEPRECATED"], product="liveTracks")
+def add_liveTracks(msgs):
+  calls.append("add_liveTracks")
+  return [], [msg("liveTracks", m.logMonoTime) for _, m in msgs], []
+
+
+@migration(inputs=["carState", "carControl"])
+def shift_carState(msgs):
+  # replacements can move a message
+  calls.append("shift_carState")
+  return [(i, msg("carState", m.logMonoTime + 25)) for i, m in msgs if m.which() == "carState"], [], []
+
+
+@migration(inputs=["deviceState"])
+def delete_deviceState(msgs):
+  calls.append("delete_deviceState")
+  return [], [], [i for i, _ in msgs]
+
+
+class TestMigration:
+  def setup_method(self):
+    calls.clear()
+
+  def test_skipped_migrations(self):
+    lr = [msg("carControl", 10), msg("carOutput", 10), msg("deviceState", 20)]
+    # the product already exists, and no inputs to migrate
+    assert names(migrate(lr, [add_carOutput, add_liveTracks])) == names(lr)
+    assert calls == []
+
+    assert names(migrate(lr, [add_carOutput, add_liveTracks, delete_deviceState])) == [("carControl", 10), ("carOutput", 10)]
+    assert calls == ["delete_deviceState"]
+
+  def test_merge_order(self):
+    lr = [msg("carControl", 10), msg("carState", 10), msg("deviceState", 15), msg("carControl", 20)]
+    # added messages go after originals with the same logMonoTime
+    assert names(migrate(lr, [add_carOutput, delete_deviceState])) == [
+      ("carControl", 10), ("carState", 10), ("carOutput", 10), ("carControl", 20), ("carOutput", 20),
+    ]
+
+    # a replacement that's no longer in order
+    assert names(migrate(lr, [add_carOutput, shift_carState])) == [
+      ("carControl", 10), ("carOutput", 10), ("deviceState", 15), ("carControl", 20), ("carOutput", 20), ("carState", 35),
+    ]
+
+    # unsorted logs come out sorted, stable on equal logMonoTime
+    assert names(migrate(lr[::-1], [add_carOutput])) == [
+      ("carState", 10), ("carControl", 10), ("carOutput", 10), ("deviceState", 15), ("carControl", 20), ("carOutput", 20),
+    ]
+    assert names(migrate(lr[::-1], [])) == [("carState", 10), ("carControl", 10), ("deviceState", 15), ("carControl", 20)]
+
+  def test_cache_key(self, tmp_path):
+    fn = str(tmp_path / "rlog.zst")
+    with open(fn, "wb") as f:
+      f.write(b"\x00")
+    path = migrated_log_path(fn, [add_carOutput], str(tmp_path))
+    assert migrated_log_path(fn, [add_carOutput], str(tmp_path)) == path
+    assert migrated_log_path(fn, [add_carOutput, shift_carState], str(tmp_path)) != path
+
+    # rewriting a local log invalidates its migrated log
+    with open(fn, "wb") as f:
+      f.write(b"\x00\x01")
+    os.utime(fn, ns=(time.time_ns(), time.time_ns() + 10**9))
+    assert migrated_log_path(fn, [add_carOutput], str(tmp_path)) != path
+
+    # remote logs are keyed on the url only
+    url = "https://example.com/rlog.zst"
+    assert migrated_log_path(url, [add_carOutput], str(tmp_path)) == migrated_log_path(url, [add_carOutput], str(tmp_path))
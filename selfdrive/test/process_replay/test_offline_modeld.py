@@ -0,0 +1,72 @@
+import copy
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_process_diff
+from openpilot.selfdrive.test.process_replay.offline_modeld import MAX_BATCH_SIZE, OfflineModeld, run_offline_modeld
+from openpilot.selfdrive.test.process_replay.process_replay import get_process_config, replay_process
+from openpilot.selfdrive.test.process_replay.test_regen import TESTED_SEGMENTS, ci_setup_data_readers
+
+
+def force_lane_change(lr, start, end):
+  # left blinker from start, steering torque a second later, and lateral control active until end (in seconds)
+  lr = sorted(lr, key=lambda m: m.logMonoTime)
+  t0 = lr[0].logMonoTime
+  out = []
+  for msg in lr:
+    t = (msg.logMonoTime - t0) * 1e-9
+    if msg.which() in ("carState", "carControl") and start <= t < end:
+      msg = msg.as_builder()
+      if msg.which() == "carState":
+        msg.carState.vEgo = max(msg.carState.vEgo, 20.)
+        msg.carState.leftBlinker, msg.carState.rightBlinker = True, False
+        msg.carState.leftBlindspot = False
+        msg.carState.steeringPressed = t >= start + 1
+        msg.carState.steeringTorque = 100.
+      else:
+        msg.carControl.latActive = True
+      msg = msg.as_reader()
+    out.append(msg)
+  return out
+
+
+class TestOfflineModeld:
+  @classmethod
+  def setup_class(cls):
+    route, sidx = TESTED_SEGMENTS[0][1].rsplit("--", 1)
+    lr, cls.frs = ci_setup_data_readers(route, sidx)
+    cls.lr = list(lr)
+
+  def _compare(self, lr, cfg, batch_size):
+    ref = replay_process(cfg, lr, self.frs, disable_progress=True)
+    new = run_offline_modeld(lr, self.frs, batch_size, cfg)
+    for service in cfg.subs:
+      ref_msgs = [m for m in ref if m.which() == service]
+      new_msgs = [m for m in new if m.which() == service]
+      assert len(ref_msgs) == len(new_msgs) > 0
+      assert [m.logMonoTime for m in ref_msgs] == [m.logMonoTime for m in new_msgs]
+      diff = compare_logs(ref_msgs, new_msgs, cfg.ignore, tolerance=cfg.tolerance)
+      assert len(diff) == 0, format_process_diff(diff)[0]
+    return new
+
+  @parameterized.expand([(1,), (MAX_BATCH_SIZE,)])
+  def test_matches_process_replay(self, batch_size):
+    self._compare(self.lr, get_process_config("modeld"), batch_size)
+
+  def test_desire_change(self, monkeypatch):
+    # modeld's process config doesn't pass carControl, which lateral control, and so desire, depends on
+    cfg = copy.deepcopy(get_process_config("modeld"))
+    cfg.pubs = [*cfg.pubs, "carControl"]
+
+    executed = []
+    execute = OfflineModeld._execute
+
+    def counted_execute(self, inputs):
+      executed.append(inputs)
+      return execute(self, inputs)
+    monkeypatch.setattr(OfflineModeld, "_execute", counted_execute)
+
+    new = self._compare(force_lane_change(self.lr, 10., 25.), cfg, MAX_BATCH_SIZE)
+    lane_change_states = {str(m.modelV2.meta.laneChangeState) for m in new if m.which() == "modelV2"}
+    assert "laneChangeStarting" in lane_change_states
+    # frames after a desire change within a batch are run again
+    assert len(executed) > sum(m.which() == "modelV2" for m in new)
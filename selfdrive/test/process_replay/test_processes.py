@@ -3,7 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import sys
-from collections import defaultdict
+from collections import Counter, defaultdict
 from tqdm import tqdm
 from typing import Any
 
@@ -12,9 +12,9 @@ from openpilot.common.git import get_commit
 from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
-                                                                   check_most_messages_valid
-from openpilot.tools.lib.filereader import FileReader
-from openpilot.tools.lib.logreader import LogReader, save_log
+                                                                   replay_sharded, check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.log_store import LogStore, read_stored_log
+from openpilot.tools.lib.logreader import save_log
 
 source_segments = [
   ("BODY", "937ccb7243511b65|2022-05-24--16-03-09--1"),        # COMMA.COMMA_BODY
@@ -68,11 +68,13 @@ EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
+  segment, cfg, args, cur_log_fn, ref_log_path, lr_path = data
   res = None
+  stats: dict[str, float] = {}
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    lr = read_stored_log(lr_path)
+    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, stats,
+                                 args.in_process)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -81,25 +83,38 @@ def run_test_process(data):
     assert os.path.exists(cur_log_fn), f"Cannot find log to upload: {cur_log_fn}"
     upload_file(cur_log_fn, os.path.basename(cur_log_fn))
     os.remove(cur_log_fn)
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, stats)
 
 
 def get_log_data(segment):
   r, n = segment.rsplit("--", 1)
-  with FileReader(get_url(r, n, "rlog.zst")) as f:
-    return (segment, f.read())
+  path = LogStore().get(segment, get_url(r, n, "rlog.zst"))
+  # message counts per service, used to schedule the most expensive replays first
+  counts = Counter(m.which() for m in read_stored_log(path))
+  return (segment, path, counts)
 
 
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+def get_ref_log(ref_log_path):
+  # remote reference logs are immutable, their url has the segment, process and ref commit
+  key = ref_log_path
+  if os.path.exists(ref_log_path):
+    key += f"@{os.path.getmtime(ref_log_path)}"
+  return read_stored_log(LogStore().get(key, ref_log_path))
+
+
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, stats=None, in_process=False):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
 
-  ref_log_msgs = list(LogReader(ref_log_path))
+  ref_log_msgs = get_ref_log(ref_log_path)
 
   try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
+    replay_stats: dict[str, dict[str, float]] = {}
+    log_msgs = replay_process(cfg, lr, disable_progress=True, replay_stats_store=replay_stats, in_process=in_process)
+    if stats is not None:
+      stats.update(replay_stats.get(cfg.proc_name, {}))
   except Exception as e:
     raise Exception("failed on segment: " + segment) from e
 
@@ -142,6 +157,8 @@ if __name__ == "__main__":
                       help="Updates reference logs using current commit")
   parser.add_argument("--upload-only", action="store_true",
                       help="Skips testing processes and uploads logs from previous test run")
+  parser.add_argument("--in-process", action="store_true",
+                      help="Replay pure python daemons (e.g. radard) in the test process instead of spawning them")
   parser.add_argument("-j", "--jobs", type=int, default=max(cpu_count - 2, 1),
                       help="Max amount of parallel jobs")
   args = parser.parse_args()
@@ -176,45 +193,56 @@ if __name__ == "__main__":
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
-  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    if not args.upload_only:
-      download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
+  log_data: dict[str, str] = {}
+  log_counts: dict[str, Counter] = defaultdict(Counter)
+  store_stats = LogStore().stats()
+  if not args.upload_only:
+    download_segments = [seg for car, seg in segments if car in tested_cars]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
       p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
-
-    pool_args: Any = []
-    for car_brand, segment in segments:
-      if car_brand not in tested_cars:
+      for segment, path, counts in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
+        log_data[segment] = path
+        log_counts[segment] = counts
+
+  pool_args: Any = []
+  pool_costs: list[int] = []
+  for car_brand, segment in segments:
+    if car_brand not in tested_cars:
+      continue
+
+    for cfg in CONFIGS:
+      if cfg.proc_name not in tested_procs:
         continue
 
-      for cfg in CONFIGS:
-        if cfg.proc_name not in tested_procs:
-          continue
-
-        # to speed things up, we only test all segments on card
-        if cfg.proc_name != 'card' and car_brand not in ('HYUNDAI', 'TOYOTA', 'HONDA', 'SUBARU', 'FORD'):
-          continue
-
-        cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
-        if args.update_refs:  # reference logs will not exist if routes were just regenerated
-          ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
-        else:
-          ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
-          ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
-
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
-
-        log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
-        log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
+      # to speed things up, we only test all segments on card
+      if cfg.proc_name != 'card' and car_brand not in ('HYUNDAI', 'TOYOTA', 'HONDA', 'SUBARU', 'FORD'):
+        continue
 
-    results: Any = defaultdict(dict)
-    p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
-      if not args.upload_only:
-        results[segment][proc] = result
+      cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
+      if args.update_refs:  # reference logs will not exist if routes were just regenerated
+        ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
+      else:
+        ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
+        ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
+
+      dat = None if args.upload_only else log_data[segment]
+      pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+      pool_costs.append(sum(log_counts[segment][pub] for pub in cfg.pubs))
+
+      log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
+      log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
+
+  results: Any = defaultdict(dict)
+  proc_msgs: Counter = Counter()
+  proc_seconds: Counter = Counter()
+  proc_latency: defaultdict[str, float] = defaultdict(float)
+  p2 = replay_sharded(run_test_process, pool_args, pool_costs, args.jobs)
+  for (segment, proc, result, stats) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
+    if not args.upload_only:
+      results[segment][proc] = result
+      proc_msgs[proc] += stats.get("msgs", 0)
+      proc_seconds[proc] += stats.get("seconds", 0.)
+      proc_latency[proc] = max(proc_latency[proc], stats.get("latency_p99", 0.))
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
@@ -222,6 +250,15 @@ if __name__ == "__main__":
       f.write(diff_long)
     print(diff_short)
 
+    print("\nReplay throughput:")
+    for proc in sorted(proc_msgs):
+      rate = proc_msgs[proc] / proc_seconds[proc] if proc_seconds[proc] > 0 else 0.
+      print(f"  {proc:<20} {proc_msgs[proc]:>8} msgs  {rate:>10.1f} msgs/sec  {proc_latency[proc] * 1e3:>8.2f} ms p99 step")
+
+    new_store_stats = LogStore().stats()
+    hits, misses = (new_store_stats[k] - store_stats[k] for k in ("hits", "misses"))
+    print(f"\nLog store: {hits} hits, {misses} misses ({new_store_stats['size'] / 1e6:.1f} MB stored)")
+
     if failed:
       print("TEST FAILED")
       print("\n\nTo push the new reference logs for this commit run:")
@@ -37,6 +37,14 @@ class Paths:
       return os.environ['COMMA_CACHE'] + "/"
     return DEFAULT_DOWNLOAD_CACHE_ROOT + os.environ.get("OPENPILOT_PREFIX", "") + "/"
 
+  @staticmethod
+  def model_cache_root() -> str:
+    # content addressed, so shared across OPENPILOT_PREFIXes
+    if PC:
+      return os.path.join(str(Path.home()), ".comma", "model_cache")
+    else:
+      return "/data/model_cache/"
+
   @staticmethod
   def persist_root() -> str:
     if PC:
@@ -23,11 +23,20 @@ def main() -> NoReturn:
 
   try:
     while True:
-      dat = b''.join(sock.recv_multipart())
-      level = dat[0]
-      record = dat[1:].decode("utf-8")
+      frames = sock.recv_multipart()
+      if len(frames) == 3:
+        # python records, split before the msg value so the file writer only decodes msg
+        level = frames[0][0]
+        prefix, msg = frames[1].decode("utf-8"), frames[2].decode("utf-8")
+        record = prefix + msg + "}"
+        file_record = (prefix, msg)
+      else:
+        dat = b''.join(frames)
+        level = dat[0]
+        record = file_record = dat[1:].decode("utf-8")
+
       if level >= log_level:
-        log_handler.emit(record)
+        log_handler.emit(file_record)
 
       if len(record) > 2*1024*1024:
         print("WARNING: log too big to publish", len(record))
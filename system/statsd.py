@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import os
 import zmq
+import math
 import time
 import uuid
+import atexit
+import bisect
+import threading
+import numpy as np
 from pathlib import Path
-from collections import defaultdict
 from datetime import datetime, UTC
 from typing import NoReturn
+from collections.abc import Iterator, Sequence
 
 from openpilot.common.params import Params
 from cereal.messaging import SubMaster
@@ -15,18 +20,244 @@ from openpilot.common.swaglog import cloudlog
 from openpilot.system.hardware import HARDWARE
 from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.version import get_build_metadata
-from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET, STATS_FLUSH_TIME_S
+from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET, STATS_FLUSH_TIME_S, STATS_CLIENT_FLUSH_TIME_S
+
+STATS_PROTOCOL_VERSION = 1
+
+# A batch is sent as two frames: a version byte followed by the null separated metric names,
+# and an array of fixed-size records referencing those names by index.
+# key is the bucket index for sketches, and the bucket count for histograms (value is then the upper bound)
+RECORD_DTYPE = np.dtype([('metric', '<u2'), ('type', 'u1'), ('field', 'u1'), ('key', '<i4'), ('value', '<f8')])
+
+DEFAULT_HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
 
 
 class METRIC_TYPE:
-  GAUGE = 'g'
-  SAMPLE = 'sa'
+  GAUGE = 0
+  SAMPLE = 1
+  HISTOGRAM = 2
+
+class FIELD:
+  VALUE = 0
+  COUNT = 1
+  SUM = 2
+  MIN = 3
+  MAX = 4
+  BUCKET = 5
+  NEG_BUCKET = 6
+
+
+class _Distribution:
+  def __init__(self):
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def _add_stats(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+  def _stats_records(self) -> Iterator[tuple[int, int, float]]:
+    yield FIELD.COUNT, 0, self.count
+    yield FIELD.SUM, 0, self.sum
+    yield FIELD.MIN, 0, self.min
+    yield FIELD.MAX, 0, self.max
+
+  def _merge_stats(self, field: int, value: float) -> bool:
+    if field == FIELD.COUNT:
+      self.count += int(value)
+    elif field == FIELD.SUM:
+      self.sum += value
+    elif field == FIELD.MIN:
+      self.min = min(self.min, value)
+    elif field == FIELD.MAX:
+      self.max = max(self.max, value)
+    else:
+      return False
+    return True
+
+
+class QuantileSketch(_Distribution):
+  """
+  DDSketch: values are counted in log-spaced buckets, so quantiles are within relative_accuracy of the
+  exact value. Past max_buckets the buckets closest to zero are collapsed, keeping memory bounded.
+  """
+  MIN_VALUE = 1e-9
+
+  def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+    super().__init__()
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_buckets = max_buckets
+    self.pos: dict[int, int] = {}
+    self.neg: dict[int, int] = {}
+
+  def _key(self, value: float) -> int:
+    return math.ceil(math.log(value) / self.log_gamma)
+
+  def _value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def _add_bucket(self, buckets: dict[int, int], key: int, count: int) -> None:
+    buckets[key] = buckets.get(key, 0) + count
+    if len(buckets) > self.max_buckets:
+      lowest = min(buckets)
+      count = buckets.pop(lowest)
+      buckets[min(buckets)] += count
+
+  def add(self, value: float) -> None:
+    self._add_stats(value)
+    if value > self.MIN_VALUE:
+      self._add_bucket(self.pos, self._key(value), 1)
+    elif value < -self.MIN_VALUE:
+      self._add_bucket(self.neg, self._key(-value), 1)
+
+  def records(self) -> Iterator[tuple[int, int, float]]:
+    yield from self._stats_records()
+    for key, count in self.pos.items():
+      yield FIELD.BUCKET, key, count
+    for key, count in self.neg.items():
+      yield FIELD.NEG_BUCKET, key, count
+
+  def merge_record(self, field: int, key: int, value: float) -> None:
+    if field == FIELD.BUCKET:
+      self._add_bucket(self.pos, key, int(value))
+    elif field == FIELD.NEG_BUCKET:
+      self._add_bucket(self.neg, key, int(value))
+    elif not self._merge_stats(field, value):
+      raise ValueError(f"unknown sample field {field}")
+
+  def quantiles(self, qs: Sequence[float]) -> list[float]:
+    """Same ranks as indexing the sorted values at round(q * (count - 1)), qs must be ascending"""
+    if self.count == 0:
+      return [math.nan] * len(qs)
+
+    zeros = self.count - sum(self.pos.values()) - sum(self.neg.values())
+    buckets = [(-self._value(k), self.neg[k]) for k in sorted(self.neg, reverse=True)]
+    buckets.append((0., zeros))
+    buckets += [(self._value(k), self.pos[k]) for k in sorted(self.pos)]
+
+    res = []
+    it = iter(buckets)
+    value, seen = next(it)
+    for q in qs:
+      rank = int(round(q * (self.count - 1)))
+      while seen <= rank:
+        value, count = next(it, (self.max, math.inf))
+        seen += count
+      res.append(min(max(value, self.min), self.max))
+    return res
+
+
+class Histogram(_Distribution):
+  """
+  Counts per upper bound, values above every bound go to the inf bucket. Buckets merged from
+  other histograms add new bounds up to MAX_BUCKETS, after that they count towards the next bound.
+  """
+  MAX_BUCKETS = 64
+
+  def __init__(self, bounds: Sequence[float] = ()):
+    super().__init__()
+    self.bounds = sorted(bounds)[:self.MAX_BUCKETS - 1] + [math.inf]
+    self.counts = [0] * len(self.bounds)
+
+  def add(self, value: float) -> None:
+    self._add_stats(value)
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+  def records(self) -> Iterator[tuple[int, int, float]]:
+    yield from self._stats_records()
+    for bound, count in zip(self.bounds, self.counts, strict=True):
+      if count > 0:
+        yield FIELD.BUCKET, count, bound
+
+  def merge_record(self, field: int, key: int, value: float) -> None:
+    if field == FIELD.BUCKET:
+      i = bisect.bisect_left(self.bounds, value)
+      if self.bounds[i] != value and len(self.bounds) < self.MAX_BUCKETS:
+        self.bounds.insert(i, value)
+        self.counts.insert(i, 0)
+      self.counts[i] += key
+    elif not self._merge_stats(field, value):
+      raise ValueError(f"unknown histogram field {field}")
+
+
+class Metrics:
+  """Metrics aggregated over a window, by the clients before sending and by the aggregator before flushing"""
+  def __init__(self):
+    self.gauges: dict[str, float] = {}
+    self.samples: dict[str, QuantileSketch] = {}
+    self.histograms: dict[str, Histogram] = {}
+
+  def __len__(self) -> int:
+    return len(self.gauges) + len(self.samples) + len(self.histograms)
+
+  def clear(self) -> None:
+    self.gauges.clear()
+    self.samples.clear()
+    self.histograms.clear()
+
+  def gauge(self, name: str, value: float) -> None:
+    self.gauges[name] = value
+
+  def sample(self, name: str, value: float) -> None:
+    if name not in self.samples:
+      self.samples[name] = QuantileSketch()
+    self.samples[name].add(value)
+
+  def histogram(self, name: str, value: float, bounds: Sequence[float] = DEFAULT_HISTOGRAM_BOUNDS) -> None:
+    if name not in self.histograms:
+      self.histograms[name] = Histogram(bounds)
+    self.histograms[name].add(value)
+
+  def encode(self) -> list[bytes]:
+    names: list[str] = []
+    records = []
+    for name, value in self.gauges.items():
+      records.append((len(names), METRIC_TYPE.GAUGE, FIELD.VALUE, 0, value))
+      names.append(name)
+    for metric_type, metrics in ((METRIC_TYPE.SAMPLE, self.samples), (METRIC_TYPE.HISTOGRAM, self.histograms)):
+      for name, metric in metrics.items():
+        records += [(len(names), metric_type, field, key, value) for field, key, value in metric.records()]
+        names.append(name)
+
+    header = bytes([STATS_PROTOCOL_VERSION]) + "\0".join(names).encode()
+    return [header, np.array(records, dtype=RECORD_DTYPE).tobytes()]
+
+  def merge(self, frames: list[bytes]) -> None:
+    header, data = frames
+    if header[0] != STATS_PROTOCOL_VERSION:
+      raise ValueError(f"unknown protocol version {header[0]}")
+    names = header[1:].decode().split("\0")
+
+    for idx, metric_type, field, key, value in np.frombuffer(data, dtype=RECORD_DTYPE).tolist():
+      name = names[idx]
+      if metric_type == METRIC_TYPE.GAUGE:
+        self.gauges[name] = value
+      elif metric_type == METRIC_TYPE.SAMPLE:
+        if name not in self.samples:
+          self.samples[name] = QuantileSketch()
+        self.samples[name].merge_record(field, key, value)
+      elif metric_type == METRIC_TYPE.HISTOGRAM:
+        if name not in self.histograms:
+          self.histograms[name] = Histogram()
+        self.histograms[name].merge_record(field, key, value)
+      else:
+        raise ValueError(f"unknown metric type {metric_type}")
+
 
 class StatLog:
   def __init__(self):
     self.pid = None
     self.zctx = None
     self.sock = None
+    self.metrics = Metrics()
+    self.last_flush_time = 0.
+    self.lock = threading.Lock()
+    atexit.register(self.flush)
 
   def connect(self) -> None:
     self.zctx = zmq.Context()
@@ -35,29 +266,69 @@ class StatLog:
     self.sock.connect(STATS_SOCKET)
     self.pid = os.getpid()
 
+    # anything aggregated before a fork is sent by the parent, the lock may have been held by its threads
+    self.lock = threading.Lock()
+    self.metrics.clear()
+    self.last_flush_time = time.monotonic()
+    threading.Thread(target=self._flush_thread, name="statlog_flush", daemon=True).start()
+
   def __del__(self):
     if self.sock is not None:
       self.sock.close()
     if self.zctx is not None:
       self.zctx.term()
 
-  def _send(self, metric: str) -> None:
+  def _get_metrics(self) -> Metrics:
     if os.getpid() != self.pid:
       self.connect()
+    return self.metrics
+
+  def _flush_thread(self) -> None:
+    # sends windows that no later metric would, so a quiet or killed process loses at most one window
+    while True:
+      time.sleep(max(self.last_flush_time + STATS_CLIENT_FLUSH_TIME_S - time.monotonic(), 0.01))
+      self._maybe_flush()
+
+  def _maybe_flush(self) -> None:
+    if time.monotonic() > self.last_flush_time + STATS_CLIENT_FLUSH_TIME_S:
+      self.flush()
 
-    try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
-    except zmq.error.Again:
-      # drop :/
-      pass
+  def flush(self) -> None:
+    if os.getpid() != self.pid:
+      return
+
+    with self.lock:
+      self.last_flush_time = time.monotonic()
+      if len(self.metrics) == 0:
+        return
+
+      try:
+        self.sock.send_multipart(self.metrics.encode(), zmq.NOBLOCK)
+      except zmq.error.Again:
+        # drop :/
+        pass
+      self.metrics.clear()
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    metrics = self._get_metrics()
+    with self.lock:
+      metrics.gauge(name, value)
+    self._maybe_flush()
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples are aggregated into a quantile sketch and at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
-  def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+  def sample(self, name: str, value: float) -> None:
+    metrics = self._get_metrics()
+    with self.lock:
+      metrics.sample(name, value)
+    self._maybe_flush()
+
+  # Histograms count values per bucket, bounds are the upper bounds of the buckets
+  def histogram(self, name: str, value: float, bounds: Sequence[float] = DEFAULT_HISTOGRAM_BOUNDS) -> None:
+    metrics = self._get_metrics()
+    with self.lock:
+      metrics.histogram(name, value, bounds)
+    self._maybe_flush()
 
 
 def main() -> NoReturn:
@@ -105,8 +376,7 @@ def main() -> NoReturn:
   idx = 0
   boot_uid = str(uuid.uuid4())[:8]
   last_flush_time = time.monotonic()
-  gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  metrics = Metrics()
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,52 +385,60 @@ def main() -> NoReturn:
       # Update metrics
       while True:
         try:
-          metric = sock.recv_string(zmq.NOBLOCK)
-          try:
-            metric_type = metric.split('|')[1]
-            metric_name = metric.split(':')[0]
-            metric_value = float(metric.split('|')[0].split(':')[1])
-
-            if metric_type == METRIC_TYPE.GAUGE:
-              gauges[metric_name] = metric_value
-            elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
-            else:
-              cloudlog.event("unknown metric type", metric_type=metric_type)
-          except Exception:
-            cloudlog.event("malformed metric", metric=metric)
+          frames = sock.recv_multipart(zmq.NOBLOCK)
         except zmq.error.Again:
           break
 
+        try:
+          metrics.merge(frames)
+        except Exception:
+          cloudlog.event("malformed metric", metric=b"".join(frames)[:256].hex())
+
       # flush when started state changes or after FLUSH_TIME_S
       if (time.monotonic() > last_flush_time + STATS_FLUSH_TIME_S) or (sm['deviceState'].started != started_prev):
         result = ""
         current_time = datetime.now(UTC)
         tags['started'] = sm['deviceState'].started
 
-        for key, value in gauges.items():
+        for key, value in metrics.gauges.items():
           result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
 
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
+        for key, sketch in metrics.samples.items():
+          if sketch.count == 0:
+            continue
 
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
-          for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
+          percentiles = [0.05, 0.5, 0.95]
+          for percentile, value in zip(percentiles, sketch.quantiles(percentiles), strict=True):
             stats[f"p{int(percentile * 100)}"] = value
 
           result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
 
+        for key, histogram in metrics.histograms.items():
+          if histogram.count == 0:
+            continue
+
+          stats = {
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'min': histogram.min,
+            'max': histogram.max,
+          }
+          # cumulative counts, like prometheus histograms
+          cumulative = 0
+          for bound, count in zip(histogram.bounds, histogram.counts, strict=True):
+            cumulative += count
+            stats[f"le_{bound:g}"] = cumulative
+
+          result += get_influxdb_line(f"histogram.{key}", stats, current_time, tags)
+
         # clear intermediate data
-        gauges.clear()
-        samples.clear()
+        metrics.clear()
         last_flush_time = time.monotonic()
 
         # check that we aren't filling up the drive
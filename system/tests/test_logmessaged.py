@@ -1,4 +1,5 @@
 import glob
+import json
 import os
 import time
 
@@ -40,6 +41,22 @@ class TestLogmessaged:
     assert len(m) == len(msgs)
     assert len(self._get_log_files()) >= 1
 
+  def test_event(self):
+    cloudlog.event("test_event", a=1, b="c")
+    time.sleep(0.5)
+    m = messaging.drain_sock(self.sock)
+    assert len(m) == 1
+    record = json.loads(m[0].logMessage)
+    assert record['msg'] == {'event': 'test_event', 'a': 1, 'b': 'c'}
+    assert record['funcName'] == 'test_event'
+
+    # file records are tagged with their types
+    logs = ""
+    for fn in self._get_log_files():
+      with open(fn) as f:
+        logs += f.read()
+    assert '"msg": {"event$s": "test_event", "a$i": 1, "b$s": "c"}' in logs
+
   def test_big_log(self):
     n = 10
     msg = "a"*3*1024*1024
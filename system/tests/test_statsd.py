@@ -0,0 +1,92 @@
+import numpy as np
+import zmq
+
+from openpilot.system import statsd
+from openpilot.system.statsd import Histogram, Metrics, QuantileSketch, StatLog
+
+
+class TestStatsd:
+  def test_sketch_quantiles(self):
+    values = np.random.default_rng(0).lognormal(0, 2, 10000)
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for v in values:
+      sketch.add(v)
+
+    qs = [0., 0.05, 0.5, 0.95, 1.]
+    expected = np.sort(values)[[int(round(q * (len(values) - 1))) for q in qs]]
+    np.testing.assert_allclose(sketch.quantiles(qs), expected, rtol=0.01)
+    assert sketch.count == len(values)
+    assert sketch.min == values.min() and sketch.max == values.max()
+
+  def test_sketch_bounded(self):
+    sketch = QuantileSketch(max_buckets=16)
+    values = np.logspace(-5, 5, 1000)
+    for v in values:
+      sketch.add(v)
+    assert len(sketch.pos) == 16
+    # collapsing only loses accuracy on the lowest quantiles
+    np.testing.assert_allclose(sketch.quantiles([0.99, 1.]), values[[989, 999]], rtol=0.01)
+
+  def test_sketch_negative(self):
+    values = np.random.default_rng(0).normal(0, 10, 1000)
+    sketch = QuantileSketch()
+    for v in values:
+      sketch.add(v)
+    sketch.add(0.)
+
+    values = np.sort(np.append(values, 0.))
+    p5, p50, p95 = sketch.quantiles([0.05, 0.5, 0.95])
+    assert abs(p5 - values[int(round(0.05 * (len(values) - 1)))]) < 0.2
+    assert abs(p50 - values[int(round(0.5 * (len(values) - 1)))]) < 0.2
+    assert abs(p95 - values[int(round(0.95 * (len(values) - 1)))]) < 0.2
+
+  def test_histogram(self):
+    h = Histogram([1, 10])
+    for v in [0.5, 1, 2, 20, 30]:
+      h.add(v)
+    assert h.counts == [2, 1, 2]
+    assert h.count == 5 and h.sum == 53.5
+
+  def test_encode_merge(self):
+    client = Metrics()
+    client.gauge("a", 1.)
+    client.gauge("a", 2.)
+    for v in range(1, 101):
+      client.sample("b", v)
+      client.histogram("c", v, bounds=[10, 50])
+
+    aggregator = Metrics()
+    aggregator.merge(client.encode())
+    aggregator.merge(client.encode())
+
+    assert aggregator.gauges == {"a": 2.}
+    assert aggregator.samples["b"].count == 200
+    assert aggregator.samples["b"].sum == 2 * 5050
+    assert aggregator.samples["b"].min == 1 and aggregator.samples["b"].max == 100
+    np.testing.assert_allclose(aggregator.samples["b"].quantiles([0.5]), [50], rtol=0.02)
+    assert aggregator.histograms["c"].bounds == [10, 50, float("inf")]
+    assert aggregator.histograms["c"].counts == [20, 80, 100]
+
+  def test_empty_batch(self):
+    aggregator = Metrics()
+    aggregator.merge(Metrics().encode())
+    assert len(aggregator) == 0
+
+  def test_flush_without_new_metrics(self, tmp_path, monkeypatch):
+    sock_path = f"ipc://{tmp_path}/stats"
+    monkeypatch.setattr(statsd, "STATS_SOCKET", sock_path)
+    monkeypatch.setattr(statsd, "STATS_CLIENT_FLUSH_TIME_S", 0.1)
+
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(sock_path)
+    try:
+      # nothing is logged after this, the window is still sent once it expires
+      StatLog().gauge("a", 1.)
+      assert sock.poll(timeout=2000)
+      aggregator = Metrics()
+      aggregator.merge(sock.recv_multipart())
+      assert aggregator.gauges == {"a": 1.}
+    finally:
+      sock.close(linger=0)
+      ctx.term()
@@ -121,8 +121,12 @@ cdef class AcadosOcpSolverCython:
     def solve(self):
         """
         Solve the ocp with current input.
+        The GIL is released during the solve, so solvers in other threads can run concurrently.
         """
-        return acados_solver.acados_solve(self.capsule)
+        cdef int status
+        with nogil:
+            status = acados_solver.acados_solve(self.capsule)
+        return status
 
 
     def reset(self, reset_qp_solver_mem=1):
@@ -298,6 +302,51 @@ cdef class AcadosOcpSolverCython:
         return out
 
 
+    def get_all(self, str field_, out_=None):
+        """
+        Get a field of the last solution for consecutive stages in a single call:
+
+            :param field: string in ['x', 'u', 'z', 'pi', 'lam', 't', 'sl', 'su',], see get()
+            :param out: optional C-contiguous float64 2D array to write into, one row per stage starting at stage 0.
+                        Defaults to N+1 stages (N for u and pi) with the dimension of stage 0.
+                        Rows of stages with a smaller dimension are only partially written.
+        """
+        out_fields = ['x', 'u', 'z', 'pi', 'lam', 't', 'sl', 'su']
+        field = field_.encode('utf-8')
+
+        if field_ not in out_fields:
+            raise Exception('AcadosOcpSolverCython.get_all(): {} is an invalid argument.\
+                    \n Possible values are {}.'.format(field_, out_fields))
+
+        cdef int stage
+        cdef int dims
+        cdef cnp.ndarray[cnp.float64_t, ndim=2] out
+        if out_ is None:
+            dims = acados_solver_common.ocp_nlp_dims_get_from_attr(self.nlp_config,
+                self.nlp_dims, self.nlp_out, 0, field)
+            out = np.zeros((self.N if field_ in ['u', 'pi'] else self.N + 1, dims))
+        else:
+            if not isinstance(out_, np.ndarray) or out_.dtype != np.float64 or out_.ndim != 2 or not out_.flags.c_contiguous:
+                raise Exception('AcadosOcpSolverCython.get_all(): out must be a C-contiguous float64 2D numpy array.')
+            out = out_
+
+        if out.shape[0] > self.N + 1 or (field_ == 'pi' and out.shape[0] > self.N):
+            raise Exception('AcadosOcpSolverCython.get_all(): too many stages for field {}, got {} with N = {}.'\
+                .format(field_, out.shape[0], self.N))
+
+        for stage in range(out.shape[0]):
+            dims = acados_solver_common.ocp_nlp_dims_get_from_attr(self.nlp_config,
+                self.nlp_dims, self.nlp_out, stage, field)
+            if dims > out.shape[1]:
+                raise Exception('AcadosOcpSolverCython.get_all(): field {} has dimension {} at stage {}, out has {} columns.'\
+                    .format(field_, dims, stage, out.shape[1]))
+            if dims > 0:
+                acados_solver_common.ocp_nlp_out_get(self.nlp_config, \
+                    self.nlp_dims, self.nlp_out, stage, field, <void *> &out[stage, 0])
+
+        return out
+
+
     def print_statistics(self):
         """
         prints statistics of previous solver run as a table:
@@ -587,6 +636,68 @@ cdef class AcadosOcpSolverCython:
                     self.nlp_solver, stage, field, <void *> value.data)
         return
 
+    def set_all(self, str field_, value_):
+        """
+        Set numerical data for consecutive stages in a single call.
+
+            :param field: string in ['x', 'u', 'pi', 'lam', 't', 'z', 'sl', 'su', 'p', 'yref', 'lbx', 'ubx', 'lbu', 'ubu'], see set()
+            :param value: 2D array with one row per stage starting at stage 0, as wide as the field's dimension.
+                          Only the terminal stage of cost fields can be shorter, e.g. yref, then only the leading values
+                          of its row are used.
+        """
+        if not isinstance(value_, np.ndarray) or value_.ndim != 2:
+            raise Exception(f"set_all: value must be 2D numpy array, got {type(value_)}.")
+        cost_fields = ['y_ref', 'yref']
+        constraints_fields = ['lbx', 'ubx', 'lbu', 'ubu']
+        out_fields = ['x', 'u', 'pi', 'lam', 't', 'z', 'sl', 'su']
+
+        if field_ not in constraints_fields + cost_fields + out_fields + ['p']:
+            raise Exception("AcadosOcpSolverCython.set_all(): {} is not a valid argument.\
+                \nPossible values are {}.".format(field_, \
+                constraints_fields + cost_fields + out_fields + ['p']))
+
+        field = field_.encode('utf-8')
+        z_guess = 'z_guess'.encode('utf-8')
+
+        cdef cnp.ndarray[cnp.float64_t, ndim=2] value = np.ascontiguousarray(value_, dtype=np.float64)
+        cdef int stage
+        cdef int dims
+        cdef int width = value.shape[1]
+
+        if value.shape[0] > self.N + 1:
+            raise Exception('AcadosOcpSolverCython.set_all(): too many stages, got {} with N = {}.'.format(value.shape[0], self.N))
+        if width == 0:
+            raise Exception('AcadosOcpSolverCython.set_all(): value for field "{}" has no columns.'.format(field_))
+
+        for stage in range(value.shape[0]):
+            # treat parameters separately
+            if field_ == 'p':
+                assert acados_solver.acados_update_params(self.capsule, stage, <double *> &value[stage, 0], width) == 0
+                continue
+
+            dims = acados_solver_common.ocp_nlp_dims_get_from_attr(self.nlp_config,
+                self.nlp_dims, self.nlp_out, stage, field)
+            if width != dims and not (field_ in cost_fields and stage == self.N and width > dims):
+                raise Exception('AcadosOcpSolverCython.set_all(): mismatching dimension for field "{}" '.format(field_) +
+                    'with dimension {} at stage {} (you have {})'.format(dims, stage, width))
+            if dims == 0:
+                # a terminal stage without cost
+                continue
+
+            if field_ in constraints_fields:
+                acados_solver_common.ocp_nlp_constraints_model_set(self.nlp_config,
+                    self.nlp_dims, self.nlp_in, stage, field, <void *> &value[stage, 0])
+            elif field_ in cost_fields:
+                acados_solver_common.ocp_nlp_cost_model_set(self.nlp_config,
+                    self.nlp_dims, self.nlp_in, stage, field, <void *> &value[stage, 0])
+            else:
+                acados_solver_common.ocp_nlp_out_set(self.nlp_config,
+                    self.nlp_dims, self.nlp_out, stage, field, <void *> &value[stage, 0])
+                if field_ == 'z':
+                    acados_solver_common.ocp_nlp_set(self.nlp_config, \
+                        self.nlp_solver, stage, z_guess, <void *> &value[stage, 0])
+        return
+
     def cost_set(self, int stage, str field_, value_):
         """
         Set numerical data in the cost module of the solver.
@@ -1,7 +1,17 @@
+import atexit
+import contextlib
+import fcntl
 import os
+import sqlite3
+import threading
+import time
 import urllib.parse
 
 DEFAULT_CACHE_DIR = os.getenv("CACHE_ROOT", os.path.expanduser("~/.commacache"))
+# byte budget of each managed cache dir
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+# "lru" or "lfu"
+DEFAULT_CACHE_EVICTION = os.getenv("CACHE_EVICTION", "lru")
 
 def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
   dir_ = os.path.join(cache_dir, "local")
@@ -12,3 +22,165 @@ def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
   else:
     cache_fn = f'{fn_parsed.hostname}_{fn_parsed.path.replace("/", "_")}'
   return os.path.join(dir_, cache_fn)
+
+
+class ManagedCache:
+  """Keeps a cache dir under a byte budget. Accesses are tracked in a sqlite db in the dir, which also
+  serializes access from multiple processes, and the least recently (or frequently) used entries
+  are deleted when the budget is exceeded. An entry is a key and the files that belong to it.
+
+  Eviction deletes files under an exclusive lock, readers that open several files of an entry
+  together take it shared with lock(), so they never see some of them deleted and some recreated."""
+  DB_NAME = ".cache_index.db"
+  LOCK_NAME = ".cache_evict.lock"
+  # deferred accesses are written at most this often, or with the next non deferred one
+  FLUSH_INTERVAL = 5.
+
+  # cache dir -> key -> [paths, size, last_access, accesses, hits, misses, bytes_saved]
+  _pending: dict[str, dict[str, list]] = {}
+  _last_flush: dict[str, float] = {}
+  _pending_lock = threading.Lock()
+  EVICTION_ORDER = {
+    "lru": "last_access ASC",
+    "lfu": "accesses ASC, last_access ASC",
+  }
+
+  def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES, eviction: str = DEFAULT_CACHE_EVICTION):
+    if eviction not in self.EVICTION_ORDER:
+      raise ValueError(f"unknown eviction policy {eviction}")
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.eviction = eviction
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def _connect(self) -> sqlite3.Connection:
+    # a connection per call, so instances can be shared across threads and forks
+    conn = sqlite3.connect(os.path.join(self.cache_dir, self.DB_NAME), timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, paths TEXT, size INTEGER, last_access REAL, accesses INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY CHECK (id = 0), hits INTEGER, misses INTEGER, bytes_saved INTEGER)")
+    conn.execute("INSERT OR IGNORE INTO stats VALUES (0, 0, 0, 0)")
+    return conn
+
+  @contextlib.contextmanager
+  def lock(self, exclusive: bool = False):
+    with open(os.path.join(self.cache_dir, self.LOCK_NAME), "a") as f:
+      fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      try:
+        yield
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+  def access(self, key: str, paths: list[str], size: int, hits: int = 0, misses: int = 0, bytes_saved: int = 0, defer: bool = False) -> None:
+    """Records an access to key, whose paths now take size bytes on disk, then evicts other entries if over budget.
+    Paths are deleted in order on eviction.
+
+    With defer=True the access is only kept in memory and written with the next flush, for reads
+    that didn't grow the entry and don't need to wait on the db."""
+    now = time.time()
+    with self._pending_lock:
+      pending = self._pending.setdefault(self.cache_dir, {})
+      if key in pending:
+        entry = pending[key]
+        entry[:3] = paths, size, now
+        for j, n in enumerate((1, hits, misses, bytes_saved), start=3):
+          entry[j] += n
+      else:
+        pending[key] = [paths, size, now, 1, hits, misses, bytes_saved]
+      if defer and now - self._last_flush.setdefault(self.cache_dir, now) < self.FLUSH_INTERVAL:
+        return
+    self.flush(keep=key)
+
+  def flush(self, keep: str | None = None) -> None:
+    """Writes the deferred accesses of this cache dir, then evicts if over budget"""
+    with self._pending_lock:
+      pending = self._pending.pop(self.cache_dir, {})
+      self._last_flush[self.cache_dir] = time.time()
+    if not len(pending):
+      return
+
+    conn = self._connect()
+    try:
+      conn.execute("BEGIN IMMEDIATE")
+      conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                       "paths=excluded.paths, size=excluded.size, last_access=excluded.last_access, accesses=accesses+excluded.accesses",
+                       [(key, "\n".join(paths), size, last_access, accesses) for key, (paths, size, last_access, accesses, *_) in pending.items()])
+      hits, misses, bytes_saved = (sum(entry[j] for entry in pending.values()) for j in range(4, 7))
+      conn.execute("UPDATE stats SET hits=hits+?, misses=misses+?, bytes_saved=bytes_saved+?", (hits, misses, bytes_saved))
+      self._evict(conn, keep=keep)
+      conn.execute("COMMIT")
+    except BaseException:
+      conn.execute("ROLLBACK")
+      raise
+    finally:
+      conn.close()
+
+  @classmethod
+  def flush_all(cls) -> None:
+    for cache_dir in list(cls._pending):
+      cls(cache_dir).flush()
+
+  @classmethod
+  def _reset_pending(cls) -> None:
+    # the parent still holds these and writes them itself
+    cls._pending = {}
+    cls._last_flush = {}
+    cls._pending_lock = threading.Lock()
+
+  def access_file(self, path: str, hit: bool) -> None:
+    """Records a read (hit) or write (miss) of a single file entry"""
+    size = os.path.getsize(path)
+    self.access(path, [path], size, hits=int(hit), misses=int(not hit), bytes_saved=size if hit else 0)
+
+  def _evict(self, conn: sqlite3.Connection, keep: str | None = None) -> None:
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    if total <= self.max_bytes:
+      return
+
+    with self.lock(exclusive=True):
+      for key, paths, size in conn.execute(f"SELECT key, paths, size FROM entries ORDER BY {self.EVICTION_ORDER[self.eviction]}").fetchall():
+        if total <= self.max_bytes:
+          break
+        if key == keep:
+          continue
+        for path in paths.split("\n"):
+          try:
+            os.remove(path)
+          except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM entries WHERE key=?", (key,))
+        total -= size
+
+  def evict(self) -> None:
+    conn = self._connect()
+    try:
+      conn.execute("BEGIN IMMEDIATE")
+      self._evict(conn)
+      conn.execute("COMMIT")
+    except BaseException:
+      conn.execute("ROLLBACK")
+      raise
+    finally:
+      conn.close()
+
+  def stats(self) -> dict[str, float]:
+    self.flush()
+    conn = self._connect()
+    try:
+      hits, misses, bytes_saved = conn.execute("SELECT hits, misses, bytes_saved FROM stats").fetchone()
+      entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    finally:
+      conn.close()
+    return {
+      "hits": hits,
+      "misses": misses,
+      "hit_rate": hits / (hits + misses) if hits + misses else 0.,
+      "bytes_saved": bytes_saved,
+      "entries": entries,
+      "size": total,
+      "max_bytes": self.max_bytes,
+    }
+
+
+atexit.register(ManagedCache.flush_all)
+os.register_at_fork(after_in_child=ManagedCache._reset_pending)
@@ -1,27 +1,36 @@
 import json
 import os
 import pickle
-import struct
 import subprocess
 import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
-import _io
-from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR, ManagedCache
 from openpilot.tools.lib.exceptions import DataUnreadableError
 from openpilot.tools.lib.vidindex import hevc_index
 from openpilot.common.file_helpers import atomic_write_in_dir
 
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 
+try:
+  import av
+except ImportError:
+  av = None
+
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+# memory budget of each GOPFrameReader's decoded frame cache
+FRAME_CACHE_BYTES = int(os.getenv("FRAMEREADER_CACHE_BYTES", str(1024 * 1024 * 1024)))
+# number of GOPs decoded in parallel, shared by all frame readers in the process
+DECODER_THREADS = int(os.getenv("FRAMEREADER_DECODER_THREADS", str(max(1, (os.cpu_count() or 1) // 2))))
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -29,14 +38,6 @@ class GOPReader:
     raise NotImplementedError
 
 
-class DoNothingContextManager:
-  def __enter__(self):
-    return self
-
-  def __exit__(self, *x):
-    pass
-
-
 class FrameType(IntEnum):
   raw = 1
   h265_stream = 2
@@ -86,11 +87,13 @@ def cache_fn(func):
     if cache_path and os.path.exists(cache_path):
       with open(cache_path, "rb") as cache_file:
         cache_value = pickle.load(cache_file)
+      ManagedCache(cache_dir).access_file(cache_path, hit=True)
     else:
       cache_value = func(fn, *args, **kwargs)
       if cache_path:
         with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as cache_file:
           pickle.dump(cache_value, cache_file, -1)
+        ManagedCache(cache_dir).access_file(cache_path, hit=False)
 
     return cache_value
 
@@ -123,17 +126,20 @@ def read_file_check_size(f, sz, cookie):
   return buff
 
 
-def rgb24toyuv(rgb):
-  yuv_from_rgb = np.array([[ 0.299     ,  0.587     ,  0.114      ],
-                           [-0.14714119, -0.28886916,  0.43601035 ],
-                           [ 0.61497538, -0.51496512, -0.10001026 ]])
-  img = np.dot(rgb.reshape(-1, 3), yuv_from_rgb.T).reshape(rgb.shape)
+YUV_FROM_RGB = np.array([[ 0.299     ,  0.587     ,  0.114      ],
+                         [-0.14714119, -0.28886916,  0.43601035 ],
+                         [ 0.61497538, -0.51496512, -0.10001026 ]], dtype=np.float32)
 
 
+def rgb24toyuv(rgb):
+  # takes a (h, w, 3) image or a batch of them (..., h, w, 3)
+  rgb = rgb.astype(np.float32)
+  ys = rgb @ YUV_FROM_RGB[0]
 
-  ys = img[:, :, 0]
-  us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
-  vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
+  # chroma is linear in rgb, so average the 2x2 blocks before converting
+  rgb_sub = (rgb[..., ::2, ::2, :] + rgb[..., 1::2, ::2, :] + rgb[..., ::2, 1::2, :] + rgb[..., 1::2, 1::2, :]) / 4
+  us = rgb_sub @ YUV_FROM_RGB[1] + 128
+  vs = rgb_sub @ YUV_FROM_RGB[2] + 128
 
   return ys, us, vs
 
@@ -141,13 +147,8 @@ def rgb24toyuv(rgb):
 def rgb24toyuv420(rgb):
   ys, us, vs = rgb24toyuv(rgb)
 
-  y_len = rgb.shape[0] * rgb.shape[1]
-  uv_len = y_len // 4
-
-  yuv420 = np.empty(y_len + 2 * uv_len, dtype=rgb.dtype)
-  yuv420[:y_len] = ys.reshape(-1)
-  yuv420[y_len:y_len + uv_len] = us.reshape(-1)
-  yuv420[y_len + uv_len:y_len + 2 * uv_len] = vs.reshape(-1)
+  batch_shape = rgb.shape[:-3]
+  yuv420 = np.concatenate([ys.reshape(*batch_shape, -1), us.reshape(*batch_shape, -1), vs.reshape(*batch_shape, -1)], axis=-1)
 
   return yuv420.clip(0, 255).astype('uint8')
 
@@ -155,13 +156,9 @@ def rgb24toyuv420(rgb):
 def rgb24tonv12(rgb):
   ys, us, vs = rgb24toyuv(rgb)
 
-  y_len = rgb.shape[0] * rgb.shape[1]
-  uv_len = y_len // 4
-
-  nv12 = np.empty(y_len + 2 * uv_len, dtype=rgb.dtype)
-  nv12[:y_len] = ys.reshape(-1)
-  nv12[y_len::2] = us.reshape(-1)
-  nv12[y_len+1::2] = vs.reshape(-1)
+  batch_shape = rgb.shape[:-3]
+  uvs = np.stack([us, vs], axis=-1)
+  nv12 = np.concatenate([ys.reshape(*batch_shape, -1), uvs.reshape(*batch_shape, -1)], axis=-1)
 
   return nv12.clip(0, 255).astype('uint8')
 
@@ -182,7 +179,10 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
           "-pix_fmt", pix_fmt,
           "-"]
   dat = subprocess.check_output(args, input=rawdat)
+  return _reshape_frames(dat, w, h, pix_fmt)
 
+
+def _reshape_frames(dat, w, h, pix_fmt):
   if pix_fmt == "rgb24":
     ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
   elif pix_fmt == "nv12":
@@ -197,6 +197,85 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+# bytes per row of each plane, without the padding PyAV frames may have
+PLANE_ROW_BYTES = {
+  "rgb24": lambda w: (3 * w,),
+  "yuv420p": lambda w: (w, w // 2, w // 2),
+  "nv12": lambda w: (w, w),
+  "yuv444p": lambda w: (w, w, w),
+}
+
+
+def _frame_to_bytes(frame, pix_fmt, w):
+  if frame.format.name != pix_fmt:
+    # bicubic, like the ffmpeg cli
+    frame = frame.reformat(format=pix_fmt, interpolation="BICUBIC")
+  planes = []
+  for plane, row_bytes in zip(frame.planes, PLANE_ROW_BYTES[pix_fmt](w), strict=True):
+    rows = np.frombuffer(plane, dtype=np.uint8, count=plane.height * plane.line_size).reshape(plane.height, plane.line_size)
+    planes.append(rows[:, :row_bytes].reshape(-1))
+  return np.concatenate(planes)
+
+
+def decode_video_data(rawdat, vid_fmt, w, h, pix_fmt):
+  """Decodes in-process with PyAV, which releases the GIL while decoding.
+  Falls back to an ffmpeg process when PyAV isn't installed or CUDA is requested."""
+  if av is None or os.getenv("FFMPEG_CUDA", "0") == "1":
+    return decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt)
+
+  codec = av.CodecContext.create(vid_fmt, "r")
+  codec.options = {"flags2": "+showall"}
+  frames = []
+  for packet in [*codec.parse(rawdat), *codec.parse(None), None]:
+    frames += [_frame_to_bytes(f, pix_fmt, w) for f in codec.decode(packet)]
+  return _reshape_frames(b"".join(f.tobytes() for f in frames), w, h, pix_fmt)
+
+
+class FrameCache:
+  """LRU cache of decoded frames, bounded by their total size"""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._frames = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, key):
+    return key in self._frames
+
+  def get(self, key):
+    with self._lock:
+      frame = self._frames.get(key)
+      if frame is not None:
+        self._frames.move_to_end(key)
+      return frame
+
+  def put(self, key, frame):
+    with self._lock:
+      old = self._frames.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes
+      self._frames[key] = frame
+      self.nbytes += frame.nbytes
+      while self.nbytes > self.max_bytes and len(self._frames) > 1:
+        _, evicted = self._frames.popitem(last=False)
+        self.nbytes -= evicted.nbytes
+
+
+_decoder_pool: ThreadPoolExecutor | None = None
+
+def decoder_pool() -> ThreadPoolExecutor:
+  global _decoder_pool
+  if _decoder_pool is None:
+    _decoder_pool = ThreadPoolExecutor(max_workers=DECODER_THREADS, thread_name_prefix="framereader_decoder")
+  return _decoder_pool
+
+def _reset_decoder_pool() -> None:
+  global _decoder_pool
+  _decoder_pool = None
+
+os.register_at_fork(after_in_child=_reset_decoder_pool)
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -227,29 +306,47 @@ def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=Fal
 
 class RawData:
   def __init__(self, f):
-    self.f = _io.FileIO(f, 'rb')
-    self.lenn = struct.unpack("I", self.f.read(4))[0]
+    self.f = np.memmap(f, dtype=np.uint8, mode='r')
+    self.lenn = int(self.f[:4].view(np.uint32)[0])
     self.count = os.path.getsize(f) / (self.lenn+4)
+    # every frame is its length followed by the data, skip the lengths to get zero-copy views of all frames
+    self.frames = self.f[:int(self.count) * (self.lenn+4)].reshape(-1, self.lenn+4)[:, 4:]
 
-  def read(self, i):
-    self.f.seek((self.lenn+4)*i + 4)
-    return self.f.read(self.lenn)
+  def read(self, i, count=1):
+    return self.frames[i:i+count]
 
 
 class RawFrameReader(BaseFrameReader):
-  def __init__(self, fn):
+  def __init__(self, fn, threads=1):
     # raw camera
     self.fn = fn
     self.frame_type = FrameType.raw
     self.rawfile = RawData(self.fn)
     self.frame_count = self.rawfile.count
     self.w, self.h = 640, 480
+    # frames of a batch are split across threads, numpy releases the GIL
+    self.threads = threads
 
   def load_and_debayer(self, img):
-    img = np.frombuffer(img, dtype='uint8').reshape(960, 1280)
-    cimg = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
+    # takes one frame or a batch of them
+    img = np.asarray(img).reshape(-1, 960, 1280)
+    cimg = np.empty((img.shape[0], 480, 640, 3), dtype=np.uint8)
+    cimg[..., 0] = img[:, 0::2, 1::2]
+    cimg[..., 1] = (img[:, 0::2, 0::2].astype(np.uint16) + img[:, 1::2, 1::2]) >> 1
+    cimg[..., 2] = img[:, 1::2, 0::2]
     return cimg
 
+  def _convert(self, dat, pix_fmt):
+    rgb_dat = self.load_and_debayer(dat)
+    if pix_fmt == "rgb24":
+      return rgb_dat
+    elif pix_fmt == "nv12":
+      return rgb24tonv12(rgb_dat)
+    elif pix_fmt == "yuv420p":
+      return rgb24toyuv420(rgb_dat)
+    else:
+      raise NotImplementedError
+
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
     assert num+count <= self.frame_count
@@ -257,20 +354,14 @@ class RawFrameReader(BaseFrameReader):
     if pix_fmt not in ("nv12", "yuv420p", "rgb24"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
 
-    app = []
-    for i in range(num, num+count):
-      dat = self.rawfile.read(i)
-      rgb_dat = self.load_and_debayer(dat)
-      if pix_fmt == "rgb24":
-        app.append(rgb_dat)
-      elif pix_fmt == "nv12":
-        app.append(rgb24tonv12(rgb_dat))
-      elif pix_fmt == "yuv420p":
-        app.append(rgb24toyuv420(rgb_dat))
-      else:
-        raise NotImplementedError
+    dat = self.rawfile.read(num, count)
+    if self.threads > 1 and count > 1:
+      with ThreadPoolExecutor(max_workers=self.threads) as executor:
+        ret = np.concatenate(list(executor.map(lambda batch: self._convert(batch, pix_fmt), np.array_split(dat, min(self.threads, count)))))
+    else:
+      ret = self._convert(dat, pix_fmt)
 
-    return app
+    return list(ret)
 
 
 class VideoStreamDecompressor:
@@ -425,24 +516,26 @@ class StreamGOPReader(GOPReader):
 
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
+  #GOPs are decoded on the shared decoder pool, so independent GOPs are decoded in parallel
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_bytes=FRAME_CACHE_BYTES):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = FrameCache(cache_bytes)
+
+    # GOPs being decoded, by (first frame, pix_fmt)
+    self.cache_lock = threading.Lock()
+    self.pending_gops: dict[tuple[int, str], Future] = {}
 
     if self.readahead:
-      self.cache_lock = threading.RLock()
       self.readahead_last = None
       self.readahead_len = 30
       self.readahead_c = threading.Condition()
       self.readahead_thread = threading.Thread(target=self._readahead_thread)
       self.readahead_thread.daemon = True
       self.readahead_thread.start()
-    else:
-      self.cache_lock = DoNothingContextManager()
 
   def close(self):
     if not self.open_:
@@ -469,33 +562,54 @@ class GOPFrameReader(BaseFrameReader):
       assert self.readahead_last
       num, pix_fmt = self.readahead_last
 
+      # queue every GOP in the window without waiting, so they're decoded in parallel
       if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
+        futures = [self._request(k, pix_fmt)[1] for k in range(num - 1, max(0, num - self.readahead_len), -1)]
       else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
+        futures = [self._request(k, pix_fmt)[1] for k in range(num, min(self.frame_count, num + self.readahead_len))]
+      for future in futures:
+        if future is not None:
+          future.exception()
 
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
+  def _decode_gop(self, num, pix_fmt):
+    frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+    try:
+      ret = decode_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+      ret = ret[skip_frames:]
+      assert ret.shape[0] == num_frames
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+      for i in range(ret.shape[0]):
+        self.frame_cache.put((frame_b+i, pix_fmt), ret[i])
+      return ret
+    finally:
+      with self.cache_lock:
+        self.pending_gops.pop((frame_b, pix_fmt), None)
+
+  def _request(self, num, pix_fmt):
+    # returns the frame if it's cached, otherwise the first frame of its GOP and the future decoding it
+    frame = self.frame_cache.get((num, pix_fmt))
+    if frame is not None:
+      return frame, None
 
+    frame_b = self._lookup_gop(num)[0]
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+      frame = self.frame_cache.get((num, pix_fmt))
+      if frame is not None:
+        return frame, None
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+      future = self.pending_gops.get((frame_b, pix_fmt))
+      if future is None:
+        future = decoder_pool().submit(self._decode_gop, num, pix_fmt)
+        self.pending_gops[(frame_b, pix_fmt)] = future
+      return frame_b, future
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
-
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+  def _get_one(self, num, pix_fmt):
+    assert num < self.frame_count
 
-      return self.frame_cache[(num, pix_fmt)]
+    frame, future = self._request(num, pix_fmt)
+    if future is None:
+      return frame
+    return future.result()[num - frame]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -506,7 +620,9 @@ class GOPFrameReader(BaseFrameReader):
     if pix_fmt not in ("nv12", "yuv420p", "rgb24", "yuv444p"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
 
-    ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
+    # queue all GOPs first so they're decoded in parallel
+    requests = [self._request(num + i, pix_fmt) for i in range(count)]
+    ret = [frame if future is None else future.result()[num + i - frame] for i, (frame, future) in enumerate(requests)]
 
     if self.readahead:
       self.readahead_last = (num+count, pix_fmt)
@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 import bz2
-from functools import cache, partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache
 import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
 import capnp
 import enum
+import hashlib
+import json
 import os
 import pathlib
+import pickle
+import queue
+import struct
 import sys
 import tqdm
+import traceback
 import urllib.parse
 import warnings
+import numpy as np
 import zstandard as zstd
 
 from collections.abc import Callable, Iterable, Iterator
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR, ManagedCache
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
 from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
@@ -39,26 +50,128 @@ def save_log(dest, log_msgs, compress=True):
     f.write(dat)
 
 
+BZ2_MAGIC = b'BZh9'
+# https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'
+
+# size of the compressed reads done while streaming a log file
+STREAM_READ_SIZE = 1000 * 1000
+# capnp's default segment limit, anything above is a corrupted header
+MAX_SEGMENTS = 512
+# bump when the index or columns format changes
+LOG_INDEX_VERSION = 1
+COLUMNS_VERSION = 1
+# default memory budget for segments prefetched by LogReader
+PREFETCH_BYTES = 1024 * 1024 * 1024
+
+
+def _get_extension(fn: str) -> str:
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ('', '.bz2', '.zst'):
+    # old rlogs weren't compressed
+    raise ValueError(f"unknown extension {ext}")
+  return ext
+
+
+def _new_decompressor(ext: str | None, dat: bytes):
+  if ext == ".bz2" or dat.startswith(BZ2_MAGIC):
+    return bz2.BZ2Decompressor()
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    return zstd.ZstdDecompressor().decompressobj()
+  return None
+
+
+def decompress_stream(chunks: Iterable[bytes], ext: str | None = None) -> Iterator[bytes]:
+  """Incrementally decompress a bz2 or zstd stream, passing uncompressed data through.
+  Concatenated bz2 streams and zstd frames are handled like bz2.decompress and zstd.decompress do."""
+  compressed = None
+  decompressor = None
+  for chunk in chunks:
+    if compressed is None:
+      compressed = _new_decompressor(ext, chunk) is not None
+    if not compressed:
+      yield chunk
+      continue
+
+    while chunk:
+      if decompressor is None:
+        decompressor = _new_decompressor(ext, chunk)
+      out = decompressor.decompress(chunk)
+      if out:
+        yield out
+      chunk = b""
+      if decompressor.eof:
+        chunk = decompressor.unused_data
+        decompressor = None
+
+
+def _message_size(buf: bytes | bytearray, pos: int) -> int | None:
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  if len(buf) - pos < 4:
+    return None
+  num_segments = struct.unpack_from("<I", buf, pos)[0] + 1
+  if num_segments > MAX_SEGMENTS:
+    raise ValueError(f"invalid segment count {num_segments}")
+  header_size = (4 * (num_segments + 1) + 7) & ~7
+  if len(buf) - pos < header_size:
+    return None
+  return header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", buf, pos + 4))
+
+
+def read_events_stream(chunks: Iterable[bytes]) -> Iterator[LogMessage]:
+  """Parse a stream of uncompressed bytes into events, holding at most one chunk and one event in memory"""
+  buf = bytearray()
+  try:
+    for chunk in chunks:
+      buf += chunk
+      pos = 0
+      while (size := _message_size(buf, pos)) is not None and pos + size <= len(buf):
+        with capnp_log.Event.from_bytes(bytes(buf[pos:pos + size])) as evt:
+          yield evt
+        pos += size
+      del buf[:pos]
+  except (ValueError, capnp.KjException):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+    return
+
+  # truncated last event
+  if len(buf):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+def _filter_union_types(ents: Iterable[LogMessage]) -> Iterator[LogMessage]:
+  for ent in ents:
+    try:
+      ent.which()
+      yield ent
+    except capnp.lib.capnp.KjException:
+      pass
+
+
+def _decompress(dat: bytes, ext: str | None = None) -> bytes:
+  if ext == ".bz2" or dat.startswith(BZ2_MAGIC):
+    return bz2.decompress(dat)
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    return zstd.decompress(dat)
+  return dat
+
+
+def _read_log_data(fn: str) -> bytes:
+  ext = _get_extension(fn)
+  with FileReader(fn) as f:
+    return _decompress(f.read(), ext)
+
+
 class _LogFileReader:
   def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
     self.data_version = None
     self._only_union_types = only_union_types
 
-    ext = None
     if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
-        # old rlogs weren't compressed
-        raise ValueError(f"unknown extension {ext}")
-
-      with FileReader(fn) as f:
-        dat = f.read()
-
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = zstd.decompress(dat)
+      dat = _read_log_data(fn)
+    else:
+      dat = _decompress(dat)
+    self.nbytes = len(dat)
 
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
@@ -73,15 +186,248 @@ class _LogFileReader:
       self._ents.sort(key=lambda x: x.logMonoTime)
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
-      if self._only_union_types:
+    if self._only_union_types:
+      yield from _filter_union_types(self._ents)
+    else:
+      yield from self._ents
+
+
+class _StreamingLogFileReader:
+  """Reads events as the file is downloaded and decompressed, without keeping them around.
+  Memory use is bounded by STREAM_READ_SIZE and the largest event, not by the size of the log.
+  Every iteration reads the file again, use _LogFileReader when random access is needed."""
+  def __init__(self, fn, only_union_types=False):
+    self._fn = fn
+    self._ext = _get_extension(fn)
+    self._only_union_types = only_union_types
+
+  def _chunks(self) -> Iterator[bytes]:
+    with FileReader(self._fn) as f:
+      while chunk := f.read(STREAM_READ_SIZE):
+        yield chunk
+
+  def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    ents = read_events_stream(decompress_stream(self._chunks(), self._ext))
+    if self._only_union_types:
+      yield from _filter_union_types(ents)
+    else:
+      yield from ents
+
+
+def build_log_index(dat: bytes) -> np.ndarray:
+  """Index an uncompressed log, one row per event in file order.
+  Events that aren't a union type get an empty which."""
+  rows = []
+  pos = 0
+  try:
+    while (size := _message_size(dat, pos)) is not None and pos + size <= len(dat):
+      with capnp_log.Event.from_bytes(dat[pos:pos + size]) as evt:
         try:
-          ent.which()
-          yield ent
-        except capnp.lib.capnp.KjException:
-          pass
+          which = str(evt.which())
+        except capnp.KjException:
+          which = ""
+        rows.append((which.encode(), pos, size, evt.logMonoTime))
+      pos += size
+  except (ValueError, capnp.KjException):
+    pass
+
+  width = max((len(r[0]) for r in rows), default=1)
+  return np.array(rows, dtype=[('which', f'S{width}'), ('offset', '<u8'), ('size', '<u4'), ('logMonoTime', '<u8')])
+
+
+def _cache_valid(fn: str, cache_path: str) -> bool:
+  if not os.path.exists(cache_path):
+    return False
+  # local logs can be rewritten, remote ones are immutable
+  local = urllib.parse.urlparse(fn).scheme == ''
+  return not (local and os.path.getmtime(fn) > os.path.getmtime(cache_path))
+
+
+def log_index_path(fn: str, cache_dir: str | None = None) -> str:
+  cache_dir = cache_dir or DEFAULT_CACHE_DIR
+  return f"{cache_path_for_file_path(fn, cache_dir)}.index_v{LOG_INDEX_VERSION}.npy"
+
+
+class _LogFileIndex:
+  """Message type index of a log file, cached as an mmap-able .npy next to the other tools caches.
+  Queries only decode the events they return, and files without matching events are never downloaded."""
+  def __init__(self, fn, cache_dir=None):
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    self._fn = fn
+    self._dat = None
+
+    path = log_index_path(fn, cache_dir)
+    hit = _cache_valid(fn, path)
+    if hit:
+      self.index = np.load(path, mmap_mode='r')
+    else:
+      # keep the data around for the first query, it's usually why the index is being built
+      self._dat = _read_log_data(fn)
+      self.index = build_log_index(self._dat)
+      with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+        np.save(f, self.index)
+    ManagedCache(cache_dir).access_file(path, hit=hit)
+
+  def rows(self, msg_type: str, start_time: int | None = None, end_time: int | None = None) -> np.ndarray:
+    mask = self.index['which'] == msg_type.encode()
+    if start_time is not None:
+      mask &= self.index['logMonoTime'] >= start_time
+    if end_time is not None:
+      mask &= self.index['logMonoTime'] < end_time
+    return np.flatnonzero(mask)
+
+  def events(self, rows: np.ndarray) -> Iterator[LogMessage]:
+    if not len(rows):
+      return
+
+    dat, self._dat = self._dat if self._dat is not None else _read_log_data(self._fn), None
+    for offset, size in zip(self.index['offset'][rows], self.index['size'][rows], strict=True):
+      with capnp_log.Event.from_bytes(dat[offset:offset + size]) as evt:
+        yield evt
+
+
+ColumnSpec = dict[str, list[str]]
+Columns = dict[str, dict[str, np.ndarray]]
+
+
+def _get_field(msg, path: str):
+  for name in path.split('.'):
+    msg = getattr(msg, name)
+  return msg
+
+
+def events_to_columns(events: LogIterable, fields: ColumnSpec) -> Columns:
+  """Walks events once, collecting fields (dotted paths into the message) into one array per field.
+  Every message type also gets its own logMonoTime column."""
+  values: dict[str, dict[str, list]] = {w: {f: [] for f in ['logMonoTime', *fs]} for w, fs in fields.items()}
+  for m in events:
+    which = m.which()
+    if which not in values:
+      continue
+
+    msg = getattr(m, which)
+    cols = values[which]
+    cols['logMonoTime'].append(m.logMonoTime)
+    for f in fields[which]:
+      v = _get_field(msg, f)
+      if isinstance(v, capnp.lib.capnp._DynamicListReader):
+        v = list(v)
+      elif isinstance(v, capnp.lib.capnp._DynamicEnum):
+        v = str(v)
+      cols[f].append(v)
+
+  return {w: {f: _to_column(v, np.uint64 if f == 'logMonoTime' else None) for f, v in cols.items()} for w, cols in values.items()}
+
+
+def _to_column(values: list, dtype=None) -> np.ndarray:
+  try:
+    return np.array(values, dtype=dtype)
+  except ValueError:
+    # ragged lists
+    return np.array(values, dtype=object)
+
+
+def columns_cache_path(fn: str, fields: ColumnSpec, cache_dir: str | None = None) -> str:
+  cache_dir = cache_dir or DEFAULT_CACHE_DIR
+  key = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+  return f"{cache_path_for_file_path(fn, cache_dir)}.columns_v{COLUMNS_VERSION}_{key}.npz"
+
+
+def _save_columns(path: str, columns: Columns) -> None:
+  # object arrays would need pickling to load, only numeric, bool and string columns can be cached
+  for w, cols in columns.items():
+    for f, v in cols.items():
+      if v.dtype.hasobject:
+        raise ValueError(f"column {w}.{f} has ragged or struct values and can't be cached, use cache=False or pick a numeric field")
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    np.savez(f, **{f"{w}/{f}": v for w, cols in columns.items() for f, v in cols.items()})
+
+
+def _load_columns(path: str, fields: ColumnSpec) -> Columns:
+  with np.load(path) as dat:
+    return {w: {f: dat[f"{w}/{f}"] for f in ['logMonoTime', *fs]} for w, fs in fields.items()}
+
+
+def _concat_columns(cols: list[np.ndarray]) -> np.ndarray:
+  # empty segments have no dtype information
+  non_empty = [c for c in cols if len(c)]
+  return np.concatenate(non_empty) if len(non_empty) else cols[0]
+
+
+def _shm_name(prefix: str, worker_id: int, seq: int) -> str:
+  # predictable names let the parent unlink blocks whose result never reached it
+  return f"{prefix}_{worker_id}_{seq}"
+
+
+def _to_transport(value, name=None):
+  # arrays go through shared memory instead of being pickled through the result queue
+  if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(value.nbytes, 1))
+    np.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+    shm.close()
+    # the parent owns and unlinks it, don't let this process' tracker clean it up on exit
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return True, (shm.name, value.shape, value.dtype.str)
+  return False, value
+
+
+def _from_transport(transport):
+  is_shm, value = transport
+  if not is_shm:
+    return value
+
+  name, shape, dtype = value
+  shm = shared_memory.SharedMemory(name=name)
+  try:
+    return np.ndarray(shape, dtype, buffer=shm.buf).copy()
+  finally:
+    shm.close()
+    shm.unlink()
+
+
+def _unlink_shm(name: str) -> bool:
+  try:
+    shm = shared_memory.SharedMemory(name=name)
+  except FileNotFoundError:
+    return False
+  shm.close()
+  shm.unlink()
+  return True
+
+
+def _picklable_exception(e: Exception) -> Exception | None:
+  # the queue pickles in a background thread and would drop the whole result on failure
+  try:
+    pickle.dumps(e)
+  except Exception:
+    return None
+  return e
+
+
+def _map_reduce_worker(worker_id, identifiers, lr_kwargs, func, reduce, tasks, results, shm_prefix):
+  acc = None
+  has_acc = False
+  seq = 0
+
+  def transport(value):
+    nonlocal seq
+    ret = _to_transport(value, _shm_name(shm_prefix, worker_id, seq))
+    seq += ret[0]
+    return ret
+
+  while (i := tasks.get()) is not None:
+    try:
+      ret = func(_LogFileReader(identifiers[i], **lr_kwargs))
+      if reduce is None:
+        results.put((worker_id, i, True, transport(ret)))
       else:
-        yield ent
+        acc = reduce(acc, ret) if has_acc else ret
+        has_acc = True
+        results.put((worker_id, i, True, None))
+    except Exception as e:
+      results.put((worker_id, i, False, (traceback.format_exc(), _picklable_exception(e))))
+
+  results.put((worker_id, None, has_acc, transport(acc) if has_acc else None))
 
 
 class ReadMode(enum.StrEnum):
@@ -103,6 +449,15 @@ class LogsUnavailable(Exception):
   pass
 
 
+class SegmentsFailed(Exception):
+  """failures maps each failed segment to its worker's traceback, errors to the original
+  exception where it could be sent back from the worker. Raised from the first segment's error."""
+  def __init__(self, failures: dict[int, str], errors: dict[int, Exception] | None = None):
+    super().__init__(f"{len(failures)} segment(s) failed:\n" + "\n".join(f"segment {i}: {tb}" for i, tb in failures.items()))
+    self.failures = failures
+    self.errors = errors or {}
+
+
 @cache
 def default_valid_file(fn: LogPath) -> bool:
   return fn is not None and file_exists(fn)
@@ -266,7 +621,13 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               prefetch=0, prefetch_bytes=PREFETCH_BYTES):
+    if streaming and sort_by_time:
+      raise ValueError("sort_by_time requires the whole log in memory, it can't be used with streaming")
+    if streaming and prefetch:
+      raise ValueError("prefetching loads whole logs, it can't be used with streaming")
+
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
@@ -275,29 +636,172 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.streaming = streaming
+    self.use_index = use_index
+    # number of segments to download and decompress ahead of the one being iterated,
+    # as long as the ones waiting to be consumed take less than prefetch_bytes
+    self.prefetch = prefetch
+    self.prefetch_bytes = prefetch_bytes
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    self.__indexes: dict[int, _LogFileIndex] = {}
     self.reset()
 
   def _get_lr(self, i):
+    if self.streaming:
+      return _StreamingLogFileReader(self.logreader_identifiers[i], only_union_types=self.only_union_types)
+
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = self._load_lr(i)
     return self.__lrs[i]
 
+  def _load_lr(self, i):
+    # doesn't keep the reader, prefetched segments are dropped once they're consumed
+    if i in self.__lrs:
+      return self.__lrs[i]
+    return _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+
   def __iter__(self):
+    if self.prefetch > 0:
+      yield from self._iter_prefetched()
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
-  def _run_on_segment(self, func, i):
-    return func(self._get_lr(i))
+  @staticmethod
+  def _buffered_bytes(futures: dict[int, Future]) -> int:
+    return sum(f.result().nbytes for f in futures.values() if f.done() and f.exception() is None)
 
-  def run_across_segments(self, num_processes, func, desc=None):
-    with multiprocessing.Pool(num_processes) as pool:
-      ret = []
-      num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, desc=desc):
-        ret.extend(p)
+  def _iter_prefetched(self):
+    num_segs = len(self.logreader_identifiers)
+    executor = ThreadPoolExecutor(max_workers=self.prefetch)
+    try:
+      futures: dict[int, Future] = {}
+      next_seg = 0
+      for i in range(num_segs):
+        while next_seg < num_segs and next_seg <= i + self.prefetch and \
+              (next_seg == i or self._buffered_bytes(futures) < self.prefetch_bytes):
+          futures[next_seg] = executor.submit(self._load_lr, next_seg)
+          next_seg += 1
+        yield from futures.pop(i).result()
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def map_reduce(self, num_processes, func, reduce=None, desc=None, allow_failures=False):
+    """Runs func on each segment's log across num_processes workers. Idle workers take the next
+    segment from a shared queue, so slow segments don't hold up the rest.
+
+    Without reduce, returns func's results in segment order. With reduce, each worker folds its
+    results with reduce(acc, result) as it goes, the workers' accumulators are folded together
+    the same way and only that value is returned. NumPy arrays come back through shared memory.
+
+    Failed segments are reported as they happen and raise SegmentsFailed at the end, chained
+    from the first segment's exception, or are left out of the results with allow_failures=True."""
+    num_segs = len(self.logreader_identifiers)
+    lr_kwargs = {'sort_by_time': self.sort_by_time, 'only_union_types': self.only_union_types}
+
+    shm_prefix = f"lrmr{os.getpid()}{os.urandom(3).hex()}"
+    tasks: multiprocessing.Queue = multiprocessing.Queue()
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    for i in range(num_segs):
+      tasks.put(i)
+    for _ in range(num_processes):
+      tasks.put(None)
+
+    workers = [multiprocessing.Process(target=_map_reduce_worker, args=(wid, self.logreader_identifiers, lr_kwargs, func, reduce, tasks, results, shm_prefix),
+                                       daemon=True) for wid in range(num_processes)]
+    for w in workers:
+      w.start()
+
+    seg_results = {}
+    completed: dict[int, int] = {}  # segment -> worker
+    failures: dict[int, str] = {}
+    errors: dict[int, Exception] = {}
+    shm_received = [0] * num_processes
+    accs = []
+    finished_workers: set[int] = set()
+    try:
+      with tqdm.tqdm(total=num_segs, desc=desc) as pbar:
+        while len(finished_workers) < num_processes:
+          try:
+            wid, i, ok, payload = results.get(timeout=1)
+          except queue.Empty:
+            if any(w.is_alive() for w in workers):
+              continue
+            break
+
+          if ok and payload is not None:
+            shm_received[wid] += payload[0]
+
+          if i is None:
+            finished_workers.add(wid)
+            if ok:
+              accs.append(_from_transport(payload))
+            continue
+
+          if ok:
+            completed[i] = wid
+            if reduce is None:
+              seg_results[i] = _from_transport(payload)
+          else:
+            failures[i], err = payload
+            if err is not None:
+              errors[i] = err
+            cloudlog.warning(f"segment {i} ({self.logreader_identifiers[i]}) failed:\n{failures[i]}")
+          pbar.update(1)
+    finally:
+      for w in workers:
+        w.join(timeout=1)
+        if w.is_alive():
+          w.terminate()
+
+      # free the shared memory of results that never made it here: still queued when we stopped
+      # early, or created by a worker that died before sending it
+      try:
+        while True:
+          wid, _, ok, payload = results.get_nowait()
+          if ok and payload is not None and payload[0]:
+            shm_received[wid] += 1
+            _unlink_shm(payload[1][0])
+      except (queue.Empty, OSError, ValueError):
+        pass
+      for wid in range(num_processes):
+        while _unlink_shm(_shm_name(shm_prefix, wid, shm_received[wid])):
+          shm_received[wid] += 1
+
+    # segments of workers that crashed, including the ones folded into their lost accumulators
+    for i in range(num_segs):
+      if i not in failures and (i not in completed or (reduce is not None and completed[i] not in finished_workers)):
+        failures[i] = "worker exited"
+
+    if len(failures) and not allow_failures:
+      failures = dict(sorted(failures.items()))
+      raise SegmentsFailed(failures, errors) from (errors[min(errors)] if len(errors) else None)
+
+    if reduce is not None:
+      if not len(accs):
+        return None
+      ret = accs[0]
+      for acc in accs[1:]:
+        ret = reduce(ret, acc)
       return ret
+    return [seg_results[i] for i in range(num_segs) if i in seg_results]
+
+  def run_across_segments(self, num_processes, func, desc=None):
+    """Runs func on each segment and concatenates the lists it returns. Like a Pool.map,
+    the first failed segment's exception is re-raised, chained to the full SegmentsFailed."""
+    try:
+      results = self.map_reduce(num_processes, func, desc=desc)
+    except SegmentsFailed as e:
+      if not len(e.errors):
+        raise
+      raise e.errors[min(e.errors)] from e
+
+    ret = []
+    for p in results:
+      ret.extend(p)
+    return ret
 
   def reset(self):
     self.logreader_identifiers = []
@@ -308,12 +812,63 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
-  def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+  def _get_index(self, i):
+    if i not in self.__indexes:
+      self.__indexes[i] = _LogFileIndex(self.logreader_identifiers[i])
+    return self.__indexes[i]
+
+  def _filter_indexed(self, msg_type: str, start_time: int | None, end_time: int | None):
+    for i in range(len(self.logreader_identifiers)):
+      index = self._get_index(i)
+      rows = index.rows(msg_type, start_time, end_time)
+      if self.sort_by_time:
+        rows = rows[np.argsort(index.index['logMonoTime'][rows], kind='stable')]
+
+      # the index rows match the events of an already loaded (unsorted) segment
+      if i in self.__lrs and not self.sort_by_time:
+        ents = self.__lrs[i]._ents
+        yield from (ents[r] for r in rows)
+      else:
+        yield from index.events(rows)
+
+  def filter(self, msg_type: str, start_time: int | None = None, end_time: int | None = None):
+    """Yields msg_type messages, optionally only those with start_time <= logMonoTime < end_time"""
+    if self.use_index:
+      msgs = self._filter_indexed(msg_type, start_time, end_time)
+    else:
+      msgs = (m for m in self if m.which() == msg_type and
+              (start_time is None or m.logMonoTime >= start_time) and (end_time is None or m.logMonoTime < end_time))
+    return (getattr(m, m.which()) for m in msgs)
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def to_columns(self, fields: ColumnSpec, cache: bool = False) -> Columns:
+    """Returns {msg_type: {field: array}} for fields like {'carState': ['vEgo', 'cruiseState.speed']},
+    each msg_type with a logMonoTime array shared by its fields. With cache=True, each log's columns
+    are stored as .npz in the tools cache dir and later calls with the same fields skip decoding entirely."""
+    seg_columns = []
+    for i, fn in enumerate(self.logreader_identifiers):
+      path = columns_cache_path(fn, fields)
+      if cache and _cache_valid(fn, path):
+        seg_columns.append(_load_columns(path, fields))
+        ManagedCache(DEFAULT_CACHE_DIR).access_file(path, hit=True)
+        continue
+
+      columns = events_to_columns(self._get_lr(i), fields)
+      if cache:
+        _save_columns(path, columns)
+        ManagedCache(DEFAULT_CACHE_DIR).access_file(path, hit=False)
+      seg_columns.append(columns)
+
+    ret = {w: {f: _concat_columns([c[w][f] for c in seg_columns]) for f in ['logMonoTime', *fs]} for w, fs in fields.items()}
+    if self.sort_by_time:
+      for cols in ret.values():
+        order = np.argsort(cols['logMonoTime'], kind='stable')
+        for f in cols:
+          cols[f] = cols[f][order]
+    return ret
+
 
 if __name__ == "__main__":
   import codecs
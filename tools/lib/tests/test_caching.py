@@ -2,11 +2,14 @@ import http.server
 import os
 import shutil
 import socket
+import tempfile
+import threading
 import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.cache import ManagedCache
+from openpilot.tools.lib.url_file import CHUNK_SIZE, URLFile, URLFileException, hash_256
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -28,11 +31,58 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = os.urandom(int(CHUNK_SIZE * 3.5))
+
+  def do_GET(self):
+    dat = self.DATA
+    if "Range" in self.headers:
+      start, end = (int(x) for x in self.headers["Range"].split("=")[1].split("-"))
+      dat = dat[start:end + 1]
+    self.send_response(206 if "Range" in self.headers else 200)
+    self.send_header("Content-Length", str(len(dat)))
+    self.end_headers()
+    self.wfile.write(dat)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
+class ShortRangeTestRequestHandler(RangeTestRequestHandler):
+  SHORT_RESPONSES = 0
+
+  def do_GET(self):
+    if ShortRangeTestRequestHandler.SHORT_RESPONSES > 0:
+      ShortRangeTestRequestHandler.SHORT_RESPONSES -= 1
+      start, end = (int(x) for x in self.headers["Range"].split("=")[1].split("-"))
+      dat = self.DATA[start:end]
+      self.send_response(206)
+      self.send_header("Content-Length", str(len(dat)))
+      self.end_headers()
+      self.wfile.write(dat)
+    else:
+      super().do_GET()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+
+@pytest.fixture
+def range_host():
+  with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
+
+@pytest.fixture
+def short_range_host():
+  with http_server_context(handler=ShortRangeTestRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
 class TestFileDownload:
 
   def test_pipeline_defaults(self, host):
@@ -128,3 +178,117 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  def test_sparse_cache(self, range_host):
+    file_url = f"{range_host}/test.hevc"
+    dat = RangeTestRequestHandler.DATA
+    cache_path = os.path.join(Paths.download_cache_root(), hash_256(file_url))
+
+    # fill in a chunk in the middle first, then read across all of them
+    for start, length in [(CHUNK_SIZE + 10, 100), (0, None), (CHUNK_SIZE - 10, 2 * CHUNK_SIZE), (len(dat) - 5, 100)]:
+      f = URLFile(file_url, cache=True)
+      f.seek(start)
+      assert f.read(ll=length) == dat[start:start + length if length is not None else None]
+
+    # a single data file holds all chunks, with one marker byte per chunk
+    with open(cache_path, "rb") as cache_file:
+      assert cache_file.read() == dat
+    with open(cache_path + "_chunks", "rb") as chunk_map:
+      assert chunk_map.read() == b"\x01" * 4
+
+  def test_short_chunk(self, short_range_host):
+    file_url = f"{short_range_host}/test_short.hevc"
+    dat = RangeTestRequestHandler.DATA
+    cache_path = os.path.join(Paths.download_cache_root(), hash_256(file_url))
+
+    # a short response is downloaded again
+    ShortRangeTestRequestHandler.SHORT_RESPONSES = 1
+    assert URLFile(file_url, cache=True).read(ll=100) == dat[:100]
+    assert ShortRangeTestRequestHandler.SHORT_RESPONSES == 0
+
+    # and never marked present if it keeps coming back short
+    f = URLFile(file_url, cache=True)
+    f.seek(CHUNK_SIZE)
+    ShortRangeTestRequestHandler.SHORT_RESPONSES = 100
+    with pytest.raises(URLFileException, match="bytes for range"):
+      f.read(ll=100)
+    ShortRangeTestRequestHandler.SHORT_RESPONSES = 0
+    with open(cache_path + "_chunks", "rb") as chunk_map:
+      assert chunk_map.read() == b"\x01"
+    assert f.read(ll=100) == dat[CHUNK_SIZE:CHUNK_SIZE + 100]
+
+
+class TestManagedCache:
+  @pytest.mark.parametrize("eviction, evicted", [("lru", "0"), ("lfu", "1")])
+  def test_eviction(self, eviction, evicted):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = ManagedCache(cache_dir, max_bytes=300, eviction=eviction)
+
+      def write(name, hits=0):
+        path = os.path.join(cache_dir, name)
+        with open(path, "wb") as f:
+          f.write(b"\x00" * 100)
+        cache.access_file(path, hit=False)
+        for _ in range(hits):
+          cache.access_file(path, hit=True)
+
+      # 0 is used the most, but the longest ago
+      write("0", hits=2)
+      write("1")
+      write("2")
+      assert sorted(f for f in os.listdir(cache_dir) if not f.startswith(".")) == ["0", "1", "2"]
+
+      write("3")
+      assert sorted(f for f in os.listdir(cache_dir) if not f.startswith(".")) == sorted({"0", "1", "2", "3"} - {evicted})
+
+      stats = cache.stats()
+      assert stats["size"] == 300
+      assert stats["entries"] == 3
+      assert stats["hits"] == 2
+      assert stats["misses"] == 4
+      assert stats["hit_rate"] == 2 / 6
+      assert stats["bytes_saved"] == 200
+
+  def test_deferred_access(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = ManagedCache(cache_dir, max_bytes=150)
+      path = os.path.join(cache_dir, "0")
+      with open(path, "wb") as f:
+        f.write(b"\x00" * 100)
+      cache.access_file(path, hit=False)
+
+      # hits are only kept in memory, until the next non deferred access or a stats call
+      for _ in range(3):
+        cache.access(path, [path], 100, hits=1, bytes_saved=100, defer=True)
+      conn = cache._connect()
+      assert conn.execute("SELECT hits FROM stats").fetchone()[0] == 0
+      conn.close()
+      stats = cache.stats()
+      assert stats["hits"] == 3
+      assert stats["bytes_saved"] == 300
+
+      # eviction waits for readers that hold the lock
+      path1 = os.path.join(cache_dir, "1")
+      with open(path1, "wb") as f:
+        f.write(b"\x00" * 100)
+      evicted = threading.Event()
+      with cache.lock():
+        t = threading.Thread(target=lambda: (cache.access_file(path1, hit=False), evicted.set()))
+        t.start()
+        assert not evicted.wait(0.5)
+        assert os.path.exists(path)
+      t.join()
+      assert not os.path.exists(path)
+
+  def test_url_file_stats(self, range_host):
+    file_url = f"{range_host}/test_stats.hevc"
+    cache = ManagedCache(Paths.download_cache_root())
+    before = cache.stats()
+
+    URLFile(file_url, cache=True).read()
+    URLFile(file_url, cache=True).read()
+
+    after = cache.stats()
+    assert after["misses"] - before["misses"] == 4
+    assert after["hits"] - before["hits"] == 4
+    assert after["bytes_saved"] - before["bytes_saved"] == len(RangeTestRequestHandler.DATA)
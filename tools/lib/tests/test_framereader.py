@@ -0,0 +1,175 @@
+import shutil
+import struct
+import threading
+import time
+import numpy as np
+import pytest
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import FrameCache, GOPFrameReader, RawFrameReader, decode_video_data, decompress_video_data, \
+                                           rgb24tonv12, rgb24toyuv420
+
+GOP_SIZE = 10
+W, H = 64, 32
+
+
+class FakeGOPFrameReader(GOPFrameReader):
+  # GOPs of GOP_SIZE frames, the raw data of a GOP is its first frame number
+  vid_fmt = "hevc"
+  w, h = W, H
+
+  def __init__(self, frame_count, **kwargs):
+    super().__init__(**kwargs)
+    self.frame_count = frame_count
+
+  def _lookup_gop(self, num):
+    frame_b = num - num % GOP_SIZE
+    return frame_b, frame_b + GOP_SIZE, 0, 0
+
+  def get_gop(self, num):
+    frame_b = num - num % GOP_SIZE
+    return frame_b, GOP_SIZE, 0, str(frame_b).encode()
+
+
+@pytest.fixture
+def fake_decoder(monkeypatch):
+  decoded = []
+
+  def decode(rawdat, vid_fmt, w, h, pix_fmt):
+    decoded.append(int(rawdat))
+    time.sleep(0.2)
+    frame_b = int(rawdat)
+    return np.repeat(np.arange(frame_b, frame_b + GOP_SIZE, dtype=np.uint8)[:, None], w * h * 3 // 2, axis=1)
+
+  monkeypatch.setattr(framereader, "decode_video_data", decode)
+  return decoded
+
+
+def encode_hevc(fn, frame_count):
+  # a moving gradient, with an I-frame every GOP_SIZE frames
+  av = pytest.importorskip("av")
+  with av.open(fn, "w", format="hevc") as container:
+    stream = container.add_stream("libx265", rate=20)
+    stream.width, stream.height = W, H
+    stream.pix_fmt = "yuv420p"
+    stream.options = {"x265-params": f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:log-level=none"}
+    x = np.arange(W)[None, :, None] + np.arange(H)[:, None, None]
+    for i in range(frame_count):
+      img = np.concatenate([(x + 4 * i) % 256, (2 * x + i) % 256, (255 - x) % 256], axis=2).astype(np.uint8)
+      for packet in stream.encode(av.VideoFrame.from_ndarray(img, format="rgb24")):
+        container.mux(packet)
+    for packet in stream.encode():
+      container.mux(packet)
+
+
+class TestFrameCache:
+  def test_byte_budget(self):
+    frame = np.zeros(100, dtype=np.uint8)
+    cache = FrameCache(max_bytes=300)
+    for i in range(3):
+      cache.put(i, frame)
+    assert cache.nbytes == 300
+
+    # the least recently used frame goes first
+    assert cache.get(0) is not None
+    cache.put(3, frame)
+    assert 1 not in cache
+    assert all(i in cache for i in (0, 2, 3))
+    assert cache.nbytes == 300
+
+    # replacing a frame accounts for the old one
+    cache.put(3, np.zeros(200, dtype=np.uint8))
+    assert cache.nbytes == 300
+    assert 2 not in cache and 0 in cache
+
+  def test_larger_than_budget(self):
+    # a single frame over the budget is still kept
+    cache = FrameCache(max_bytes=10)
+    cache.put(0, np.zeros(100, dtype=np.uint8))
+    cache.put(1, np.zeros(100, dtype=np.uint8))
+    assert 0 not in cache and 1 in cache
+    assert cache.nbytes == 100
+
+
+class TestGOPFrameReader:
+  def test_shared_gop_decode(self, fake_decoder):
+    fr = FakeGOPFrameReader(3 * GOP_SIZE)
+    frames = {}
+
+    def get(num):
+      frames[num] = fr.get(num)[0]
+
+    # concurrent requests for frames of the same GOP decode it once
+    threads = [threading.Thread(target=get, args=(num,)) for num in range(GOP_SIZE)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    assert fake_decoder == [0]
+    assert all(frames[num][0] == num for num in range(GOP_SIZE))
+
+    # the rest come from the cache, the GOPs of a batch are all queued up front
+    ret = fr.get(5, count=2 * GOP_SIZE)
+    assert sorted(fake_decoder) == [0, GOP_SIZE, 2 * GOP_SIZE]
+    assert [f[0] for f in ret] == list(range(5, 5 + 2 * GOP_SIZE))
+    assert fr.pending_gops == {}
+
+  def test_cache_budget(self, fake_decoder):
+    # room for a GOP and a half, the oldest frames are evicted and decoded again
+    fr = FakeGOPFrameReader(2 * GOP_SIZE, cache_bytes=W * H * 3 // 2 * GOP_SIZE * 3 // 2)
+    fr.get(0)
+    fr.get(GOP_SIZE)
+    assert fr.frame_cache.nbytes == fr.frame_cache.max_bytes
+    assert fr.get(GOP_SIZE - 1)[0][0] == GOP_SIZE - 1
+    assert fake_decoder == [0, GOP_SIZE]
+    assert fr.get(0)[0][0] == 0
+    assert fake_decoder == [0, GOP_SIZE, 0]
+
+
+def debayer(dat):
+  # one frame at a time, like RawFrameReader did before frames were batched
+  img = np.frombuffer(dat, dtype='uint8').reshape(960, 1280)
+  return np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
+
+
+class TestRawFrameReader:
+  @pytest.mark.parametrize("pix_fmt", ["rgb24", "nv12", "yuv420p"])
+  @pytest.mark.parametrize("threads", [1, 3])
+  def test_batched(self, tmp_path, pix_fmt, threads):
+    fn = str(tmp_path / "video.raw")
+    frames = [np.random.default_rng(i).integers(0, 256, 960 * 1280, dtype=np.uint8).tobytes() for i in range(7)]
+    with open(fn, "wb") as f:
+      for dat in frames:
+        f.write(struct.pack("I", len(dat)) + dat)
+
+    fr = RawFrameReader(fn, threads=threads)
+    assert fr.frame_count == len(frames)
+    convert = {"rgb24": lambda x: x, "nv12": rgb24tonv12, "yuv420p": rgb24toyuv420}[pix_fmt]
+    expected = [convert(debayer(dat)) for dat in frames]
+
+    single = [fr.get(i, pix_fmt=pix_fmt)[0] for i in range(len(frames))]
+    batched = fr.get(1, count=len(frames) - 1, pix_fmt=pix_fmt)
+    assert len(batched) == len(frames) - 1
+    for i, frame in enumerate(expected):
+      np.testing.assert_array_equal(single[i], frame)
+      if i > 0:
+        np.testing.assert_array_equal(batched[i - 1], frame)
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs the ffmpeg cli")
+@pytest.mark.parametrize("pix_fmt", ["yuv420p", "nv12", "rgb24", "yuv444p"])
+def test_pyav_matches_ffmpeg(tmp_path, pix_fmt):
+  fn = str(tmp_path / "video.hevc")
+  encode_hevc(fn, 3 * GOP_SIZE)
+  with open(fn, "rb") as f:
+    rawdat = f.read()
+
+  pyav = decode_video_data(rawdat, "hevc", W, H, pix_fmt)
+  ffmpeg = decompress_video_data(rawdat, "hevc", W, H, pix_fmt)
+  assert pyav.shape == ffmpeg.shape
+  assert len(pyav) == 3 * GOP_SIZE
+  if pix_fmt in ("yuv420p", "nv12"):
+    np.testing.assert_array_equal(pyav, ffmpeg)
+  else:
+    # both scale with bicubic, rounding can differ slightly between swscale setups
+    np.testing.assert_allclose(pyav.astype(int), ffmpeg.astype(int), atol=2)
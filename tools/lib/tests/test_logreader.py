@@ -1,15 +1,19 @@
+import bz2
 import capnp
 import contextlib
 import io
 import shutil
 import tempfile
 import os
+import numpy as np
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
+from openpilot.tools.lib import logreader
 from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
@@ -24,6 +28,16 @@ def noop(segment: LogIterable):
   return segment
 
 
+def mono_times(segment: LogIterable):
+  return np.array([m.logMonoTime for m in segment], dtype=np.uint64)
+
+
+def fail_on_first_segment(segment: LogIterable):
+  if next(iter(segment)).logMonoTime == 0:
+    raise ValueError("first segment")
+  return 1
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -254,3 +268,186 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_streaming(self, mocker, ext):
+    mocker.patch.object(logreader, "STREAM_READ_SIZE", 100)
+    dat = b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(1000))
+    if ext == ".bz2":
+      dat = bz2.compress(dat)
+    elif ext == ".zst":
+      dat = zstd.compress(dat)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, f"rlog{ext}")
+      with open(fn, "wb") as f:
+        f.write(dat)
+
+      msgs = [m.logMonoTime for m in LogReader(fn, streaming=True)]
+      assert msgs == [m.logMonoTime for m in LogReader(fn)]
+      assert msgs == list(range(1000))
+
+      # truncated events are dropped with a warning
+      truncated_fn = os.path.join(tmpdir, "rlog_truncated")
+      with open(truncated_fn, "wb") as f:
+        f.write(b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(10))[:-1])
+      with pytest.warns(RuntimeWarning, match="Corrupted events detected"):
+        assert len(list(LogReader(truncated_fn, streaming=True))) == 9
+
+  @pytest.mark.parametrize("sort_by_time", [True, False])
+  def test_index(self, sort_by_time, tmp_path, monkeypatch):
+    monkeypatch.setattr(logreader, "DEFAULT_CACHE_DIR", str(tmp_path))
+    with tempfile.NamedTemporaryFile(suffix=".bz2") as rlog:
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(logMonoTime=(i * 7919) % 1000)
+        if i % 10 == 0:
+          msg.init('carParams')
+        else:
+          msg.init('carState')
+        msgs.append(msg.to_bytes())
+      rlog.write(bz2.compress(b"".join(msgs)))
+      rlog.flush()
+
+      lr = LogReader(rlog.name, sort_by_time=sort_by_time)
+      for use_index in (True, True, False):  # build, then load from cache
+        lr_index = LogReader(rlog.name, sort_by_time=sort_by_time, use_index=use_index)
+        for msg_type in ("carParams", "carState", "initData"):
+          assert [m.as_builder().to_bytes() for m in lr_index.filter(msg_type)] == [m.as_builder().to_bytes() for m in lr.filter(msg_type)]
+          assert len(list(lr_index.filter(msg_type, 100, 200))) == len(list(lr.filter(msg_type, 100, 200)))
+        assert lr_index.first("initData") is None
+        assert lr_index.first("carParams") is not None
+        assert lr_index.first("carState").as_builder().to_bytes() == lr.first("carState").as_builder().to_bytes()
+
+      assert os.path.exists(logreader.log_index_path(rlog.name))
+      assert logreader.log_index_path(rlog.name).startswith(str(tmp_path))
+
+  def test_to_columns(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(logreader, "DEFAULT_CACHE_DIR", str(tmp_path))
+    with tempfile.NamedTemporaryFile() as rlog:
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        if i % 2 == 0:
+          msg.init('carState')
+          msg.carState.vEgo = i / 10
+          msg.carState.cruiseState.speed = i
+        else:
+          msg.init('controlsState')
+          msg.controlsState.curvature = -i / 100
+        msgs.append(msg.to_bytes())
+      rlog.write(b"".join(msgs))
+      rlog.flush()
+
+      fields = {'carState': ['vEgo', 'cruiseState.speed'], 'controlsState': ['curvature'], 'carParams': ['carFingerprint']}
+      lr = LogReader([rlog.name, rlog.name])
+      for cache in (True, True, False):
+        columns = lr.to_columns(fields, cache=cache)
+        assert columns['carState']['logMonoTime'].tolist() == list(range(0, 100, 2)) * 2
+        assert np.allclose(columns['carState']['vEgo'], [m.vEgo for m in lr.filter('carState')])
+        assert np.allclose(columns['carState']['cruiseState.speed'], [m.cruiseState.speed for m in lr.filter('carState')])
+        assert np.allclose(columns['controlsState']['curvature'], [m.curvature for m in lr.filter('controlsState')])
+        assert len(columns['carParams']['logMonoTime']) == len(columns['carParams']['carFingerprint']) == 0
+
+      assert os.path.exists(logreader.columns_cache_path(rlog.name, fields))
+
+  def test_to_columns_non_numeric(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(logreader, "DEFAULT_CACHE_DIR", str(tmp_path))
+    with tempfile.NamedTemporaryFile() as rlog:
+      msgs = []
+      for i in range(10):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        msg.init('carState')
+        msg.carState.gearShifter = 'drive' if i % 2 else 'park'
+        msg.carState.init('buttonEvents', i % 3)
+        msgs.append(msg.to_bytes())
+      rlog.write(b"".join(msgs))
+      rlog.flush()
+
+      # enums are stored as their names and can be cached
+      lr = LogReader(rlog.name)
+      for cache in (True, True):
+        columns = lr.to_columns({'carState': ['gearShifter']}, cache=cache)
+        assert columns['carState']['gearShifter'].tolist() == ['park', 'drive'] * 5
+
+      # struct lists only work uncached
+      fields = {'carState': ['buttonEvents']}
+      assert len(lr.to_columns(fields)['carState']['buttonEvents']) == 10
+      with pytest.raises(ValueError, match="can't be cached"):
+        lr.to_columns(fields, cache=True)
+      assert not os.path.exists(logreader.columns_cache_path(rlog.name, fields))
+
+  @pytest.mark.parametrize("prefetch_bytes", [1, logreader.PREFETCH_BYTES])
+  def test_prefetch(self, prefetch_bytes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(6):
+        fn = os.path.join(tmpdir, f"rlog_{seg}.zst")
+        with open(fn, "wb") as f:
+          f.write(zstd.compress(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100))))
+        fns.append(fn)
+
+      lr = LogReader(fns, prefetch=3, prefetch_bytes=prefetch_bytes)
+      msgs = [m.logMonoTime for m in lr]
+      assert msgs == [m.logMonoTime for m in LogReader(fns)]
+      assert msgs == list(range(600))
+      # consumed segments aren't kept around
+      assert len(lr._LogReader__lrs) == 0
+
+      # stopping early doesn't wait on the remaining segments
+      lr = LogReader(fns, prefetch=3)
+      assert next(iter(lr)).logMonoTime == 0
+
+  def test_map_reduce(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(8):
+        fn = os.path.join(tmpdir, f"rlog_{seg}")
+        with open(fn, "wb") as f:
+          f.write(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100)))
+        fns.append(fn)
+      lr = LogReader(fns)
+
+      ret = lr.map_reduce(3, mono_times)
+      assert [r.tolist() for r in ret] == [list(range(seg * 100, seg * 100 + 100)) for seg in range(8)]
+
+      ret = lr.map_reduce(3, mono_times, reduce=lambda a, b: np.concatenate([a, b]))
+      assert sorted(ret.tolist()) == list(range(800))
+
+      with pytest.raises(logreader.SegmentsFailed) as e:
+        lr.map_reduce(3, fail_on_first_segment)
+      assert list(e.value.failures) == [0]
+      assert isinstance(e.value.__cause__, ValueError)
+      assert lr.map_reduce(3, fail_on_first_segment, reduce=lambda a, b: a + b, allow_failures=True) == 7
+
+      # like a Pool.map, run_across_segments raises the segment's own exception
+      with pytest.raises(ValueError, match="first segment"):
+        lr.run_across_segments(3, fail_on_first_segment)
+
+  def test_map_reduce_shm_cleanup(self, monkeypatch):
+    def shm_blocks():
+      return {f for f in os.listdir("/dev/shm") if f.startswith(f"lrmr{os.getpid()}")}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(4):
+        fn = os.path.join(tmpdir, f"rlog_{seg}")
+        with open(fn, "wb") as f:
+          f.write(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100)))
+        fns.append(fn)
+      lr = LogReader(fns)
+
+      lr.map_reduce(2, mono_times)
+      assert shm_blocks() == set()
+
+      # workers die right after putting a result in shared memory, before sending it
+      to_transport = logreader._to_transport
+      def crash_after_transport(value, name=None):
+        to_transport(value, name)
+        os._exit(1)
+      monkeypatch.setattr(logreader, "_to_transport", crash_after_transport)
+
+      with pytest.raises(logreader.SegmentsFailed) as e:
+        lr.map_reduce(2, mono_times)
+      assert set(e.value.failures.values()) == {"worker exited"}
+      assert shm_blocks() == set()
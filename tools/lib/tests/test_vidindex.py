@@ -0,0 +1,66 @@
+import os
+import tempfile
+import pytest
+
+from openpilot.tools.lib import vidindex
+from openpilot.tools.lib.vidindex import HevcIndexer, HevcNalUnitType, VideoFileInvalid, get_ue, hevc_index
+
+
+def nal_unit(nal_unit_type: HevcNalUnitType, rbsp: bytes) -> bytes:
+  return b"\x00\x00\x01" + bytes([nal_unit_type << 1, 1]) + rbsp
+
+
+def slice_rbsp(first_slice: bool, slice_type: int, size: int) -> bytes:
+  # first_slice_segment_in_pic_flag, slice_pic_parameter_set_id = 0, slice_type, then filler without start codes
+  bits = ("1" if first_slice else "0") + "1" + {0: "1", 1: "010", 2: "011"}[slice_type]
+  bits += "1" + "0" * (-(len(bits) + 1) % 8)
+  return int(bits, 2).to_bytes(len(bits) // 8, "big") + b"\x55" * size
+
+
+class TestVidIndex:
+  def test_get_ue(self):
+    assert get_ue(b"\x80", 0, 0) == (0, 1)
+    assert get_ue(b"\x40", 0, 0) == (1, 3)
+    assert get_ue(b"\x60", 0, 0) == (2, 3)
+    assert get_ue(b"\x0f\xff", 0, 4) == (0, 1)
+    assert get_ue(b"\x00\x01\xff\xfe", 0, 0) == (2**15 - 1 + 2**15 - 1, 31)
+    # longer than the initial window
+    assert get_ue(b"\x00" * 8 + b"\x80" + b"\x00" * 8, 0, 0) == (2**64 - 1, 129)
+    with pytest.raises(VideoFileInvalid):
+      get_ue(b"\x00\x00", 0, 0)
+
+  def test_incremental(self):
+    expected_prefix = nal_unit(HevcNalUnitType.VPS_NUT, b"\x11" * 10) + nal_unit(HevcNalUnitType.SPS_NUT, b"\x22" * 10) + \
+                      nal_unit(HevcNalUnitType.PPS_NUT, b"\x33" * 10)
+    dat = b"\x00" + expected_prefix
+    expected_frames = []
+    for i in range(50):
+      expected_frames.append((i % 3, len(dat)))
+      dat += nal_unit(HevcNalUnitType.TRAIL_R, slice_rbsp(True, i % 3, 1000 + i))
+      dat += nal_unit(HevcNalUnitType.TRAIL_R, slice_rbsp(False, 1, 100))
+
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(dat)
+      f.flush()
+      frame_types, dat_len, prefix = hevc_index(f.name)
+
+    assert frame_types == expected_frames
+    assert dat_len == len(dat)
+    assert prefix == expected_prefix
+
+    # same index no matter how the data is split
+    for read_size in (1, 2, 3, 7, 500):
+      indexer = HevcIndexer()
+      for i in range(0, len(dat), read_size):
+        indexer.feed(dat[i:i + read_size])
+      assert indexer.finish() == (frame_types, dat_len, prefix)
+
+  def test_invalid(self, mocker):
+    mocker.patch.object(vidindex, "INDEX_READ_SIZE", 2)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      for dat in (b"\x00\x00", b"\x01\x00\x00\x01\x02", b"\x00\x00\x00\x02\x02"):
+        fn = os.path.join(tmpdir, "invalid.hevc")
+        with open(fn, "wb") as f:
+          f.write(dat)
+        with pytest.raises(VideoFileInvalid):
+          hevc_index(fn)
@@ -2,6 +2,7 @@ import logging
 import os
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -9,9 +10,14 @@ from urllib3.util import Timeout
 
 from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.cache import ManagedCache
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Max concurrent chunk downloads in a single read
+MAX_PARALLEL_DOWNLOADS = 8
+#  Attempts at a chunk before giving up on short responses
+CHUNK_DOWNLOAD_ATTEMPTS = 3
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -24,6 +30,45 @@ class URLFileException(Exception):
   pass
 
 
+class SparseChunkCache:
+  """Cache of a remote file's chunks, stored at their offsets in a single sparse file.
+  A sidecar map with one byte per chunk marks the chunks that have been written, so
+  processes can fill in different chunks of the same file concurrently."""
+  def __init__(self, path: str, length: int):
+    self._num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    self._data_fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    self._map_fd = os.open(path + "_chunks", os.O_RDWR | os.O_CREAT, 0o644)
+    self._map = bytearray(os.pread(self._map_fd, self._num_chunks, 0).ljust(self._num_chunks, b"\x00"))
+
+  def has_chunk(self, chunk: int) -> bool:
+    return self._map[chunk] == 1
+
+  @property
+  def size(self) -> int:
+    return self._map.count(1) * CHUNK_SIZE
+
+  def write_chunk(self, chunk: int, data: bytes) -> None:
+    # data goes in before it's marked, a partially written chunk is just downloaded again
+    os.pwrite(self._data_fd, data, chunk * CHUNK_SIZE)
+    os.pwrite(self._map_fd, b"\x01", chunk)
+    self._map[chunk] = 1
+
+  def read(self, offset: int, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+      n = os.preadv(self._data_fd, [view[pos:]], offset + pos)
+      if n == 0:
+        raise URLFileException(f"Cache file ended early at {offset + pos}, expected {offset + size} bytes")
+      pos += n
+    return bytes(buf)
+
+  def close(self) -> None:
+    os.close(self._data_fd)
+    os.close(self._map_fd)
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
 
@@ -86,37 +131,68 @@ class URLFile:
         file_length.write(str(self._length))
     return self._length
 
+  def _check_response(self, response: BaseHTTPResponse, headers: dict[str, str], download_range: bool) -> None:
+    response_code = response.status
+    if response_code == 416:  # Requested Range Not Satisfiable
+      raise URLFileException(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(response.data)[:500]}")
+    if download_range and response_code != 206:  # Partial Content
+      raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(response.data)[:500]}")
+    if (not download_range) and response_code != 200:  # OK
+      raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(response.data)[:500]}")
+
+  def _download_chunk(self, cache: "SparseChunkCache", chunk: int) -> None:
+    start = chunk * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length())
+    headers = {'Range': f"bytes={start}-{end - 1}"}
+    for _ in range(CHUNK_DOWNLOAD_ATTEMPTS):
+      response = self._request('GET', self._url, headers=headers)
+      self._check_response(response, headers, True)
+      # a truncated response would leave a hole in the sparse file that's marked present
+      if len(response.data) == end - start:
+        cache.write_chunk(chunk, response.data)
+        return
+    raise URLFileException(f"Error, got {len(response.data)} bytes for range of {end - start} {headers} ({self._url})")
+
   def read(self, ll: int|None=None) -> bytes:
     if self._force_download:
       return self.read_aux(ll=ll)
 
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    file_end = min(self._pos + ll, length) if ll is not None else length
+    if file_begin >= file_end:
+      return b""
+
+    cache_path = os.path.join(Paths.download_cache_root(), hash_256(self._url))
+    managed_cache = ManagedCache(Paths.download_cache_root())
+    # the data file and chunk map are opened together, eviction can't delete one in between
+    with managed_cache.lock():
+      cache = SparseChunkCache(cache_path, length)
+    try:
+      #  Download the chunks we don't have yet, in parallel if there are multiple
+      chunks = range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1)
+      missing = [c for c in chunks if not cache.has_chunk(c)]
+      if len(missing) == 1:
+        self._download_chunk(cache, missing[0])
+      elif len(missing) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(missing), MAX_PARALLEL_DOWNLOADS)) as executor:
+          for future in [executor.submit(self._download_chunk, cache, c) for c in missing]:
+            future.result()
+
+      response = cache.read(file_begin, file_end - file_begin)
+    finally:
+      cache.close()
+
+    cached = [c for c in chunks if c not in missing]
+    bytes_saved = sum(min(file_end, (c + 1) * CHUNK_SIZE) - max(file_begin, c * CHUNK_SIZE) for c in cached)
+    # the chunk map goes first on eviction, so a chunk is never marked present without its data.
+    # reads of chunks that were all cached are accounted for in batches
+    managed_cache.access(hash_256(self._url), [cache_path + "_chunks", cache_path, cache_path + "_length"], cache.size,
+                         hits=len(cached), misses=len(missing), bytes_saved=bytes_saved, defer=not len(missing))
+
+    self._pos = file_end
+    return response
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -126,7 +202,7 @@ class URLFile:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
@@ -142,13 +218,7 @@ class URLFile:
       if t2 - t1 > 0.1:
         print(f"get {self._url} {headers!r} {t2 - t1:.3f} slow")
 
-    response_code = response.status
-    if response_code == 416:  # Requested Range Not Satisfiable
-      raise URLFileException(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-    if download_range and response_code != 206:  # Partial Content
-      raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-    if (not download_range) and response_code != 200:  # OK
-      raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
+    self._check_response(response, headers, download_range)
 
     self._pos += len(ret)
     return ret
@@ -17,6 +17,8 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+# size of the reads done while indexing a file
+INDEX_READ_SIZE = 1000 * 1000
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -120,32 +122,22 @@ class VideoFileInvalid(Exception):
   pass
 
 def get_ue(dat: bytes, start_idx: int, skip_bits: int) -> tuple[int, int]:
-  prefix_val = 0
-  prefix_len = 0
-  suffix_val = 0
-  suffix_len = 0
-
-  i = start_idx
-  while i < len(dat):
-    j = 7
-    while j >= 0:
-      if skip_bits > 0:
-        skip_bits -= 1
-      elif prefix_val == 0:
-        prefix_val = (dat[i] >> j) & 1
-        prefix_len += 1
-      else:
-        suffix_val = (suffix_val << 1) | ((dat[i] >> j) & 1)
-        suffix_len += 1
-      j -= 1
-
-      if prefix_val == 1 and prefix_len - 1 == suffix_len:
-        val = 2**(prefix_len-1) - 1 + suffix_val
-        size = prefix_len + suffix_len
-        return val, size
-    i += 1
-
-  raise VideoFileInvalid("invalid exponential-golomb code")
+  # read a window of bits as an int and find the prefix with bit_length, growing the window for long codes
+  window = 8
+  while True:
+    chunk = dat[start_idx:start_idx + window]
+    num_bits = len(chunk) * 8 - skip_bits
+    if num_bits > 0:
+      bits = int.from_bytes(chunk, "big") & ((1 << num_bits) - 1)
+      leading_zeros = num_bits - bits.bit_length()
+      size = 2 * leading_zeros + 1
+      if bits and size <= num_bits:
+        suffix_val = (bits >> (num_bits - size)) & ((1 << leading_zeros) - 1)
+        return (1 << leading_zeros) - 1 + suffix_val, size
+
+    if start_idx + window >= len(dat):
+      raise VideoFileInvalid("invalid exponential-golomb code")
+    window *= 2
 
 def require_nal_unit_start(dat: bytes, nal_unit_start: int) -> None:
   if nal_unit_start < 1:
@@ -258,38 +250,91 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
-  with FileReader(hevc_file_name) as f:
-    dat = f.read()
-
-  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
-    raise VideoFileInvalid("data is too short")
-
-  if dat[0] != 0x00:
-    raise VideoFileInvalid("first byte must be 0x00")
+class HevcIndexer:
+  """Builds the index of an hevc stream incrementally, as data is fed to it. Only the NAL unit
+  being read is buffered, so partially downloaded or streamed files can be indexed as they arrive."""
+  def __init__(self, allow_corrupt: bool=False):
+    self.allow_corrupt = allow_corrupt
+    self.frame_types: list[tuple[int, int]] = []
+    self.prefix_dat = bytearray()
+    self.dat_len = 0
+
+    self._buf = bytearray()
+    self._buf_offset = 0  # file offset of _buf[0]
+    self._nal_unit_start: int | None = None  # in _buf
+    self._search_start = 0  # in _buf, where to look for the next start code
+    self._done = False
+
+  def _add_nal_unit(self, nal_unit_start: int, nal_unit_end: int) -> None:
+    nal_unit_type = get_hevc_nal_unit_type(self._buf, nal_unit_start)
+    if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+      self.prefix_dat += self._buf[nal_unit_start:nal_unit_end]
+    elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+      slice_type, is_first_slice = get_hevc_slice_type(self._buf, nal_unit_start, nal_unit_type)
+      if is_first_slice:
+        self.frame_types.append((slice_type, self._buf_offset + nal_unit_start))
+
+  def _index(self, final: bool) -> None:
+    try:
+      if self._nal_unit_start is None:
+        if len(self._buf) < NAL_UNIT_START_CODE_SIZE + 1:
+          if final:
+            raise VideoFileInvalid("data is too short")
+          return
+        if self._buf[0] != 0x00:
+          raise VideoFileInvalid("first byte must be 0x00")
+        self._nal_unit_start = 1 # skip past first byte 0x00
+        self._search_start = 1 + NAL_UNIT_START_CODE_SIZE
+        require_nal_unit_start(self._buf, 1)
+
+      while not self._done:
+        # length of NAL unit is byte count up to next NAL unit start index
+        pos = self._buf.find(NAL_UNIT_START_CODE, self._search_start)
+        if pos == -1:
+          if not final:
+            # the start code could be split across feeds
+            self._search_start = max(self._search_start, len(self._buf) - NAL_UNIT_START_CODE_SIZE + 1)
+            break
+          pos = len(self._buf)
+          self._done = True
+
+        if DEBUG:
+          print("  nal_unit_len:", pos - self._nal_unit_start)
+        self._add_nal_unit(self._nal_unit_start, pos)
+        self._nal_unit_start = pos
+        self._search_start = pos + NAL_UNIT_START_CODE_SIZE
+    except Exception as e:
+      if self._nal_unit_start is None or not self.allow_corrupt:
+        raise
+      print(f"ERROR: NAL unit skipped @ {self._buf_offset + self._nal_unit_start}\n", str(e))
+      self._done = True
+
+    # drop everything before the NAL unit being read
+    if self._nal_unit_start is not None and self._nal_unit_start > 0:
+      del self._buf[:self._nal_unit_start]
+      self._buf_offset += self._nal_unit_start
+      self._search_start -= self._nal_unit_start
+      self._nal_unit_start = 0
+
+  def feed(self, dat: bytes) -> None:
+    self.dat_len += len(dat)
+    if self._done:
+      return
+    self._buf += dat
+    self._index(final=False)
+
+  def finish(self) -> tuple[list, int, bytes]:
+    if not self._done:
+      self._index(final=True)
+    return self.frame_types, self.dat_len, bytes(self.prefix_dat)
 
-  prefix_dat = b""
-  frame_types = list()
 
-  i = 1 # skip past first byte 0x00
-  try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
-      nal_unit_type = get_hevc_nal_unit_type(dat, i)
-      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
-  except Exception as e:
-    if not allow_corrupt:
-      raise
-    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
-
-  return frame_types, len(dat), prefix_dat
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  indexer = HevcIndexer(allow_corrupt)
+  with FileReader(hevc_file_name) as f:
+    while dat := f.read(INDEX_READ_SIZE):
+      indexer.feed(dat)
+  return indexer.finish()
 
 def main() -> None:
   parser = argparse.ArgumentParser()